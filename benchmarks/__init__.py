@@ -0,0 +1,6 @@
+# Benchmarks for the probe website. They run against a temporary SQLite
+# database and Ansible directory, seeded with a synthetic fleet of users and
+# probes (see fleet.py), so they can be run without a real server setup.
+#
+# Run e.g.:
+#   python -m benchmarks.bench_views --users 5 --probes 50 --output results.json
@@ -0,0 +1,209 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from benchmarks import common
+
+# End-to-end benchmark against a simulated fleet (see simulator.py): tunnel
+# checks, the connection status endpoint and Ansible pushes, with the wall
+# clock time and resource use of each.
+#
+# The push is done with a playbook of raw tasks (no Python is needed on the
+# fake probes), once with the tuned ansible.cfg from
+# ansible_interface.export_ansible_config and once with Ansible's defaults.
+
+PLAYBOOK = '''- hosts: all
+  gather_facts: no
+  tasks:
+    - raw: /root/connection_status.sh
+    - raw: echo configured
+'''
+
+
+def measure(func):
+    """Run 'func', and return its result and a dictionary with the wall clock
+    time, CPU time and max RSS of this process and its children"""
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    result = func()
+    wall = time.perf_counter() - start
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return result, {
+            'wall': wall,
+            'user_cpu': self_after.ru_utime - self_before.ru_utime,
+            'system_cpu': self_after.ru_stime - self_before.ru_stime,
+            'children_user_cpu': children_after.ru_utime - children_before.ru_utime,
+            'children_system_cpu': children_after.ru_stime - children_before.ru_stime,
+            # In KiB (on Linux)
+            'max_rss': self_after.ru_maxrss,
+            'children_max_rss': children_after.ru_maxrss
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark tunnel checks, status polls and pushes '
+                                                 'against a simulated fleet of probes')
+    parser.add_argument('--probes', type=int, default=100, help='number of simulated probes (10-1000)')
+    parser.add_argument('--latency', type=float, default=0, help='seconds of added latency')
+    parser.add_argument('--loss', type=float, default=0, help='probability of dropped connections')
+    parser.add_argument('--dead', type=float, default=0, help='fraction of probes with stale tunnels')
+    parser.add_argument('--down', type=float, default=0, help='fraction of probes without tunnels')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the simulator')
+    parser.add_argument('--skip-ansible', action='store_true', help="don't benchmark Ansible pushes")
+    parser.add_argument('--output', default=None, help='JSON output file (default: stdout)')
+    parser.add_argument('--keep', action='store_true', help="don't remove the temporary database etc.")
+    args = parser.parse_args()
+
+    root = common.configure()
+
+    # Must be imported after configure()
+    import paramiko
+    from benchmarks import fleet
+    from probe_website import app, util, preflight, status_cache
+    from probe_website import ansible_interface as ansible
+    import probe_website.views as views
+
+    database = views.database
+    database.init_database()
+    ansible_path = ansible.settings.ANSIBLE_PATH
+    fleet.write_default_scripts(ansible_path, 3)
+    username = fleet.generate_fleet(database, users=1, probes=args.probes)[0]
+
+    # All the fake probes share one host key
+    host_key = paramiko.RSAKey.generate(2048)
+    host_key_path = os.path.join(root, 'simulator_host_key')
+    host_key.write_private_key_file(host_key_path)
+    user = database.get_user(username)
+    for probe in user.probes:
+        probe.set_host_key('localhost ssh-rsa {}'.format(host_key.get_base64()))
+    database.save_changes()
+    ansible.export_known_hosts(database)
+
+    with open(os.path.join(ansible_path, 'probe.yml'), 'w') as f:
+        f.write(PLAYBOOK)
+    with open(os.path.join(ansible_path, 'vault_pass.txt'), 'w') as f:
+        f.write('benchmark\n')
+
+    ports = [probe.port for probe in user.probes]
+    macs = [probe.custom_id for probe in user.probes]
+    database.shutdown_session()
+
+    simulator = subprocess.Popen([sys.executable, '-m', 'benchmarks.simulator',
+                                  '--host-key', host_key_path,
+                                  '--ports', ','.join(str(port) for port in ports),
+                                  '--latency', str(args.latency),
+                                  '--loss', str(args.loss),
+                                  '--dead', str(args.dead),
+                                  '--down', str(args.down),
+                                  '--seed', str(args.seed)],
+                                 cwd=common.PROJECT_ROOT,
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    fleet_info = json.loads(simulator.stdout.readline().decode('utf-8'))
+
+    app.config['TESTING'] = True
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': fleet.PASSWORD})
+
+    results = {}
+    try:
+        def check_tunnels():
+            return sum(1 for port in ports if util.is_probe_connected(port) is True)
+
+        util.probe_breaker.reset()
+        connected, results['is_probe_connected'] = measure(check_tunnels)
+        results['is_probe_connected']['connected'] = connected
+
+        def run_preflight():
+            report = preflight.run_preflight(database, database.get_user(username))
+            database.shutdown_session()
+            return len(report.eligible)
+
+        util.probe_breaker.reset()
+        eligible, results['preflight'] = measure(run_preflight)
+        results['preflight']['eligible'] = eligible
+
+        def poll_statuses(etags):
+            statuses = {}
+            for mac in macs:
+                headers = {'If-None-Match': etags[mac]} if mac in etags else {}
+                response = client.get('/get_connection_status?mac=' + mac, headers=headers)
+                statuses[mac] = response.status_code
+                if 'ETag' in response.headers:
+                    etags[mac] = response.headers['ETag']
+            return statuses
+
+        # The first poll goes to the probes, the second one should be 304s
+        # from the status cache
+        util.probe_breaker.reset()
+        status_cache.clear()
+        etags = {}
+        statuses, results['connection_status_cold'] = measure(lambda: poll_statuses(etags))
+        statuses, results['connection_status_cached'] = measure(lambda: poll_statuses(etags))
+        results['connection_status_cached']['not_modified'] = sum(1 for code in statuses.values() if code == 304)
+
+        if args.skip_ansible:
+            results['ansible'] = 'skipped'
+        elif shutil.which('ansible-playbook') is None:
+            results['ansible'] = 'skipped (ansible-playbook not found)'
+        else:
+            util.probe_breaker.reset()
+            results['ansible_tuned_config'] = _benchmark_push(database, username, ansible)
+
+            # Ansible's defaults, for comparison
+            default_config = os.path.join(root, 'ansible-default.cfg')
+            open(default_config, 'w').close()
+            tuned_export = ansible.export_ansible_config
+            ansible.export_ansible_config = lambda *args: default_config
+            try:
+                results['ansible_default_config'] = _benchmark_push(database, username, ansible)
+            finally:
+                ansible.export_ansible_config = tuned_export
+    finally:
+        simulator.stdin.close()
+        simulator_stats = json.loads(simulator.stdout.readline().decode('utf-8') or '{}')
+        simulator.wait()
+
+    params = {'probes': args.probes, 'latency': args.latency, 'loss': args.loss,
+              'dead': len(fleet_info['dead']), 'down': len(fleet_info['down']),
+              'seed': args.seed, 'cpus': os.cpu_count()}
+    results['simulator'] = simulator_stats
+    common.write_results('fleet', params, results, args.output)
+
+    if not args.keep:
+        shutil.rmtree(root)
+
+
+def _benchmark_push(database, username, ansible):
+    """Push to all of 'username's probes through run_ansible_playbook, and
+    return the measurements and results of the run"""
+    from probe_website import preflight
+
+    def push():
+        user = database.get_user(username)
+        report = preflight.run_preflight(database, user)
+        for probe in report.eligible:
+            ansible.export_probe_configs(probe, user.get_organization(), database)
+        ansible.export_to_inventory(username, report.eligible)
+        ansible.run_ansible_playbook(username, database)
+        ansible.supervisor.wait(username, timeout=ansible.ANSIBLE_TIMEOUT)
+        # Records the results of the run
+        ansible.get_playbook_status(username, database)
+        run = database.get_last_ansible_run(username)
+        succeeded = sum(1 for host in run.hosts if host.succeeded())
+        database.shutdown_session()
+        return len(report.eligible), succeeded
+
+    (hosts, succeeded), measurements = measure(push)
+    measurements.update({'hosts': hosts, 'succeeded': succeeded})
+    return measurements
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import argparse
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks import common
+from benchmarks.oauth_server import OAuthServer
+
+# Times Dataporten logins (/__oauth/callback) against the local stand-in
+# OAuth server (see oauth_server.py), e.g. the rush of logins at the start
+# of a term. Each user logs in 'logins' times; the first login also adds the
+# user. The number of connections the OAuth server got shows whether they
+# were reused between logins.
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Dataporten logins against a local '
+                                                 'stand-in OAuth server')
+    parser.add_argument('--users', type=int, default=50, help='number of users')
+    parser.add_argument('--logins', type=int, default=3, help='logins per user')
+    parser.add_argument('--concurrency', type=int, default=8, help='logins at the same time')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds added to each OAuth request')
+    parser.add_argument('--handshake-latency', type=float, default=0.05,
+                        help='seconds added to each new OAuth connection (the TLS handshake)')
+    parser.add_argument('--no-pool', action='store_true',
+                        help="use a new HTTP session for each OAuth request (no keep-alive)")
+    parser.add_argument('--output', default=None, help='JSON output file (default: stdout)')
+    parser.add_argument('--keep', action='store_true', help="don't remove the temporary database etc.")
+    args = parser.parse_args()
+
+    server = OAuthServer(0, args.latency, args.handshake_latency)
+    server.start()
+    root = common.configure(OAUTH_BASE_URL=server.get_base_url(),
+                            OAUTH_POOL_SIZE=args.concurrency)
+
+    # Must be imported after configure()
+    from rauth import OAuth2Session
+    from probe_website import app, oauth
+    import probe_website.views as views
+
+    views.database.init_database()
+    if args.no_pool:
+        oauth.dataporten.service.session_obj = OAuth2Session
+
+    app.config['TESTING'] = True
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def login(n):
+        client = app.test_client()
+        start = time.perf_counter()
+        response = client.get('/__oauth/callback?code=user{}-{}'.format(n % args.users, n))
+        duration = time.perf_counter() - start
+        # A successful login redirects to the front page, with the session cookie set
+        ok = response.status_code == 302 and 'Set-Cookie' in response.headers
+        with lock:
+            latencies.append(duration)
+            if not ok or client.get('/probes').status_code != 200:
+                failures.append(n)
+
+    # One round of first logins (adding the users), then the rest
+    results = {}
+    for name, logins in [('first_login', range(args.users)),
+                         ('login', range(args.users, args.users * args.logins))]:
+        del latencies[:]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(login, logins))
+        wall = time.perf_counter() - start
+        results[name] = {'wall': wall,
+                         'logins_per_second': len(latencies) / wall if wall > 0 else 0,
+                         'latency': common.percentiles(latencies)}
+
+    results['failures'] = len(failures)
+    results['oauth_server'] = server.stats
+    server.shutdown()
+
+    params = {'users': args.users, 'logins': args.logins, 'concurrency': args.concurrency,
+              'latency': args.latency, 'handshake_latency': args.handshake_latency,
+              'pool': not args.no_pool}
+    common.write_results('login', params, results, args.output)
+
+    if not args.keep:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
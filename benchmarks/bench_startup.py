@@ -0,0 +1,122 @@
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks import common
+
+# Measures the cold start of a web server process (e.g. a FastCGI worker
+# being spawned): the time to import probe_website, and the time of the
+# first request, against databases with different numbers of users. Each
+# measurement is done in a new Python process, both with an empty template
+# cache ('cold') and with the templates precompiled ('precompiled', as
+# after 'flask compile-templates').
+
+
+def seed(root, users):
+    """Set up the database at 'root', with 'users' users (plus admin)"""
+    common.configure(root)
+    from werkzeug.security import generate_password_hash
+    from probe_website.database import User
+    import probe_website.views as views
+
+    database = views.database
+    database.init_database()
+    # Inserted directly, as hashing a password for each user takes too long
+    pw_hash = generate_password_hash('benchmark')
+    database.session.bulk_insert_mappings(User, [{'username': 'user{}'.format(i),
+                                                  'pw_hash': pw_hash,
+                                                  'contact_person': 'Contact {}'.format(i),
+                                                  'contact_email': 'user{}@example.org'.format(i),
+                                                  'admin': False} for i in range(users)])
+    database.save_changes()
+
+
+def measure(root):
+    """Import probe_website and do the first request, and print the
+    durations (in seconds) as JSON"""
+    start = time.perf_counter()
+    common.configure(root)
+    from probe_website import app
+    imported = time.perf_counter()
+
+    client = app.test_client()
+    response = client.get('/login')
+    if response.status_code != 200:
+        raise RuntimeError('Got status {}'.format(response.status_code))
+    first_request = time.perf_counter()
+
+    print(json.dumps({'import': imported - start, 'first_request': first_request - imported}))
+
+
+def compile_templates(root):
+    common.configure(root)
+    from probe_website.cli import compile_all_templates
+    compile_all_templates()
+
+
+def run_child(*args):
+    return subprocess.check_output([sys.executable, '-m', 'benchmarks.bench_startup'] + list(args),
+                                   cwd=common.PROJECT_ROOT).decode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of the web site')
+    parser.add_argument('--users', default='0,1000,10000', help='comma separated numbers of users')
+    parser.add_argument('--repeat', type=int, default=5, help='runs for each number of users')
+    parser.add_argument('--output', default=None, help='JSON output file (default: stdout)')
+    parser.add_argument('--keep', action='store_true', help="don't remove the temporary databases etc.")
+    parser.add_argument('--seed', nargs=2, metavar=('ROOT', 'USERS'), help=argparse.SUPPRESS)
+    parser.add_argument('--measure', metavar='ROOT', help=argparse.SUPPRESS)
+    parser.add_argument('--compile', metavar='ROOT', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        seed(args.seed[0], int(args.seed[1]))
+        return
+    if args.measure is not None:
+        measure(args.measure)
+        return
+    if args.compile is not None:
+        compile_templates(args.compile)
+        return
+
+    results = {}
+    for users in [int(users) for users in args.users.split(',')]:
+        root = tempfile.mkdtemp(prefix='probe-bench-')
+        run_child('--seed', root, str(users))
+        template_cache = os.path.join(root, 'template_cache')
+
+        results[str(users)] = {}
+        for mode in ['cold', 'precompiled']:
+            if mode == 'precompiled':
+                run_child('--compile', root)
+
+            runs = []
+            for i in range(args.repeat):
+                if mode == 'cold':
+                    shutil.rmtree(template_cache, ignore_errors=True)
+                start = time.perf_counter()
+                run = json.loads(run_child('--measure', root))
+                # Includes starting the interpreter
+                run['process'] = time.perf_counter() - start
+                runs.append(run)
+
+            results[str(users)][mode] = {key: {'median': statistics.median(run[key] for run in runs),
+                                               'min': min(run[key] for run in runs),
+                                               'max': max(run[key] for run in runs)}
+                                         for key in ['import', 'first_request', 'process']}
+
+        if not args.keep:
+            shutil.rmtree(root)
+
+    params = {'users': args.users, 'repeat': args.repeat}
+    common.write_results('startup', params, results, args.output)
+
+
+if __name__ == '__main__':
+    main()
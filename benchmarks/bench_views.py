@@ -0,0 +1,111 @@
+import argparse
+import shutil
+from benchmarks import common
+
+# Times the main views of the web site through Flask's test client, against
+# a synthetic fleet (see fleet.py). Ansible itself is never started, and the
+# probes are treated as connected.
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the main views of the probe website')
+    parser.add_argument('--users', type=int, default=5, help='number of users')
+    parser.add_argument('--probes', type=int, default=20, help='probes per user')
+    parser.add_argument('--scripts', type=int, default=10, help='scripts per probe')
+    parser.add_argument('--repeat', type=int, default=10, help='runs of each benchmark')
+    parser.add_argument('--output', default=None, help='JSON output file (default: stdout)')
+    parser.add_argument('--keep', action='store_true', help="don't remove the temporary database etc.")
+    args = parser.parse_args()
+
+    root = common.configure()
+
+    # Must be imported after configure()
+    from benchmarks import fleet
+    from probe_website import app, util
+    from probe_website import ansible_interface as ansible
+    import probe_website.views as views
+
+    database = views.database
+    database.init_database()
+    fleet.write_default_scripts(ansible.settings.ANSIBLE_PATH, args.scripts)
+    usernames = fleet.generate_fleet(database, args.users, args.probes, unregistered=args.repeat)
+    username = usernames[0]
+
+    # Stub out everything that would need real probes or Ansible
+    util.is_probe_connected = lambda port: True
+    ansible._start_playbook = lambda *args, **kwargs: None
+
+    app.config['TESTING'] = True
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': fleet.PASSWORD})
+    admin_client = app.test_client()
+    admin_client.post('/login', data={'username': 'admin', 'password': 'admin'})
+
+    probe_id = database.get_user(username).probes[0].custom_id
+    setup_form = _get_setup_form(database, probe_id)
+
+    def check(response):
+        # Reading the body also renders streamed pages (e.g. /probes)
+        response.get_data()
+        if response.status_code >= 400:
+            raise RuntimeError('Got status {}'.format(response.status_code))
+
+    def get_all_user_data():
+        database.get_all_user_data()
+        database.shutdown_session()
+
+    unregistered = fleet.get_unregistered_macs(database, username)
+    database.shutdown_session()
+
+    def register_key():
+        n = len(unregistered)
+        response = client.post('/register_key', data={'mac': unregistered.pop(),
+                                                      'pub_key': fleet.make_pub_key(10**6 + n),
+                                                      'host_key': fleet.make_host_key(10**6 + n)})
+        if response.data != b'success':
+            raise RuntimeError('register_key failed: {}'.format(response.data))
+
+    benchmarks = [
+            ('probes_render', lambda: check(client.get('/probes'))),
+            ('probe_setup_get', lambda: check(client.get('/probe_setup?id=' + probe_id))),
+            ('probe_setup_post', lambda: check(client.post('/probe_setup?id=' + probe_id, data=setup_form))),
+            ('push_config_export', lambda: check(client.post('/probes', data={'action': 'push_config'}))),
+            ('get_all_user_data', get_all_user_data),
+            ('user_managment_render', lambda: check(admin_client.get('/user_managment'))),
+            ('register_key', register_key),
+    ]
+
+    results = {}
+    for name, func in benchmarks:
+        results[name] = common.time_call(func, args.repeat)
+
+    params = {'users': args.users, 'probes': args.probes, 'scripts': args.scripts,
+              'repeat': args.repeat}
+    common.write_results('views', params, results, args.output)
+
+    if not args.keep:
+        shutil.rmtree(root)
+
+
+def _get_setup_form(database, probe_id):
+    """Return the form data of saving 'probe_id' unchanged on probe_setup"""
+    from probe_website import util
+    probe = database.get_probe(probe_id)
+    form = {'probe_name': probe.name,
+            'probe_id': util.convert_mac(probe.custom_id, mode='display'),
+            'probe_location': probe.location,
+            'action': 'save'}
+    for script in probe.scripts:
+        form['script.{}.minute_interval'.format(script.id)] = str(script.minute_interval)
+        if script.enabled:
+            form['script.{}.enabled'.format(script.id)] = 'on'
+    for config in probe.network_configs:
+        form['network.{}.ssid'.format(config.id)] = config.ssid
+        form['network.{}.anonymous_id'.format(config.id)] = config.anonymous_id
+        form['network.{}.username'.format(config.id)] = config.username
+        form['network.{}.password'.format(config.id)] = config.password
+    return form
+
+
+if __name__ == '__main__':
+    main()
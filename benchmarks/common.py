@@ -0,0 +1,125 @@
+import sys
+import os
+import json
+import time
+import types
+import tempfile
+import platform
+import statistics
+import subprocess
+
+# Settings used when running the benchmarks. They are installed as the
+# probe_website.settings and probe_website.secret_settings modules (see
+# configure), so no settings.py is needed.
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def configure(root=None, **extra_settings):
+    """Set up a temporary environment for the benchmarks at 'root' (a new
+    temporary directory if None), and return its path.
+
+    NB: This must be called before anything from probe_website is imported,
+    as the settings are read at import time.
+    """
+    if 'probe_website' in sys.modules:
+        raise RuntimeError('configure() must be called before probe_website is imported')
+
+    if root is None:
+        root = tempfile.mkdtemp(prefix='probe-bench-')
+    ansible_path = os.path.join(root, 'ansible-probes', '')
+    for dir_name in ['group_vars/all', 'host_vars', 'inventory', 'logs', 'certs']:
+        os.makedirs(os.path.join(ansible_path, dir_name), exist_ok=True)
+
+    settings = types.ModuleType('probe_website.settings')
+    settings.ROOT_DIR = root
+    settings.DATABASE_URL = 'sqlite:///' + os.path.join(root, 'database.db')
+    settings.ANSIBLE_PATH = ansible_path
+    settings.CERTIFICATE_DIR = os.path.join(ansible_path, 'certs', '')
+    settings.ALLOWED_CERT_EXTENSIONS = set(['cer', 'cert', 'ca', 'pem'])
+    settings.PROBE_ASSOCIATION_PERIOD = 40*60
+    # The background sampler would skew the measurements
+    settings.HISTORY_SAMPLE_INTERVAL = None
+    for key, value in extra_settings.items():
+        setattr(settings, key, value)
+
+    secret_settings = types.ModuleType('probe_website.secret_settings')
+    secret_settings.OAUTH_CREDENTIALS = {'id': 'ClientID', 'secret': 'ClientSecret'}
+    secret_settings.SECRET_KEY = 'benchmark signing key'
+
+    sys.modules['probe_website.settings'] = settings
+    sys.modules['probe_website.secret_settings'] = secret_settings
+
+    if PROJECT_ROOT not in sys.path:
+        sys.path.insert(0, PROJECT_ROOT)
+
+    return root
+
+
+def time_call(func, repeat=10, setup=None):
+    """Call 'func' 'repeat' times, and return statistics (in seconds) of
+    the durations as a dictionary. 'setup' is called before each call,
+    without being timed."""
+    durations = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+
+    return {
+            'runs': repeat,
+            'min': min(durations),
+            'median': statistics.median(durations),
+            'mean': statistics.mean(durations),
+            'max': max(durations)
+    }
+
+
+def percentiles(durations):
+    """Return latency statistics (in milliseconds) of 'durations' (seconds)"""
+    if len(durations) == 0:
+        return {'count': 0}
+
+    durations = sorted(durations)
+
+    def percentile(p):
+        return 1000 * durations[min(len(durations) - 1, int(round(p / 100 * (len(durations) - 1))))]
+
+    return {
+            'count': len(durations),
+            'mean': 1000 * statistics.mean(durations),
+            'p50': percentile(50),
+            'p90': percentile(90),
+            'p99': percentile(99),
+            'max': 1000 * durations[-1]
+    }
+
+
+def get_commit():
+    """Return the git commit of the project, or None"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_ROOT,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def write_results(name, params, results, output=None):
+    """Write the results of benchmark 'name' as JSON to 'output' (a path),
+    or stdout if None"""
+    data = {
+            'benchmark': name,
+            'commit': get_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'params': params,
+            'results': results
+    }
+    text = json.dumps(data, indent=2, sort_keys=True)
+    if output is None:
+        print(text)
+    else:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
@@ -0,0 +1,83 @@
+import os
+import yaml
+
+# Generates a synthetic fleet of users, probes, scripts and network configs,
+# added through DatabaseManager the same way the web site adds them.
+
+PASSWORD = 'benchmark'
+
+
+def make_mac(n):
+    """Return a unique (locally administered) MAC in storage format for 'n'"""
+    return '02{:010x}'.format(n)
+
+
+def make_pub_key(n):
+    return 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQC{:08d} root@probe{}'.format(n, n)
+
+
+def make_host_key(n):
+    return 'localhost ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQD{:08d}'.format(n)
+
+
+def write_default_scripts(ansible_path, scripts):
+    """Write a global default script config with 'scripts' scripts, which
+    new probes get (see DatabaseManager.load_default_scripts)"""
+    configs = [{'name': 'Script {}'.format(i),
+                'script_file': 'script{}.py'.format(i),
+                'args': '--interval {}'.format(i),
+                'minute_interval': 5 + i,
+                'enabled': i % 2 == 0,
+                'required': i == 0} for i in range(scripts)]
+    path = os.path.join(ansible_path, 'group_vars', 'all', 'script_configs.yml')
+    with open(path, 'w') as f:
+        yaml.safe_dump({'default_script_configs': configs}, f, default_flow_style=False)
+
+
+def generate_fleet(database, users=5, probes=20, unregistered=0, first_mac=0):
+    """Add 'users' users with 'probes' registered and configured probes each
+    (plus 'unregistered' probes waiting for register_key). Return a list of
+    the usernames.
+
+    Each probe gets the default scripts (see write_default_scripts).
+    """
+    usernames = []
+    n = first_mac
+    for i in range(users):
+        username = 'user{}'.format(i)
+        database.add_user(username, PASSWORD, 'Contact {}'.format(i),
+                          'user{}@example.org'.format(i))
+        user = database.get_user(username)
+        for db in user.databases:
+            db.db_name = 'probes'
+            db.address = 'db.example.org'
+            db.port = '8086'
+            db.username = username
+            db.password = PASSWORD
+            db.status = 'custom'
+        database.save_changes()
+
+        for j in range(probes + unregistered):
+            probe = database.add_probe(username, 'Probe {}-{}'.format(i, j), make_mac(n),
+                                       'Room {}'.format(j))
+            if j < probes:
+                probe.set_pub_key(make_pub_key(n))
+                probe.set_host_key(make_host_key(n))
+                probe.associated = True
+                for config in probe.network_configs:
+                    config.ssid = 'eduroam'
+                    config.anonymous_id = 'anonymous@example.org'
+                    config.username = username
+                    config.password = PASSWORD
+            n += 1
+            # Saved for each probe, so the port generation sees the added probes
+            database.save_changes()
+
+        usernames.append(username)
+
+    return usernames
+
+
+def get_unregistered_macs(database, username):
+    """Return the MACs of 'username's probes that have no keys registered"""
+    return [probe.custom_id for probe in database.get_user(username).probes if probe.pub_key == '']
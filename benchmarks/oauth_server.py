@@ -0,0 +1,133 @@
+import argparse
+import json
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# A local stand-in for Dataporten's OAuth server, for benchmarking the login
+# path (set OAUTH_BASE_URL to its address). It implements just enough of it
+# for probe_website.oauth:
+#   GET  /oauth/authorization : redirects back with a code
+#   POST /oauth/token         : exchanges a code for an access token
+#   GET  /userinfo            : returns the user of the access token
+#
+# Codes are of the form <user id>-<anything>, and the user is
+# <user id>@example.org, so a benchmark can log in as any user with
+# /__oauth/callback?code=<user id>-1 without going through the authorization
+# redirect.
+#
+# The server supports keep-alive connections, and can add a delay to each
+# new connection (handshake_latency, to simulate the cost of a TLS handshake
+# with the real server) and to each request (latency).
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.count('connections')
+        if self.server.handshake_latency > 0:
+            time.sleep(self.server.handshake_latency)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.count('requests')
+        url = urllib.parse.urlsplit(self.path)
+        args = dict(urllib.parse.parse_qsl(url.query))
+
+        if url.path == '/oauth/authorization':
+            code = '{}-{}'.format(args.get('user', 'user0'), time.time())
+            location = '{}?{}'.format(args.get('redirect_uri', '/'), urllib.parse.urlencode({'code': code}))
+            self._respond(302, b'', [('Location', location)])
+        elif url.path == '/userinfo':
+            header = self.headers.get('Authorization', '')
+            token = header[len('Bearer '):] if header.startswith('Bearer ') else args.get('access_token', '')
+            if not token.startswith('token-'):
+                self._respond_json(401, {'error': 'invalid_token'})
+                return
+            user_id = token[len('token-'):]
+            self._respond_json(200, {'user': {'userid_sec': ['feide:{}@example.org'.format(user_id)],
+                                              'name': 'User {}'.format(user_id),
+                                              'email': '{}@example.org'.format(user_id)}})
+        else:
+            self._respond_json(404, {'error': 'not_found'})
+
+    def do_POST(self):
+        self.server.count('requests')
+        length = int(self.headers.get('Content-Length', 0))
+        form = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode('utf-8')))
+
+        if self.path == '/oauth/token':
+            code = form.get('code', '')
+            if '-' not in code or form.get('grant_type') != 'authorization_code':
+                self._respond_json(400, {'error': 'invalid_grant'})
+                return
+            self._respond_json(200, {'access_token': 'token-' + code.split('-')[0],
+                                     'token_type': 'Bearer',
+                                     'expires_in': 3600})
+        else:
+            self._respond_json(404, {'error': 'not_found'})
+
+    def _respond_json(self, status, data):
+        self._respond(status, json.dumps(data).encode('utf-8'), [('Content-Type', 'application/json')])
+
+    def _respond(self, status, body, headers):
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class OAuthServer(socketserver.ThreadingMixIn, HTTPServer):
+    """The stand-in server, listening on localhost:'port' (0 means any free port)"""
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0, handshake_latency=0):
+        super().__init__(('localhost', port), Handler)
+        self.latency = latency
+        self.handshake_latency = handshake_latency
+        self.stats = {'connections': 0, 'requests': 0}
+        self._lock = threading.Lock()
+
+    def count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def get_base_url(self):
+        return 'http://localhost:{}/'.format(self.server_port)
+
+    def start(self):
+        """Serve in a background thread"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Dataporten OAuth server')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to each request')
+    parser.add_argument('--handshake-latency', type=float, default=0,
+                        help='seconds added to each new connection')
+    args = parser.parse_args()
+
+    server = OAuthServer(args.port, args.latency, args.handshake_latency)
+    print('Set OAUTH_BASE_URL = {!r} in settings.py'.format(server.get_base_url()), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.stats), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+import argparse
+import collections
+import logging
+import os
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks import common
+
+# Load generator for the registration API. It simulates a registration storm
+# (e.g. after a mass reflash), where many probes run probe_init.sh at once:
+# each probe POSTs its keys to /register_key, and then polls /get_port until
+# it gets a port, the same way probe_init.sh does.
+#
+# By default a local server is started in this process (werkzeug's threaded
+# server, against a temporary database with the unregistered probes added).
+# To run it against another local server instead, give its address with
+# --url, and a file with the MACs of probes added through its web site
+# (one per line) with --mac-file.
+
+# Part of the MACs/keys, so the keys of different runs don't collide
+KEY_OFFSET = 10**7
+
+
+def make_keys(n):
+    """Return a (pub key, host key) pair for probe 'n', in the format
+    util.is_pub_ssh_key_valid and util.is_ssh_host_key_valid expect"""
+    from benchmarks import fleet
+    return fleet.make_pub_key(KEY_OFFSET + n), fleet.make_host_key(KEY_OFFSET + n)
+
+
+class Storm():
+    """Registrations of the probes with MACs 'macs' against the server at
+    'url', started at 'rate' probes per second"""
+    def __init__(self, url, macs, rate, concurrency, retries, poll_interval, timeout):
+        self.url = url.rstrip('/')
+        self.macs = macs
+        self.rate = rate
+        self.concurrency = concurrency
+        self.retries = retries
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        # endpoint -> list of durations
+        self.latencies = collections.defaultdict(list)
+        # endpoint -> response -> count
+        self.responses = collections.defaultdict(collections.Counter)
+        self.registered = 0
+        self.got_port = 0
+
+    def _request(self, endpoint, data=None, query=None):
+        """Do one request, record its latency and response, and return the
+        response (the body, or 'http-<status>' / 'error-<exception>')"""
+        url = self.url + '/' + endpoint
+        if query is not None:
+            url += '?' + urllib.parse.urlencode(query)
+        if data is not None:
+            data = urllib.parse.urlencode(data).encode('utf-8')
+
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(url, data=data, timeout=self.timeout) as response:
+                body = response.read().decode('utf-8').strip()
+        except urllib.error.HTTPError as e:
+            body = 'http-{}'.format(e.code)
+        except (urllib.error.URLError, OSError) as e:
+            body = 'error-{}'.format(type(getattr(e, 'reason', e)).__name__)
+        duration = time.perf_counter() - start
+
+        # Ports are counted as one kind of response
+        kind = 'port' if body.isdigit() else body
+        with self._lock:
+            self.latencies[endpoint].append(duration)
+            self.responses[endpoint][kind] += 1
+        return body
+
+    def _run_probe(self, n, mac):
+        """Do what probe_init.sh does for the probe with MAC 'mac'"""
+        pub_key, host_key = make_keys(n)
+        for attempt in range(self.retries + 1):
+            response = self._request('register_key', data={'mac': mac,
+                                                           'pub_key': pub_key,
+                                                           'host_key': host_key})
+            if response in ('success', 'already-registered'):
+                break
+            # The real script waits longer, but the point is the load
+            time.sleep(self.poll_interval)
+        else:
+            return
+
+        with self._lock:
+            self.registered += 1
+
+        for attempt in range(self.retries + 1):
+            if self._request('get_port', query={'mac': mac}).isdigit():
+                with self._lock:
+                    self.got_port += 1
+                return
+            time.sleep(self.poll_interval)
+
+    def run(self):
+        """Start all the probes (at the given rate), wait for them to finish,
+        and return the wall clock time"""
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for n, mac in enumerate(self.macs):
+                if self.rate > 0:
+                    # Keep to the schedule, even if the server is slow
+                    delay = start + n / self.rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                executor.submit(self._run_probe, n, mac)
+        return time.perf_counter() - start
+
+    def get_results(self, wall):
+        requests = sum(len(durations) for durations in self.latencies.values())
+        return {
+                'wall': wall,
+                'probes': len(self.macs),
+                'registered': self.registered,
+                'got_port': self.got_port,
+                'requests': requests,
+                'requests_per_second': requests / wall if wall > 0 else 0,
+                'registrations_per_second': self.registered / wall if wall > 0 else 0,
+                'latency': {endpoint: common.percentiles(durations)
+                            for endpoint, durations in self.latencies.items()},
+                'responses': {endpoint: dict(counts) for endpoint, counts in self.responses.items()}
+        }
+
+
+def start_local_server(probes, duplicates):
+    """Start the web site in a thread on a free local port, with 'probes'
+    unregistered probes (and 'duplicates' of them listed twice, as if their
+    probe_init.sh was restarted). Return (url, MACs, server, root)."""
+    root = common.configure()
+
+    # Must be imported after configure()
+    from werkzeug.serving import make_server
+    from benchmarks import fleet
+    from probe_website import app
+    import probe_website.views as views
+
+    database = views.database
+    database.init_database()
+    fleet.write_default_scripts(views.settings.ANSIBLE_PATH, 3)
+    username = fleet.generate_fleet(database, users=1, probes=0, unregistered=probes)[0]
+    macs = fleet.get_unregistered_macs(database, username)
+    database.shutdown_session()
+    macs += macs[:duplicates]
+
+    # Don't log every request
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('localhost', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return 'http://localhost:{}'.format(server.server_port), macs, server, root
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a registration storm (register_key '
+                                                 'and get_port) against a local server')
+    parser.add_argument('--probes', type=int, default=200, help='number of registering probes')
+    parser.add_argument('--rate', type=float, default=50, help='probes started per second (0: all at once)')
+    parser.add_argument('--concurrency', type=int, default=50, help='max probes registering at once')
+    parser.add_argument('--duplicates', type=int, default=0,
+                        help='probes that register twice (get already-registered)')
+    parser.add_argument('--retries', type=int, default=3, help='retries of failed requests')
+    parser.add_argument('--poll-interval', type=float, default=0.5, help='seconds between retries')
+    parser.add_argument('--timeout', type=float, default=30, help='request timeout in seconds')
+    parser.add_argument('--url', default=None, help='address of a running server (default: start one)')
+    parser.add_argument('--mac-file', default=None, help='MACs to register, with --url')
+    parser.add_argument('--output', default=None, help='JSON output file (default: stdout)')
+    parser.add_argument('--keep', action='store_true', help="don't remove the temporary database etc.")
+    args = parser.parse_args()
+
+    server = root = None
+    if args.url is not None:
+        if args.mac_file is None:
+            parser.error('--mac-file is needed with --url')
+        with open(args.mac_file) as f:
+            macs = [line.strip() for line in f if line.strip() != '']
+        url = args.url
+    else:
+        url, macs, server, root = start_local_server(args.probes, args.duplicates)
+
+    storm = Storm(url, macs, args.rate, args.concurrency, args.retries,
+                  args.poll_interval, args.timeout)
+    try:
+        wall = storm.run()
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    params = {'probes': len(macs), 'rate': args.rate, 'concurrency': args.concurrency,
+              'duplicates': args.duplicates, 'retries': args.retries,
+              'server': 'local' if server is not None else 'external', 'cpus': os.cpu_count()}
+    common.write_results('registration_storm', params, storm.get_results(wall), args.output)
+
+    if root is not None and not args.keep:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+import argparse
+import json
+import logging
+import random
+import resource
+import selectors
+import socket
+import sys
+import threading
+import time
+import paramiko
+
+# A simulated fleet of probes for end-to-end benchmarks. Each fake probe is a
+# small in-process SSH server (paramiko) listening on localhost:<port>, i.e.
+# where the probe's reverse SSH tunnel would be on the web server. They
+# answer connection_status.sh, reboot, and any other command (such as
+# Ansible raw tasks) with exit status 0.
+#
+# Faults can be injected:
+#   latency : seconds added before the SSH handshake and before each answer
+#   loss    : probability that a connection is dropped right after it's accepted
+#   dead    : fraction of the probes whose tunnel is 'stale', i.e. the port is
+#             open, but nothing ever answers (like a tunnel whose probe is gone)
+#   down    : fraction of the probes with no tunnel at all (nothing listening)
+#
+# All the fake probes use the same host key, which should be registered as
+# the probes' host key in the database.
+#
+# Run as a separate process (so it doesn't skew the measurements):
+#   python -m benchmarks.simulator --host-key <file> --ports 50000-50099
+# It prints one line of JSON with the listening, dead and down ports when
+# it's ready, and runs until stdin is closed.
+
+
+class FakeProbe(paramiko.ServerInterface):
+    """The SSH server side of one connection to a fake probe"""
+    def __init__(self, simulator, port):
+        self.simulator = simulator
+        self.port = port
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def get_allowed_auths(self, username):
+        return 'none,publickey'
+
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.simulator.answer,
+                                  args=(self.port, channel, command.decode('utf-8', 'replace')),
+                                  daemon=True)
+        thread.start()
+        return True
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+
+class Simulator():
+    """Fake probes listening on 'ports' (see the module comment for the
+    fault parameters)"""
+    def __init__(self, host_key, ports, latency=0, loss=0, dead=0, down=0, seed=None):
+        self.host_key = host_key
+        self.latency = latency
+        self.loss = loss
+        self.random = random.Random(seed)
+
+        ports = list(ports)
+        shuffled = ports[:]
+        self.random.shuffle(shuffled)
+        dead_count = int(round(len(ports) * dead))
+        down_count = int(round(len(ports) * down))
+        self.dead_ports = set(shuffled[:dead_count])
+        self.down_ports = set(shuffled[dead_count:dead_count + down_count])
+        self.ports = [port for port in ports if port not in self.down_ports]
+
+        self.connections = 0
+        self.commands = 0
+        self._selector = selectors.DefaultSelector()
+        self._sockets = []
+        self._stale = []
+        self._running = False
+
+    def start(self):
+        """Start listening on all ports (except the down ones)"""
+        for port in self.ports:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('localhost', port))
+            sock.listen(64)
+            sock.setblocking(False)
+            self._selector.register(sock, selectors.EVENT_READ, port)
+            self._sockets.append(sock)
+
+        self._running = True
+        self._thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        for sock in self._sockets + self._stale:
+            sock.close()
+        self._selector.close()
+
+    def _accept_loop(self):
+        while self._running:
+            for key, events in self._selector.select(timeout=0.2):
+                try:
+                    conn, addr = key.fileobj.accept()
+                except BlockingIOError:
+                    continue
+                conn.setblocking(True)
+                port = key.data
+                self.connections += 1
+
+                if port in self.dead_ports:
+                    # Keep it open without ever answering
+                    self._stale.append(conn)
+                elif self.loss > 0 and self.random.random() < self.loss:
+                    conn.close()
+                else:
+                    thread = threading.Thread(target=self._serve, args=(conn, port), daemon=True)
+                    thread.start()
+
+    def _serve(self, conn, port):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(self.host_key)
+        try:
+            transport.start_server(server=FakeProbe(self, port))
+        except (paramiko.SSHException, EOFError, OSError):
+            transport.close()
+
+    def answer(self, port, channel, command):
+        """Answer 'command' from the SSH client on 'channel'"""
+        self.commands += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        output = ''
+        if 'connection_status.sh' in command:
+            # Every other probe is on wifi only
+            output = json.dumps({'eth0': port % 2, 'wlan0': 1}) + '\n'
+        elif 'echo ~' in command:
+            output = '/root\n'
+
+        try:
+            channel.sendall(output.encode('utf-8'))
+            channel.send_exit_status(0)
+            channel.close()
+        except (EOFError, OSError, paramiko.SSHException):
+            pass
+
+
+def parse_ports(ports):
+    """Parse a port range ('50000-50099') or comma separated list of ports"""
+    if '-' in ports:
+        first, last = ports.split('-')
+        return list(range(int(first), int(last) + 1))
+    return [int(port) for port in ports.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a fleet of probes with SSH tunnels on localhost')
+    parser.add_argument('--host-key', required=True, help='RSA host key (private key file)')
+    parser.add_argument('--ports', required=True, help='port range (50000-50099) or list of ports')
+    parser.add_argument('--latency', type=float, default=0, help='seconds of added latency')
+    parser.add_argument('--loss', type=float, default=0, help='probability of dropped connections')
+    parser.add_argument('--dead', type=float, default=0, help='fraction of probes with stale tunnels')
+    parser.add_argument('--down', type=float, default=0, help='fraction of probes without tunnels')
+    parser.add_argument('--seed', type=int, default=None, help='random seed')
+    args = parser.parse_args()
+
+    # Connections that are closed right away (e.g. by nc -z) are logged as errors
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+
+    # Every listening port and connection is a file descriptor
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    host_key = paramiko.RSAKey.from_private_key_file(args.host_key)
+    simulator = Simulator(host_key, parse_ports(args.ports), args.latency, args.loss,
+                          args.dead, args.down, args.seed)
+    simulator.start()
+    print(json.dumps({'ports': simulator.ports,
+                      'dead': sorted(simulator.dead_ports),
+                      'down': sorted(simulator.down_ports)}), flush=True)
+
+    # Run until the parent closes stdin
+    sys.stdin.read()
+    simulator.stop()
+    print(json.dumps({'connections': simulator.connections, 'commands': simulator.commands}), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,8 +21,10 @@ CREATE TABLE "network_configs" (
 "anonymous_id" TEXT,
 "username" TEXT,
 "password" TEXT,
+"version" INTEGER DEFAULT '0',
 "probe_id" INTEGER REFERENCES "probes"("id")
 );
+CREATE INDEX "ix_network_configs_version" ON "network_configs" ("version");
 
 
 CREATE TABLE "probes" (
@@ -37,19 +39,24 @@ CREATE TABLE "probes" (
 "associated" INTEGER,
 "has_been_updated" INTEGER,
 "last_updated" TEXT,
+"version" INTEGER DEFAULT '0',
 "user_id" INTEGER REFERENCES "users"("id")
 );
+CREATE INDEX "ix_probes_version" ON "probes" ("version");
 
 
 CREATE TABLE "scripts" (
 "id" INTEGER PRIMARY KEY AUTOINCREMENT,
 "description" TEXT,
+"filename" TEXT,
 "args" TEXT,
 "minute_interval" INTEGER,
 "enabled" INTEGER,
 "required" INTEGER,
+"version" INTEGER DEFAULT '0',
 "probe_id" INTEGER REFERENCES "probes"("id")
 );
+CREATE INDEX "ix_scripts_version" ON "scripts" ("version");
 
 
 CREATE TABLE "users" (
@@ -61,4 +68,71 @@ CREATE TABLE "users" (
 "admin" INTEGER,
 "oauth_id" TEXT
 );
+CREATE INDEX "ix_users_username" ON "users" ("username");
+CREATE INDEX "ix_users_oauth_id" ON "users" ("oauth_id");
 
+
+CREATE TABLE "ansible_runs" (
+"id" INTEGER PRIMARY KEY AUTOINCREMENT,
+"started" TEXT,
+"finished" TEXT,
+"exit_status" INTEGER,
+"version" INTEGER DEFAULT '0',
+"user_id" INTEGER REFERENCES "users"("id")
+);
+CREATE INDEX "ix_ansible_runs_version" ON "ansible_runs" ("version");
+CREATE INDEX "ix_ansible_runs_user_id" ON "ansible_runs" ("user_id");
+
+
+CREATE TABLE "ansible_run_hosts" (
+"id" INTEGER PRIMARY KEY AUTOINCREMENT,
+"probe_custom_id" TEXT,
+"ok" INTEGER,
+"changed" INTEGER,
+"unreachable" INTEGER,
+"failed" INTEGER,
+"duration" REAL,
+"run_id" INTEGER REFERENCES "ansible_runs"("id")
+);
+CREATE INDEX "ix_ansible_run_hosts_probe_run" ON "ansible_run_hosts" ("probe_custom_id", "run_id");
+
+
+CREATE TABLE "probe_heartbeats" (
+"id" INTEGER PRIMARY KEY AUTOINCREMENT,
+"timestamp" INTEGER,
+"received" INTEGER,
+"eth0" INTEGER,
+"wlan0" INTEGER,
+"uptime" INTEGER,
+"load" REAL,
+"probe_id" INTEGER UNIQUE REFERENCES "probes"("id")
+);
+
+
+CREATE TABLE "version_counter" (
+"id" INTEGER PRIMARY KEY AUTOINCREMENT,
+"version" INTEGER
+);
+
+
+CREATE TABLE "deleted_rows" (
+"id" INTEGER PRIMARY KEY AUTOINCREMENT,
+"table_name" TEXT,
+"row_id" INTEGER,
+"user_id" INTEGER,
+"version" INTEGER
+);
+CREATE INDEX "ix_deleted_rows_user_id" ON "deleted_rows" ("user_id");
+CREATE INDEX "ix_deleted_rows_version" ON "deleted_rows" ("version");
+
+
+CREATE TABLE "api_tokens" (
+"id" INTEGER PRIMARY KEY AUTOINCREMENT,
+"name" TEXT,
+"token_hash" TEXT,
+"scopes" TEXT,
+"created" DATETIME,
+"user_id" INTEGER REFERENCES "users"("id")
+);
+CREATE UNIQUE INDEX "ix_api_tokens_token_hash" ON "api_tokens" ("token_hash");
+CREATE INDEX "ix_api_tokens_user_id" ON "api_tokens" ("user_id");
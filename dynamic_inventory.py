@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+from sys import argv
+import os
+import json
+import time
+import hashlib
+
+# Only the database is needed, not the rest of the web application
+os.environ['PROBE_WEBSITE_NO_VIEWS'] = '1'
+from probe_website import settings, inventory
+from probe_website.database import DatabaseManager
+
+# Ansible dynamic inventory script, which reads the probes (and all their
+# configs) of a user directly from the database specified in settings.py.
+# This makes it unnecessary to export host_vars files before each push.
+
+# The script is configured with environment variables (set by the
+# web application when it runs ansible-playbook):
+#   PROBE_INVENTORY_USER    : the user whose probes should be listed
+#   PROBE_INVENTORY_HOSTS   : comma separated MACs of the probes to include
+#                             (optional, all the user's probes by default)
+#   PROBE_INVENTORY_REFRESH : if set, ignore any cached result
+
+# The result is cached for this many seconds. The web application refreshes
+# it at the start of each push, and the later batches of a staged rollout
+# (one ansible-playbook invocation each) use the cached result.
+CACHE_TTL = 60
+
+
+database = DatabaseManager(settings.DATABASE_URL)
+
+
+def get_cache_path(username, probe_ids):
+    """Return the path of the cached inventory for 'username' and 'probe_ids'"""
+    name = username
+    if probe_ids is not None:
+        name += '-' + hashlib.sha1(','.join(sorted(probe_ids)).encode('utf-8')).hexdigest()
+    return os.path.join(settings.ANSIBLE_PATH, 'inventory', 'cache', name + '.json')
+
+
+def get_inventory(username, probe_ids, refresh=False):
+    """Return the inventory as a JSON string, from the cache if possible"""
+    path = get_cache_path(username, probe_ids)
+    if (not refresh and
+            os.path.isfile(path) and
+            time.time() - os.path.getmtime(path) < CACHE_TTL):
+        with open(path, 'r') as f:
+            return f.read()
+
+    data = json.dumps(inventory.build_inventory(database, username, probe_ids))
+    database.shutdown_session()
+
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    # Write to a temporary file first, so a concurrent reader never sees a partial file
+    with open(path + '.tmp', 'w') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+    return data
+
+
+if __name__ == '__main__':
+    username = os.environ.get('PROBE_INVENTORY_USER', '')
+    hosts = os.environ.get('PROBE_INVENTORY_HOSTS', '')
+    probe_ids = hosts.split(',') if hosts != '' else None
+    refresh = os.environ.get('PROBE_INVENTORY_REFRESH', '') != ''
+
+    if len(argv) == 3 and argv[1] == '--host':
+        # All host variables are included in _meta of --list
+        print('{}')
+    elif len(argv) == 2 and argv[1] == '--list' and username != '':
+        print(get_inventory(username, probe_ids, refresh))
+    else:
+        print('Usage: PROBE_INVENTORY_USER=<username> {} --list | --host <host>'.format(argv[0]))
+        exit(1)
@@ -0,0 +1,74 @@
+#!/bin/bash
+
+# Fetch this probe's config bundle from the server (pull mode), and apply it
+# if it has changed. Meant to be run periodically (e.g. from a systemd timer).
+#
+# The config token is delivered to the probe as the probe_config_token
+# Ansible variable, and should be stored in /root/init/config_token.
+# The bundle is only applied if its HMAC-SHA256 signature is valid.
+# Applying it is left to /root/apply_config.sh, which gets the path of the
+# bundle (JSON) as its only argument.
+
+USAGE="${0} <web server address> <probe MAC>"
+
+if [[ $# != 2 ]]; then
+    echo "${USAGE}"
+    exit 1
+fi
+
+SERVER_ADDRESS="${1}"
+MAC="${2}"
+
+TOKEN_FILE="/root/init/config_token"
+BUNDLE_FILE="/root/probe_config.json"
+ETAG_FILE="/root/probe_config.etag"
+
+function log_error {
+    echo "[!] ${0}: ${1}"
+    logger "[!] ${0}: ${1}"
+}
+
+if [[ ! -f "${TOKEN_FILE}" ]]; then
+    log_error "No config token (${TOKEN_FILE})"
+    exit 1
+fi
+token=$(<"${TOKEN_FILE}")
+
+etag=""
+if [[ -f "${ETAG_FILE}" && -f "${BUNDLE_FILE}" ]]; then
+    etag=$(<"${ETAG_FILE}")
+fi
+
+tmp_dir=$(mktemp -d)
+trap 'rm -rf "${tmp_dir}"' EXIT
+
+status=$(curl -s -o "${tmp_dir}/bundle" -D "${tmp_dir}/headers" -w '%{http_code}' \
+    -H "Authorization: Bearer ${token}" \
+    -H "If-None-Match: \"${etag}\"" \
+    "https://${SERVER_ADDRESS}/probe_config/${MAC}")
+
+if [[ "${status}" == "304" ]]; then
+    # Nothing has changed
+    exit 0
+elif [[ "${status}" != "200" ]]; then
+    log_error "Unable to fetch config: ${status} $(cat "${tmp_dir}/bundle")"
+    exit 1
+fi
+
+signature=$(grep -i '^X-Config-Signature:' "${tmp_dir}/headers" | awk '{ print $2 }' | tr -d '\r')
+expected=$(openssl dgst -sha256 -hmac "${token}" "${tmp_dir}/bundle" | awk '{ print $NF }')
+if [[ "${signature}" == "" || "${signature}" != "${expected}" ]]; then
+    log_error "Invalid config signature"
+    exit 1
+fi
+
+new_etag=$(grep -i '^ETag:' "${tmp_dir}/headers" | awk '{ print $2 }' | tr -d '\r"')
+
+mv "${tmp_dir}/bundle" "${BUNDLE_FILE}"
+if [[ -x /root/apply_config.sh ]]; then
+    if ! /root/apply_config.sh "${BUNDLE_FILE}"; then
+        log_error "Unable to apply config"
+        exit 1
+    fi
+fi
+echo -n "${new_etag}" > "${ETAG_FILE}"
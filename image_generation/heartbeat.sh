@@ -0,0 +1,48 @@
+#!/bin/bash
+
+# Send a heartbeat with the probe's connection status, uptime and load to the
+# server. Meant to be run every minute (e.g. from cron or a systemd timer).
+#
+# The heartbeat is signed with the probe's SSH key (the same key that was
+# registered through /register_key), so the server can authenticate it.
+
+USAGE="${0} <web server address> <probe MAC>"
+
+if [[ $# != 2 ]]; then
+    echo "${USAGE}"
+    exit 1
+fi
+
+SERVER_ADDRESS="${1}"
+MAC="${2}"
+
+KEY_FILE="/root/.ssh/id_rsa"
+
+function log_error {
+    echo "[!] ${0}: ${1}"
+    logger "[!] ${0}: ${1}"
+}
+
+timestamp=$(date +%s)
+eth0=$([[ $(ifconfig eth0 | awk '/inet /{print $2}') == "" ]] && echo 0 || echo 1)
+wlan0=$([[ $(ifconfig wlan0 | awk '/inet /{print $2}') == "" ]] && echo 0 || echo 1)
+uptime=$(awk '{ printf "%d", $1 }' /proc/uptime)
+load=$(awk '{ print $1 }' /proc/loadavg)
+
+signature=$(printf '%s' "${MAC}|${timestamp}|${eth0}|${wlan0}|${uptime}|${load}" |
+    openssl dgst -sha256 -sign "${KEY_FILE}" | base64 -w 0)
+
+response=$(curl -s \
+    --data-urlencode "mac=${MAC}" \
+    --data-urlencode "timestamp=${timestamp}" \
+    --data-urlencode "eth0=${eth0}" \
+    --data-urlencode "wlan0=${wlan0}" \
+    --data-urlencode "uptime=${uptime}" \
+    --data-urlencode "load=${load}" \
+    --data-urlencode "signature=${signature}" \
+    "https://${SERVER_ADDRESS}/heartbeat")
+
+if [[ "${response}" != "success" ]]; then
+    log_error "Heartbeat failed: ${response}"
+    exit 1
+fi
@@ -1,4 +1,7 @@
 from flask import Flask
+from jinja2 import FileSystemBytecodeCache
+import os.path
+from os import makedirs
 from probe_website import settings
 from probe_website import secret_settings
 
@@ -16,4 +19,18 @@ app.secret_key = secret_settings.SECRET_KEY
 app.config['UPLOAD_FOLDER'] = settings.CERTIFICATE_DIR
 app.config['MAX_CONTENT_LENGTH'] = 64 * 1024  # 64 KiB
 
-import probe_website.views
+# Compiled templates are cached on disk, so new processes don't have to
+# compile them again (they can be precompiled with 'flask compile-templates')
+TEMPLATE_CACHE_DIR = getattr(settings, 'TEMPLATE_CACHE_DIR',
+                             os.path.join(settings.ROOT_DIR, 'template_cache'))
+if TEMPLATE_CACHE_DIR is not None:
+    if not os.path.exists(TEMPLATE_CACHE_DIR):
+        makedirs(TEMPLATE_CACHE_DIR)
+    app.jinja_options = dict(app.jinja_options,
+                             bytecode_cache=FileSystemBytecodeCache(TEMPLATE_CACHE_DIR))
+
+# Scripts that only use the database (e.g. dynamic_inventory.py, which
+# Ansible runs for every push) set this, so the views aren't loaded
+if os.environ.get('PROBE_WEBSITE_NO_VIEWS', '') == '':
+    import probe_website.views
+    import probe_website.cli
@@ -1,12 +1,18 @@
-from probe_website import settings, util, app
+from probe_website import settings, util, app, status_cache
+from probe_website.supervisor import ProcessSupervisor, ChildResult
 import yaml
 import os.path
 from os import makedirs
 import shutil
-from subprocess import Popen
+import stat
 import re
+import gzip
+import math
+import threading
+import configparser
+import hashlib
+import tempfile
 from flask import flash
-import time
 
 
 def load_default_config(username, config_name):
@@ -42,40 +48,63 @@ def export_host_config(probe_id, data, filename):
 
 
 # Make a hosts file for this user at <ansible_root>/inventories/username/hosts
-def export_to_inventory(username, database, selected_probes=None):
+def export_to_inventory(username, probes):
     """Export an Ansible hosts file for 'username' at
-    <ansible_root>/inventory/<username> from the supplied SQL database
+    <ansible_root>/inventory/<username> containing 'probes'
 
     Each inventory entry will be in the following format:
     [<username>]
     <mac> ansible_host=localhost ansible_port=<port> probe_name=<name>
     ...
 
-    selected_probes=None means select all valid probes
+    The probes should be the eligible probes of a pre-flight report (see
+    the preflight module), as no checks are done here.
     """
-    from probe_website.database import Probe
-
     dir_path = os.path.join(settings.ANSIBLE_PATH, 'inventory')
     if not os.path.exists(dir_path):
         makedirs(dir_path)
 
-    user = database.get_user(username)
     with open(os.path.join(dir_path, username), 'wb') as f:
         f.write('[{}]\n'.format(username).encode('utf-8'))
-        for probe in database.session.query(Probe).filter(Probe.user_id == user.id).all():
-            if selected_probes and probe.custom_id not in selected_probes:
-                continue
-            if (probe.associated and
-                    util.is_probe_connected(probe.port) and
-                    database.valid_network_configs(probe) and
-                    database.valid_database_configs(user)):
-                entry = '{} ansible_host=localhost ansible_port={} username="{}" probe_name="{}"'.format(
-                            probe.custom_id,
-                            probe.port,
-                            username,
-                            probe.name)
-                f.write(entry.encode('utf-8'))
-                f.write('\n'.encode('utf-8'))
+        for probe in probes:
+            f.write(_inventory_entry(username, probe).encode('utf-8'))
+            f.write('\n'.encode('utf-8'))
+
+
+def ensure_inventory_entry(username, probe):
+    """Make sure 'probe' has an up to date entry in 'username's inventory
+    file, so a single probe can be updated with --limit without exporting
+    the whole inventory.
+
+    The file is only rewritten if the entry is missing or outdated.
+    """
+    dir_path = os.path.join(settings.ANSIBLE_PATH, 'inventory')
+    path = os.path.join(dir_path, username)
+    entry = _inventory_entry(username, probe)
+
+    lines = ['[{}]'.format(username)]
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            lines = f.read().decode('utf-8').splitlines()
+        if entry in lines:
+            return
+
+    if not os.path.exists(dir_path):
+        makedirs(dir_path)
+
+    lines = [line for line in lines if not line.startswith(probe.custom_id + ' ')]
+    lines.append(entry)
+    with open(path, 'wb') as f:
+        f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+def _inventory_entry(username, probe):
+    """Return the inventory line for 'probe'"""
+    return '{} ansible_host=localhost ansible_port={} username="{}" probe_name="{}"'.format(
+                probe.custom_id,
+                probe.port,
+                username,
+                probe.name)
 
 
 def export_known_hosts(database):
@@ -96,6 +125,55 @@ def export_known_hosts(database):
                 f.write(key + '\n')
 
 
+def ensure_known_host(probe):
+    """Make sure 'probe's host key is in the known_hosts file, without
+    exporting the keys of all probes"""
+    if probe.host_key == '':
+        return
+
+    path = os.path.join(settings.ANSIBLE_PATH, 'known_hosts')
+    key = probe.host_key.replace('localhost', '[localhost]:{}'.format(probe.port))
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            if key in f.read().splitlines():
+                return
+
+    with open(path, 'a') as f:
+        f.write(key + '\n')
+
+
+def export_probe_configs(probe, organization, database, network_configs=True):
+    """Export the Ansible host configs (script configs, probe info and
+    optionally network configs) of 'probe'
+
+    Nothing is exported when the dynamic inventory is used, because Ansible
+    will then read the configs directly from the database. Configs exported
+    before the dynamic inventory was turned on are removed, as Ansible would
+    let them override the configs from the database.
+    """
+    if USE_DYNAMIC_INVENTORY:
+        remove_host_config(probe.custom_id)
+        return
+
+    data = util.strip_id(database.get_script_data(probe))
+    export_host_config(probe.custom_id,
+                       {'host_script_configs': data},
+                       'script_configs')
+    export_host_config(probe.custom_id,
+                       {'probe_name': probe.name,
+                        'probe_location': probe.location,
+                        'probe_mac': probe.custom_id,
+                        'probe_organization': organization,
+                        'probe_config_token': util.get_probe_config_key(probe.custom_id)},
+                       'probe_info')
+
+    if network_configs:
+        data = util.strip_id(database.get_network_config_data(probe))
+        export_host_config(probe.custom_id,
+                           {'networks': data},
+                           'network_configs')
+
+
 def remove_host_config(probe_id):
     """Remove all Ansible configs associated with 'probe_id'"""
     probe_id = util.convert_mac(probe_id, mode='storage')
@@ -168,14 +246,46 @@ def get_certificate_data(username, probe_id):
     return data
 
 
-# Using this as a global var is not very nice. Maybe find a better solution.
-_ansible_pid = {}
+# Owns the Ansible processes (one per user)
+supervisor = ProcessSupervisor()
+
+# Number of compressed logs to keep for each user (in addition to the current one)
+LOG_ROTATE_COUNT = 10
 
+# If true, Ansible reads the inventory and host variables directly from the
+# database through dynamic_inventory.py, and no host_vars files are exported
+USE_DYNAMIC_INVENTORY = getattr(settings, 'USE_DYNAMIC_INVENTORY', False)
 
-def run_ansible_playbook(username):
+# Tuning of the generated ansible.cfg (see export_ansible_config)
+FORKS_PER_CPU = 10  # The forks mostly wait for the network, not the CPU
+MAX_FORKS = 50
+CONTROL_PERSIST = 5*60  # In seconds
+FACT_CACHE_TTL = 24*60*60  # In seconds
+# Private directory of the SSH control sockets (one subdirectory per user).
+# Unix socket paths are limited to 108 bytes, and SSH adds a 40 character
+# hash and a 17 character temporary suffix to the path of the directory.
+CONTROL_PATH_ROOT = getattr(settings, 'CONTROL_PATH_ROOT', os.path.join(settings.ROOT_DIR, 'cp'))
+MAX_CONTROL_PATH_DIR_LENGTH = 108 - 1 - 40 - 17 - 1
+
+# Limits for each Ansible run
+ANSIBLE_TIMEOUT = 30*60  # Wall-clock time, in seconds
+ANSIBLE_CPU_LIMIT = 20*60  # CPU time of each process, in seconds
+ANSIBLE_MEMORY_LIMIT = 2*1024**3  # Address space of each process, in bytes
+
+
+def run_ansible_playbook(username, database, limit=None, rollout=None):
     """Start an Ansible instance as subprocess with 'username's configs
 
-    Pipe all output from the Ansible process to a separate logfile
+    Pipe all output from the Ansible process to a separate logfile, and
+    register the run in the database so its results can be recorded when
+    it finishes.
+
+    If 'limit' is a list of probe ids, only those probes of the inventory
+    will be updated (using ansible-playbook's --limit).
+
+    If 'rollout' is a dictionary with the keys canary_size, batch_size and
+    max_failure_rate, the probes will be updated in batches instead of all
+    at once (see make_batches and the Rollout class).
     """
     inventory = os.path.join(settings.ANSIBLE_PATH, 'inventory', username)
     command = ['ansible-playbook',
@@ -184,51 +294,187 @@ def run_ansible_playbook(username):
                '--vault-password-file', os.path.join(settings.ANSIBLE_PATH, 'vault_pass.txt'),
                "--ssh-common-args='-o UserKnownHostsFile={}/known_hosts'".format(settings.ANSIBLE_PATH)]
 
-    with open(inventory, 'rb') as f:
-        # Do not run Ansible if the inventory file is empty
-        # (the first line will be the username)
-        if len(f.readlines()) <= 1:
-            return
+    # Do not run Ansible if the inventory file is empty
+    # (the first line will be the username)
+    hosts = _read_inventory_hosts(username)
+    if limit is not None:
+        hosts = [host for host in hosts if host in limit]
+    if len(hosts) == 0:
+        return
+
+    env = dict(os.environ, ANSIBLE_CONFIG=export_ansible_config(username, len(hosts)))
+    if USE_DYNAMIC_INVENTORY:
+        # The inventory file is still used for keeping track of the hosts
+        # to update, but Ansible gets them (and their variables) from the database.
+        # The first ansible-playbook invocation of the run refreshes the cached
+        # inventory, which the later batches of a rollout then use.
+        command[command.index('-i') + 1] = os.path.join(settings.ROOT_DIR, 'dynamic_inventory.py')
+        env.update(PROBE_INVENTORY_USER=username,
+                   PROBE_INVENTORY_HOSTS=','.join(hosts),
+                   PROBE_INVENTORY_REFRESH='1')
+
+    if is_ansible_running(username):
+        return
+
+    # Make sure the previous run is recorded before its log is rotated away
+    _update_ansible_run(username, database)
 
     dir_path = os.path.join(settings.ANSIBLE_PATH, 'logs')
     if not os.path.exists(dir_path):
         makedirs(dir_path)
-    log_file = open(os.path.join(dir_path, username), 'w')
-    log_file.write(' ')  # Be sure to clear the file
+    _rotate_log(dir_path, username)
+    log_path = os.path.join(dir_path, username)
 
     # This will run in parallel with the web application. stdout will
-    # be logged to the log_file, so to check the status of the command,
-    # just check that file (if the 'PLAY RECAP' string is in the log,
-    # the command has been completed)
-    if not is_ansible_running(username):
-        ps = Popen(command, stdout=log_file)
-        global ansible_pid
-        _ansible_pid[username] = ps.pid
+    # be logged to the log file, and the results are parsed from it once
+    # the process has exited (see get_playbook_status)
+    if rollout is not None:
+        batches = make_batches(hosts, rollout['canary_size'], rollout['batch_size'])
+        _rollouts[username] = Rollout(username, command, env, batches, rollout['max_failure_rate'], log_path)
+        _rollouts[username].start()
+    else:
+        _rollouts.pop(username, None)
+        if limit is not None:
+            command += ['--limit', ','.join(hosts)]
+        with open(log_path, 'w') as log_file:
+            _start_playbook(username, command, log_file, env)
+
+    database.add_ansible_run(username, hosts)
+    database.save_changes()
+    status_cache.invalidate_user(username)
+
+
+def export_ansible_config(username, host_count):
+    """Export an ansible.cfg for 'username's next Ansible run at
+    <ansible_root>/run/<username>/ansible.cfg, and return its path.
+
+    The config is tuned for pushing to many probes through the slow reverse
+    SSH tunnels: the number of forks depends on the number of hosts and CPUs,
+    SSH connections are reused (pipelining and ControlPersist) and facts are
+    cached between runs. Any ansible.cfg in the Ansible root is used as
+    a base, so its other settings still apply.
+    """
+    dir_path = os.path.join(settings.ANSIBLE_PATH, 'run', username)
+    if not os.path.exists(dir_path):
+        makedirs(dir_path)
 
-    log_file.close()
+    control_path_dir = _get_control_path_dir(username)
+
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(os.path.join(settings.ANSIBLE_PATH, 'ansible.cfg'))
+    for section in ['defaults', 'ssh_connection']:
+        if not config.has_section(section):
+            config.add_section(section)
+
+    forks = max(1, min(host_count, (os.cpu_count() or 1) * FORKS_PER_CPU, MAX_FORKS))
+    config['defaults'].update({
+            'forks': str(forks),
+            'gathering': 'smart',
+            'fact_caching': 'jsonfile',
+            'fact_caching_connection': os.path.join(settings.ANSIBLE_PATH, 'facts'),
+            'fact_caching_timeout': str(FACT_CACHE_TTL),
+            'retry_files_enabled': 'False'
+    })
+    config['ssh_connection']['pipelining'] = 'True'
+    if control_path_dir is not None:
+        config['ssh_connection'].update({
+                'ssh_args': '-o ControlMaster=auto -o ControlPersist={}s'.format(CONTROL_PERSIST),
+                'control_path_dir': control_path_dir,
+                # %C is a hash of the connection, which keeps the socket path short
+                'control_path': '%(directory)s/%%C'
+        })
+
+    path = os.path.join(dir_path, 'ansible.cfg')
+    with open(path, 'w') as f:
+        config.write(f)
+    return path
+
+
+# Used if CONTROL_PATH_ROOT is too long for socket paths (see _get_control_path_dir)
+_temporary_control_path_root = None
 
-    # Change ansible status immediately
-    get_playbook_status(username, probe=None, force_fileread=True)
+
+def _get_control_path_dir(username):
+    """Return the directory of 'username's SSH control sockets, or None if
+    there is no safe directory for them (SSH connections are then not reused).
+
+    Anyone who can write to the directory could take over the SSH connections
+    to the probes, so it must be owned by us and not accessible by others.
+    If CONTROL_PATH_ROOT is too long, a private temporary directory is used.
+    """
+    global _temporary_control_path_root
+
+    user_hash = hashlib.sha1(username.encode('utf-8')).hexdigest()[:8]
+    root = CONTROL_PATH_ROOT
+    if len(os.path.join(root, user_hash)) > MAX_CONTROL_PATH_DIR_LENGTH:
+        if _temporary_control_path_root is None:
+            # mkdtemp makes a new directory with an unpredictable name and mode 0700
+            _temporary_control_path_root = tempfile.mkdtemp(prefix='probe-cp-')
+        root = _temporary_control_path_root
+
+    path = os.path.join(root, user_hash)
+    try:
+        for dir_path in [root, path]:
+            if not os.path.lexists(dir_path):
+                os.mkdir(dir_path, mode=0o700)
+            if not _is_private_dir(dir_path):
+                print('Not reusing SSH connections: {} is not a private directory'.format(dir_path))
+                return None
+    except OSError as e:
+        print('Not reusing SSH connections: {}'.format(e))
+        return None
+    return path
+
+
+def _is_private_dir(path):
+    """Return true if 'path' is a directory (not a symlink) owned by this
+    process' user, and only accessible by that user"""
+    info = os.lstat(path)
+    return (stat.S_ISDIR(info.st_mode) and
+            info.st_uid == os.getuid() and
+            info.st_mode & 0o077 == 0)
+
+
+def _start_playbook(username, command, log_file, env=None):
+    """Start 'command' through the supervisor, with the configured limits"""
+    return supervisor.start(username, command, log_file,
+                            timeout=ANSIBLE_TIMEOUT,
+                            memory_limit=ANSIBLE_MEMORY_LIMIT,
+                            cpu_limit=ANSIBLE_CPU_LIMIT,
+                            env=env)
 
 
 def is_ansible_running(username):
-    if username in _ansible_pid:
-        return os.path.exists('/proc/{}'.format(_ansible_pid[username]))
-    return False
+    """Return true if an Ansible process (or rollout) started by 'username'
+    is still running"""
+    if username in _rollouts and _rollouts[username].is_alive():
+        return True
+    return supervisor.is_running(username)
 
-_playbook_status = None
 
+def cancel_ansible_playbook(username):
+    """Ask 'username's running Ansible process (or rollout) to stop. Return
+    false if Ansible wasn't running.
+
+    This doesn't wait for the process to exit: the supervisor kills it if it
+    doesn't exit in time, and the run is recorded as finished by
+    get_playbook_status once it has exited.
+    """
+    if username in _rollouts and _rollouts[username].is_alive():
+        _rollouts[username].cancel()
+    elif not supervisor.cancel(username):
+        return False
+
+    status_cache.invalidate_user(username)
+    return True
 
-def get_playbook_status(username, probe=None, force_fileread=False):
-    """Return whether ansible is running or not, and optionally the results
-    of the last Ansible run. This is the "front-end" function to
-    _read_playbook_status()
 
-    This function should be used instead of _read_playbook_status, because
-    this function does not read the log file as each call, but rather only
-    if a set time has passed since last time the log was read.
+def get_playbook_status(username, database, probe=None):
+    """Return whether ansible is running or not, or the result of the last
+    Ansible run that included 'probe'.
 
-    If force_fileread is True, the file reading timer will be ignored.
+    The results of a run are stored in the database when the run has finished,
+    so apart from that one time, this is just a lookup in the database.
 
     If only username is supplied, return one of:
         running             : ansible is running
@@ -236,91 +482,299 @@ def get_playbook_status(username, probe=None, force_fileread=False):
 
     If probe is supplied too, return the status for that specific probe, which
     will be one of the  following:
+        queued              : probe is waiting for its batch in a staged rollout
         updating            : probe is currently updating
         completed           : probe completed successfully in the last update
         failed              : probe failed in the last update
-        unknown             : the log file could not be read
+        unknown             : the probe has no recorded update results
     """
-
-    global _playbook_status
-
-    update_interval = 30
-    if (not force_fileread and
-            _playbook_status is not None and
-            'timestamp' in _playbook_status and
-            time.time() - _playbook_status['timestamp'] < update_interval):
-        pass
-    else:
-        _playbook_status = _read_playbook_status(username)
-        if _playbook_status is None:
-            return 'unknown'
+    if _has_result(username):
+        _update_ansible_run(username, database)
 
     # If no probe is specified, return the status of Ansible itself (running or not-running)
-    ansible_running = is_ansible_running(username)
     if probe is None:
-        return 'running' if ansible_running else 'not-running'
+        return 'running' if is_ansible_running(username) else 'not-running'
+
+    run_host = database.get_last_ansible_run_host(probe.custom_id)
+    if run_host is None:
+        return 'unknown'
+
+    if not run_host.run.is_finished():
+        # The run may have been started by another process, in which case
+        # the log file is the only way to know if it has finished
+        _update_ansible_run(username, database, run_host.run)
+        if not run_host.run.is_finished():
+            rollout = _rollouts.get(username)
+            if rollout is not None and rollout.is_queued(probe.custom_id):
+                return 'queued'
+            return 'updating'
+
+    if not run_host.has_result():
+        # E.g. if the run timed out or was cancelled before the probe was done
+        if run_host.run.exit_status not in [0, None]:
+            return 'failed'
+        return 'unknown'
+
+    return 'completed' if run_host.succeeded() else 'failed'
+
+
+def get_rollout_status(username):
+    """Return a dictionary describing the progress of 'username's last
+    staged rollout (see Rollout.get_status), or None if there is none"""
+    if username not in _rollouts:
+        return None
+    return _rollouts[username].get_status()
+
+
+def make_batches(hosts, canary_size, batch_size):
+    """Split 'hosts' into batches for a staged rollout: a canary batch with
+    'canary_size' hosts, followed by batches of 'batch_size' hosts.
+
+    batch_size is either a number of hosts, or a percentage of all the hosts
+    as a string like '25%'.
+    """
+    if type(batch_size) is str and batch_size.endswith('%'):
+        batch_size = math.ceil(len(hosts) * float(batch_size[:-1]) / 100)
+    canary_size = max(1, int(canary_size))
+    batch_size = max(1, int(batch_size))
 
-    # If the probe was updated last time Ansible was run, return completed or failed
-    if probe.custom_id in _playbook_status:
-        return _playbook_status[probe.custom_id]
+    batches = [hosts[:canary_size]]
+    for i in range(canary_size, len(hosts), batch_size):
+        batches.append(hosts[i:i + batch_size])
+    return [batch for batch in batches if len(batch) > 0]
 
-    return 'unknown'
 
+# Staged rollouts, by username. Finished rollouts are kept so their
+# progress can still be shown.
+_rollouts = {}
 
-def _read_playbook_status(username):
-    """Do not run ths function directly; use get_playbook_status instead.
 
-    Read the log generated by the ansible-playbook command and parse its content.
+class Rollout(threading.Thread):
+    """Update the probes of a user in batches, one ansible-playbook run
+    (limited to the probes of the batch) at a time.
 
-    run_ansible_playbook), and return:
-      * Not started (no log file or empty):        None
-      * Unfinished (No 'PLAY RECAP' in log file):  'running'
-      * Finished ('PLAY RECAP' in log file):       dictionary of each probe's state, like:
-                                                   status = {'123456abcdef': 'succeeded'
-                                                             'abcdef123456': 'failed'}
+    If the share of failed or unreachable probes in a batch is larger than
+    max_failure_rate (between 0 and 1), the remaining batches are skipped.
+    All batches write to the same log file.
+    """
+    def __init__(self, username, command, env, batches, max_failure_rate, log_path):
+        super().__init__(daemon=True)
+        self.username = username
+        self.command = command
+        self.env = env
+        self.batches = batches
+        self.max_failure_rate = max_failure_rate
+        self.log_path = log_path
+
+        # running, completed, halted or cancelled
+        self.state = 'running'
+        self.current_batch = 0
+        self.batch_results = []
+        self.exit_status = None
+        # True when the results of the rollout have been stored in the database
+        self.recorded = False
+        self._cancelled = False
+        # Held while checking _cancelled and starting a batch, so a cancel
+        # either stops the running batch or prevents the next one from starting
+        self._lock = threading.Lock()
+
+        # Start with an empty log file
+        open(self.log_path, 'w').close()
+
+    def run(self):
+        env = self.env
+        for i, batch in enumerate(self.batches):
+            if i == 1:
+                # The inventory was refreshed by the first batch
+                env = dict(env)
+                env.pop('PROBE_INVENTORY_REFRESH', None)
+
+            with self._lock:
+                if self._cancelled:
+                    self.state = 'cancelled'
+                    return
+                self.current_batch = i
+                with open(self.log_path, 'a') as log_file:
+                    log_offset = log_file.tell()
+                    _start_playbook(self.username, self.command + ['--limit', ','.join(batch)],
+                                    log_file, env)
+            supervisor.wait(self.username)
+            result = supervisor.pop_result(self.username)
+            self.exit_status = None if result is None else result.exit_status
+
+            with open(self.log_path, 'r') as f:
+                f.seek(log_offset)
+                stats = parse_play_recap(f.read())
+            failed = 0
+            for host in batch:
+                if (host not in stats or
+                        stats[host]['failed'] > 0 or
+                        stats[host]['unreachable'] > 0):
+                    failed += 1
+            failure_rate = failed / len(batch)
+            self.batch_results.append({'hosts': len(batch),
+                                       'failed': failed,
+                                       'failure_rate': failure_rate})
+
+            if self._cancelled:
+                self.state = 'cancelled'
+                return
+            if failure_rate > self.max_failure_rate and i < len(self.batches) - 1:
+                print('Rollout for {} halted after batch {} (failure rate {:.0%})'.format(
+                      self.username, i + 1, failure_rate))
+                self.state = 'halted'
+                return
+
+        self.state = 'completed'
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            supervisor.cancel(self.username)
+
+    def is_queued(self, probe_id):
+        """Return true if 'probe_id' is in a batch that has not started yet"""
+        for batch in self.batches[self.current_batch + 1:]:
+            if probe_id in batch:
+                return True
+        return False
+
+    def skipped_hosts(self):
+        """Return the hosts of the batches that were never started"""
+        if self.state == 'completed':
+            return []
+        hosts = []
+        for batch in self.batches[len(self.batch_results):]:
+            hosts += batch
+        return hosts
+
+    def get_status(self):
+        """Return a dictionary with the progress of the rollout, like:
+            {'state': 'running', 'current_batch': 1,
+             'batches': [{'hosts': 1, 'state': 'done', 'failed': 0, 'failure_rate': 0.0},
+                         {'hosts': 5, 'state': 'running'},
+                         {'hosts': 5, 'state': 'pending'}]}
+        """
+        batches = []
+        for i, batch in enumerate(self.batches):
+            if i < len(self.batch_results):
+                entry = dict(self.batch_results[i])
+                entry['state'] = 'done'
+            elif i == self.current_batch and self.state == 'running':
+                entry = {'hosts': len(batch), 'state': 'running'}
+            elif self.state == 'running':
+                entry = {'hosts': len(batch), 'state': 'pending'}
+            else:
+                entry = {'hosts': len(batch), 'state': 'skipped'}
+            batches.append(entry)
+
+        return {'state': self.state,
+                'current_batch': self.current_batch,
+                'max_failure_rate': self.max_failure_rate,
+                'batches': batches}
+
+
+def _has_result(username):
+    """Return true if a run of 'username' has finished, but its results have
+    not been stored in the database yet"""
+    if username in _rollouts:
+        rollout = _rollouts[username]
+        if not rollout.is_alive() and not rollout.recorded:
+            return True
+    return supervisor.has_result(username)
+
+
+def parse_play_recap(log_cont):
+    """Parse the PLAY RECAP section(s) of the Ansible output 'log_cont', and
+    return a dictionary with the results of each probe, like:
+        {'123456abcdef': {'ok': 5, 'changed': 1, 'unreachable': 0, 'failed': 0},
+         'abcdef123456': {'ok': 0, 'changed': 0, 'unreachable': 1, 'failed': 0}}
+    """
+    # Matches lines like this, and extracts the numbers:
+    # '12af4521deee               : ok=0    changed=0    unreachable=1    failed=0'
+    regex = '([a-zA-Z0-9_-]+)\\s+:\\s+ok=([0-9]+)+\\s+changed=([0-9]+)\\s+unreachable=([0-9]+)+\\s+failed=([0-9]+)+'
+    stats = {}
+    for name, ok, changed, unreachable, failed in re.findall(regex, log_cont):
+        stats[name] = {
+                'ok': int(ok),
+                'changed': int(changed),
+                'unreachable': int(unreachable),
+                'failed': int(failed)
+        }
+    return stats
+
+
+def _update_ansible_run(username, database, run=None):
+    """Store the results of 'username's last Ansible run in the database,
+    if the run has finished and has not been recorded already.
+
+    If 'run' is None, the last run of 'username' is looked up.
     """
-    status = {}
+    if is_ansible_running(username):
+        return
 
-    status['timestamp'] = time.time()
+    skipped = []
+    rollout = _rollouts.get(username)
+    if rollout is not None and not rollout.recorded:
+        result = ChildResult(rollout.exit_status)
+        # Probes in batches that never ran were not part of the update after all
+        skipped = rollout.skipped_hosts()
+        rollout.recorded = True
+    else:
+        result = supervisor.pop_result(username)
+
+    if run is None:
+        run = database.get_last_ansible_run(username)
+    if run is None or run.is_finished():
+        return
 
     log_file = os.path.join(settings.ANSIBLE_PATH, 'logs', username)
-    inventory_file = os.path.join(settings.ANSIBLE_PATH, 'inventory', username)
-    if not os.path.isfile(log_file) or not os.path.isfile(inventory_file):
-        status['ansible'] = 'not-running'
-        return status
-
-    completed = False
-    with open(log_file, 'r') as log_f, open(inventory_file, 'rb') as inv_f:
-        log_cont = log_f.read()
-        inv_cont = inv_f.read().decode('utf-8')
-        # Ansible is done updating
-        if 'PLAY RECAP' in log_cont:
-            # Matches lines like this, and extracts the numbers:
-            # '12af4521deee               : ok=0    changed=0    unreachable=1    failed=0'
-            regex = '([a-zA-Z0-9_-]+)\s+:\s+ok=([0-9]+)+\s+changed=([0-9]+)\s+unreachable=([0-9]+)+\s+failed=([0-9]+)+'
-            probes = re.findall(regex, log_cont)
-            status = {name: int(unreachable)+int(failed) for name, ok, changed, unreachable, failed in probes}
-            for key, value in status.items():
-                # Make the site always show the failed state if failed, i.e. do not
-                # go back to show the last time updated
-                if '--- PARSED ---' in log_cont:
-                    if value == 1:
-                        status[key] = 'failed'
-                else:
-                    status[key] = 'completed' if value == 0 else 'failed'
-                    completed = True
-            status['ansible'] = 'completed'
-        # Ansible is running
-        elif log_cont != '' and is_ansible_running(username):
-            regex = '\n([a-zA-Z0-9_-]+) '
-            probes = re.findall(regex, inv_cont)
-            status = {name: 'updating' for name in probes}
-
-    # Only tag probes as completed once. After that, let them show the time of
-    # last update. (This is kind of a workaround, maybe fix later)
-    if completed:
-        with open(log_file, 'a') as f:
-            f.write('--- PARSED ---\n')
-
-    status['timestamp'] = time.time()
-    return status
+    log_cont = ''
+    if os.path.isfile(log_file):
+        with open(log_file, 'r') as f:
+            log_cont = f.read()
+
+    # If the process is unknown to us (e.g. it was started by another server
+    # process), only consider the run finished when Ansible has written its recap
+    if result is None and 'PLAY RECAP' not in log_cont:
+        return
+
+    for host in list(run.hosts):
+        if host.probe_custom_id in skipped:
+            run.hosts.remove(host)
+
+    exit_status = None if result is None else result.exit_status
+    database.finish_ansible_run(run, exit_status, parse_play_recap(log_cont))
+    database.save_changes()
+
+
+def _read_inventory_hosts(username):
+    """Return a list of the hosts (probe MACs) in 'username's inventory file"""
+    inventory = os.path.join(settings.ANSIBLE_PATH, 'inventory', username)
+    if not os.path.isfile(inventory):
+        return []
+
+    with open(inventory, 'rb') as f:
+        inv_cont = f.read().decode('utf-8')
+    return re.findall('\\n([a-zA-Z0-9_-]+) ', inv_cont)
+
+
+def _rotate_log(dir_path, username):
+    """Compress 'username's current Ansible log, and rotate the old
+    compressed logs (<username>.1.gz is the newest one)"""
+    path = os.path.join(dir_path, username)
+    if not os.path.isfile(path) or os.path.getsize(path) == 0:
+        return
+
+    def rotated(i):
+        return '{}.{}.gz'.format(path, i)
+
+    if os.path.exists(rotated(LOG_ROTATE_COUNT)):
+        os.remove(rotated(LOG_ROTATE_COUNT))
+    for i in range(LOG_ROTATE_COUNT - 1, 0, -1):
+        if os.path.exists(rotated(i)):
+            os.rename(rotated(i), rotated(i + 1))
+
+    with open(path, 'rb') as src, gzip.open(rotated(1), 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(path)
@@ -0,0 +1,101 @@
+from time import monotonic
+import threading
+
+# Circuit breaker for the probes' SSH tunnels. When the tunnel of a probe is
+# down, every check or command against it can block a request for up to the
+# SSH timeout. After a number of failures in a row, the breaker 'opens' for
+# the probe, and the checks are answered immediately as failed (a negative
+# cache) until a background thread finds the tunnel up again. The retries are
+# done with exponential backoff, so known-dead probes cost next to nothing.
+
+
+class CircuitBreaker():
+    """Per-key circuit breaker (the keys are the probes' tunnel ports).
+
+    check is a function taking a key, returning true if it is reachable again.
+    It's only called from the background retry thread.
+    """
+    failure_threshold = 3
+    # In seconds
+    base_backoff = 30
+    max_backoff = 30*60
+
+    def __init__(self, check):
+        self.check = check
+        # key -> number of failures in a row
+        self._failures = {}
+        # key -> (time of next retry, current backoff) for open circuits
+        self._open = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def is_open(self, key):
+        """Return true if 'key' is known to be down, i.e. it shouldn't be tried"""
+        with self._lock:
+            return key in self._open
+
+    def record_success(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+            self._open.pop(key, None)
+
+    def record_failure(self, key):
+        """Count a failure for 'key', and open its circuit if there have
+        been failure_threshold failures in a row"""
+        with self._lock:
+            failures = self._failures.get(key, 0) + 1
+            self._failures[key] = failures
+            if failures < self.failure_threshold or key in self._open:
+                return
+            self._open[key] = (monotonic() + self.base_backoff, self.base_backoff)
+            self._start_retry_thread()
+        self._wakeup.set()
+
+    def reset(self, key=None):
+        """Forget the state of 'key' (or all keys if None)"""
+        with self._lock:
+            if key is None:
+                self._failures.clear()
+                self._open.clear()
+            else:
+                self._failures.pop(key, None)
+                self._open.pop(key, None)
+
+    def _start_retry_thread(self):
+        """NB: self._lock must be held when calling this function"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._retry_loop, daemon=True)
+        self._thread.start()
+
+    def _retry_loop(self):
+        while True:
+            with self._lock:
+                if len(self._open) == 0:
+                    self._thread = None
+                    return
+                now = monotonic()
+                due = [key for key, (retry_at, _) in self._open.items() if retry_at <= now]
+                next_retry = min(retry_at for retry_at, _ in self._open.values())
+
+            if len(due) == 0:
+                self._wakeup.wait(max(0, next_retry - now))
+                self._wakeup.clear()
+                continue
+
+            for key in due:
+                try:
+                    reachable = self.check(key)
+                except Exception:
+                    reachable = False
+
+                with self._lock:
+                    if key not in self._open:
+                        continue
+                    if reachable:
+                        self._failures.pop(key, None)
+                        del self._open[key]
+                    else:
+                        backoff = min(self._open[key][1] * 2, self.max_backoff)
+                        self._open[key] = (monotonic() + backoff, backoff)
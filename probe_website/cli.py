@@ -0,0 +1,45 @@
+from probe_website import app
+from probe_website.views import database
+import click
+
+# Commands for the flask command line tool, e.g.:
+#   export FLASK_APP=runserver.py
+#   flask init-db
+#   flask compile-templates
+
+
+@app.cli.command('init-db')
+def init_db():
+    """Create the database tables and the admin user.
+
+    This is done once (and after upgrades that change the database, which
+    adds the missing tables, columns and indexes), instead of by each web
+    server process when it starts.
+    """
+    if database.init_database():
+        click.echo('Added the user admin (password: admin). Change the password!')
+    click.echo('The database is ready')
+
+
+@app.cli.command('compile-templates')
+def compile_templates():
+    """Compile all templates into the template cache (TEMPLATE_CACHE_DIR).
+
+    Run this when deploying, as the same user as the web server (the cached
+    files are only readable by the user that wrote them), so the first
+    requests after a restart don't have to compile the templates.
+    """
+    if app.jinja_env.bytecode_cache is None:
+        click.echo('The template cache is turned off (TEMPLATE_CACHE_DIR = None)')
+        return
+    names = compile_all_templates()
+    click.echo('Compiled {} templates'.format(len(names)))
+
+
+def compile_all_templates():
+    """Compile all templates (which stores them in the template cache),
+    and return their names"""
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
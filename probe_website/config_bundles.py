@@ -0,0 +1,147 @@
+from probe_website import settings, util, inventory
+import os.path
+from os import makedirs
+import hashlib
+import hmac
+import json
+import threading
+
+# Pull-mode config distribution: instead of Ansible pushing the configs
+# through the SSH tunnels, a signed config bundle is published for each probe,
+# which the probes fetch themselves (see the /probe_config/<mac> view).
+#
+# Bundles are stored at <ansible_root>/bundles/<mac>.json, and the ETag and
+# signature of each bundle in <ansible_root>/bundles/index.json. The index is
+# kept in memory, so unchanged configs can be answered without reading
+# any bundle or querying the database.
+
+# If true, configs are published as bundles instead of being pushed with Ansible
+PULL_MODE = getattr(settings, 'CONFIG_DISTRIBUTION', 'push') == 'pull'
+
+_index = {}
+_index_mtime = None
+_index_lock = threading.Lock()
+
+
+def is_valid_token(probe_id, token):
+    """Return true if 'token' is the key of 'probe_id'"""
+    return hmac.compare_digest(util.get_probe_config_key(probe_id), token)
+
+
+def sign_bundle(probe_id, body):
+    """Return the HMAC-SHA256 signature of 'body' (bytes) with the key of 'probe_id'"""
+    key = util.get_probe_config_key(probe_id).encode('utf-8')
+    return hmac.new(key, body, hashlib.sha256).hexdigest()
+
+
+def publish_bundles(database, username, probe_ids):
+    """Render and publish the config bundles of 'username's probes in 'probe_ids'.
+
+    The bundle contains the same variables as the ones Ansible gets when
+    pushing (see inventory.build_inventory). Return the number of bundles
+    that changed.
+    """
+    data = inventory.build_inventory(database, username, probe_ids)
+    group_vars = data[username]['vars'] if username in data else {}
+
+    dir_path = _get_dir()
+    changed = {}
+    for probe_id, host_vars in data['_meta']['hostvars'].items():
+        # The probe already knows its own key
+        host_vars = dict(host_vars)
+        host_vars.pop('probe_config_token', None)
+        bundle = {'group_vars': group_vars, 'host_vars': host_vars}
+        body = json.dumps(bundle, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        etag = hashlib.sha256(body).hexdigest()[:32]
+
+        info = get_bundle_info(probe_id)
+        if info is not None and info['etag'] == etag:
+            continue
+
+        _write_file(os.path.join(dir_path, probe_id + '.json'), body)
+        changed[probe_id] = {'etag': etag, 'signature': sign_bundle(probe_id, body)}
+
+    if len(changed) > 0:
+        with _index_lock:
+            _load_index()
+            _index.update(changed)
+            _save_index()
+
+    return len(changed)
+
+
+def remove_bundle(probe_id):
+    """Remove the published bundle of 'probe_id' (if any)"""
+    dir_path = _get_dir()
+    with _index_lock:
+        _load_index()
+        if probe_id not in _index:
+            return
+        del _index[probe_id]
+        _save_index()
+
+    path = os.path.join(dir_path, probe_id + '.json')
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def get_bundle_info(probe_id):
+    """Return a dictionary with the 'etag' and 'signature' of 'probe_id's
+    published bundle, or None if no bundle has been published"""
+    with _index_lock:
+        _load_index()
+        return _index.get(probe_id)
+
+
+def load_bundle(probe_id):
+    """Return the published bundle of 'probe_id' as bytes, or None"""
+    path = os.path.join(_get_dir(), probe_id + '.json')
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _get_dir():
+    dir_path = os.path.join(settings.ANSIBLE_PATH, 'bundles')
+    if not os.path.exists(dir_path):
+        makedirs(dir_path)
+    return dir_path
+
+
+def _load_index():
+    """(Re)load the index file if it has changed since last time, e.g. because
+    another server process published bundles.
+
+    NB: _index_lock must be held when calling this function
+    """
+    global _index, _index_mtime
+    path = os.path.join(_get_dir(), 'index.json')
+    if not os.path.isfile(path):
+        return
+
+    mtime = os.path.getmtime(path)
+    if mtime == _index_mtime:
+        return
+
+    with open(path, 'r') as f:
+        _index = json.load(f)
+    _index_mtime = mtime
+
+
+def _save_index():
+    """Write the in-memory index to the index file
+
+    NB: _index_lock must be held when calling this function
+    """
+    global _index_mtime
+    path = os.path.join(_get_dir(), 'index.json')
+    _write_file(path, json.dumps(_index).encode('utf-8'))
+    _index_mtime = os.path.getmtime(path)
+
+
+def _write_file(path, data):
+    """Write 'data' (bytes) to 'path', without readers ever seeing a partial file"""
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
@@ -1,16 +1,29 @@
 from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker, relationship
+from sqlalchemy.orm import scoped_session, sessionmaker, relationship, subqueryload, joinedload
+from sqlalchemy import event, inspect
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.ext.declarative import declarative_base
 from re import fullmatch
-from probe_website import util, settings, messages
+from probe_website import util, settings, messages, user_cache
 from probe_website import ansible_interface as ansible
-from flask import flash
+from flask import flash, g, has_request_context
+from datetime import datetime
+from time import time
+from os import urandom
+import binascii
+import hashlib
 
 # The models module depend on this, so that's why it's global
 Base = declarative_base()
 
+# Number of rows fetched at a time when streaming long lists (see
+# iter_probes_data and iter_user_data)
+STREAM_BATCH_SIZE = 500
+
 # This must be imported AFTER Base has been instantiated!
 from probe_website.models import Probe, Script, NetworkConfig, Database, User
+from probe_website.models import AnsibleRun, AnsibleRunHost, Heartbeat
+from probe_website.models import VersionCounter, DeletedRow, ApiToken
 
 
 class DatabaseManager():
@@ -19,6 +32,10 @@ class DatabaseManager():
         """Set up SQL Alchemy with the database at 'database_path'
 
         database_url can be e.g. 'sqlite:////home/bob/database.db'
+
+        No connection is made to the database until the first query, so
+        this is cheap. The tables and the admin user are set up once with
+        init_database (the init-db command), not by each web server process.
         """
         self.engine = create_engine(database_url, convert_unicode=True)
         self.session = scoped_session(sessionmaker(autocommit=False,
@@ -29,11 +46,45 @@ class DatabaseManager():
         Base.query = self.session.query_property()
 
         self.setup_relationships()
+        event.listen(self.session, 'before_flush', _assign_versions)
 
+    def init_database(self):
+        """Create the tables, columns and indexes that don't exist yet, and
+        add an admin user (password admin) if there are no users. Return true
+        if the admin user was added."""
         Base.metadata.create_all(self.engine)
 
-        if len(self.session.query(User).all()) == 0:
+        # create_all doesn't add new columns or indexes to tables that
+        # already exist (e.g. after an upgrade)
+        inspector = inspect(self.engine)
+        self._add_missing_columns(inspector)
+        for table in Base.metadata.sorted_tables:
+            existing = set(index['name'] for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(self.engine)
+
+        added = False
+        if self.session.query(User.id).first() is None:
             self.add_user('admin', 'admin', 'admin', 'admin', True)
+            added = True
+        self.shutdown_session()
+        return added
+
+    def _add_missing_columns(self, inspector):
+        """Add the columns of the models that are missing from the existing
+        tables. Existing rows get the column's server default (or NULL), so
+        only columns that allow that can be added this way."""
+        preparer = self.engine.dialect.identifier_preparer
+        for table in Base.metadata.sorted_tables:
+            existing = set(column['name'] for column in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                print('Adding the column {}.{}'.format(table.name, column.name))
+                column_ddl = CreateColumn(column).compile(dialect=self.engine.dialect)
+                self.engine.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                                    preparer.format_table(table), column_ddl))
 
     def setup_relationships(self):
         """Set up the relations between the different SQL tables"""
@@ -47,6 +98,11 @@ class DatabaseManager():
                                              back_populates='probe',
                                              cascade='all, delete, delete-orphan')
 
+        Probe.heartbeat = relationship('Heartbeat',
+                                       uselist=False,
+                                       back_populates='probe',
+                                       cascade='all, delete, delete-orphan')
+
         User.probes = relationship('Probe',
                                    order_by=Probe.id,
                                    back_populates='user',
@@ -57,10 +113,57 @@ class DatabaseManager():
                                       back_populates='user',
                                       cascade='all, delete, delete-orphan')
 
+        User.ansible_runs = relationship('AnsibleRun',
+                                         order_by=AnsibleRun.id,
+                                         back_populates='user',
+                                         cascade='all, delete, delete-orphan')
+
+        User.api_tokens = relationship('ApiToken',
+                                       order_by=ApiToken.id,
+                                       back_populates='user',
+                                       cascade='all, delete, delete-orphan')
+
+        AnsibleRun.hosts = relationship('AnsibleRunHost',
+                                        order_by=AnsibleRunHost.id,
+                                        back_populates='run',
+                                        cascade='all, delete, delete-orphan')
+
     def shutdown_session(self):
         """Close the database"""
+        self.clear_request_cache()
         self.session.remove()
 
+    def _get_request_cache(self):
+        """Return the cache of the users and probes fetched during the current
+        request (see get_user and get_probe), or None outside of requests.
+
+        The cache lives in flask.g, so it's thrown away after each request.
+        The cached instances are the same ones as in the SQL Alchemy session,
+        so it only saves the queries, and never returns other data than
+        the session would.
+        """
+        if not has_request_context():
+            return None
+        cache = getattr(g, '_database_cache', None)
+        if cache is None:
+            cache = {'users': {}, 'probes': {}}
+            g._database_cache = cache
+        return cache
+
+    def clear_request_cache(self, username=None, probe_id=None):
+        """Remove 'username' and/or 'probe_id' (MAC) from the request cache.
+        If both are None, the whole cache is cleared"""
+        cache = self._get_request_cache()
+        if cache is None:
+            return
+        if username is None and probe_id is None:
+            cache['users'].clear()
+            cache['probes'].clear()
+        if username is not None:
+            cache['users'].pop(username, None)
+        if probe_id is not None:
+            cache['probes'].pop(util.convert_mac(probe_id, mode='storage'), None)
+
     def add_user(self, username, password, contact_person, contact_email, admin=False, oauth_id=None):
         """Add a new user to the database"""
         if len(self.session.query(User).filter(User.username == username).all()) != 0:
@@ -69,6 +172,7 @@ class DatabaseManager():
         user = User(username, password, contact_person, contact_email, admin, oauth_id)
         self.session.add(user)
         self.add_default_databases(user)
+        self._invalidate_cached_user(username)
         self.save_changes()
         return True
 
@@ -178,17 +282,17 @@ class DatabaseManager():
         """Return true if 'entry' is of type str and non-empty"""
         return type(entry) is str and entry != ''
 
-    def update_probe(self, current_probe_id, name=None, new_custom_id=None, location=None):
-        """Update 'current_probe_id' with new attributes"""
-        probe = self.get_probe(current_probe_id)
+    def update_probe(self, probe, name=None, new_custom_id=None, location=None):
+        """Update 'probe' (a Probe instance) with new attributes"""
         if probe is None:
             return False
 
-        conv_curr = util.convert_mac(current_probe_id, mode='storage')
+        conv_curr = probe.custom_id
         conv_new = util.convert_mac(new_custom_id, mode='storage')
         if not conv_curr == conv_new:
             if self.is_valid_id(new_custom_id):
                 probe.custom_id = util.convert_mac(new_custom_id, mode='storage')
+                self.clear_request_cache(probe_id=conv_curr)
             else:
                 return False
 
@@ -290,8 +394,11 @@ class DatabaseManager():
         if user is None:
             return False
 
+        self._invalidate_cached_user(current_username)
         if self.is_valid_string(new_username) and ' ' not in new_username:
             user.username = new_username
+            self.clear_request_cache(username=current_username)
+            self._invalidate_cached_user(new_username)
         if self.is_valid_string(password) and password != '***':
             user.set_password(password)
         if self.is_valid_string(contact_person):
@@ -304,39 +411,46 @@ class DatabaseManager():
     # This method also just returns the basic info, not info about each
     # probe's script configs etc.
     def get_all_probes_data(self, username):
-        """Return a list of dictionaries with data about all probes of 'username'.
+        """Return a list of dictionaries with data about all probes of 'username'
+        (see iter_probes_data)"""
+        return list(self.iter_probes_data(username))
+
+    def iter_probes_data(self, username):
+        """Yield a dictionary with data about each probe of 'username'.
 
         The data listed for each probe is the same as the data returned from
         get_probe_data (see function below), with the exception of the script
-        and network configs;
+        and network configs.
+
+        The probes are fetched STREAM_BATCH_SIZE at a time (through a
+        server-side cursor, if the database driver supports it), so long
+        lists can be rendered without having all the probes in memory.
         """
-        all_data = []
         user = self.get_user(username)
-
-        for probe in self.session.query(Probe).filter(Probe.user_id == user.id).all():
-            data_entry = self.get_probe_data(probe.custom_id)
-
-            # We don't need the detailed data
-            data_entry.pop('scripts')
-            data_entry.pop('network_configs')
-            all_data.append(data_entry)
-
-        return all_data
+        probes = (self.session.query(Probe)
+                  .filter(Probe.user_id == user.id)
+                  .order_by(Probe.id)
+                  .yield_per(STREAM_BATCH_SIZE))
+        for probe in probes:
+            yield self._get_basic_probe_data(probe)
 
     def get_probe_data(self, probe_id):
         """Return a dictionary containing all saved data about 'probe_id'"""
         probe = self.get_probe(probe_id)
-        data = {
+        data = self._get_basic_probe_data(probe)
+        data['scripts'] = self.get_script_data(probe)
+        data['network_configs'] = self.get_network_config_data(probe)
+        return data
+
+    def _get_basic_probe_data(self, probe):
+        return {
                 'name': probe.name,
                 'id': util.convert_mac(probe.custom_id, mode='display'),
                 'storage_id': probe.custom_id,
                 'location': probe.location,
-                'scripts': self.get_script_data(probe),
-                'network_configs': self.get_network_config_data(probe),
                 'associated': probe.associated,
                 'association_period_expired': probe.association_period_expired()
         }
-        return data
 
     def get_script_data(self, probe):
         """Return a dictionary containing all script configs of 'probe'"""
@@ -385,7 +499,7 @@ class DatabaseManager():
                 print('Invalid username')
                 return
 
-        databases = self.session.query(Database).filter(Database.user_id == user.id)
+        databases = self.session.query(Database).filter(Database.user_id == user.id).all()
 
         configs = {db.db_type: '' for db in databases}
         for database in databases:
@@ -404,44 +518,181 @@ class DatabaseManager():
 
     def get_user_data(self, username):
         """Return a dictionary containing all data about 'username'"""
-        user = self.get_user(username)
-        data = {
+        return self._get_user_data(self.get_user(username))
+
+    def _get_user_data(self, user):
+        return {
                 'username': user.username,
                 'password': '***',
                 'contact_person': user.contact_person,
                 'contact_email': user.contact_email,
                 'id': user.id
         }
-        return data
 
     def get_all_user_data(self):
         """Return a list containing data about all users"""
-        users = []
-        for username, in self.session.query(User.username).all():
-            users.append(self.get_user_data(username))
-        return users
+        return list(self.iter_user_data())
+
+    def iter_user_data(self):
+        """Yield the data (see get_user_data) of each user, fetched
+        STREAM_BATCH_SIZE at a time (like iter_probes_data)"""
+        for user in self.session.query(User).order_by(User.id).yield_per(STREAM_BATCH_SIZE):
+            yield self._get_user_data(user)
 
     def get_user(self, username):
         """Return the User class instance with the username 'username'"""
-        return self.session.query(User).filter(User.username == username).first()
+        cache = self._get_request_cache()
+        if cache is not None and username in cache['users']:
+            return cache['users'][username]
+
+        user = self.session.query(User).filter(User.username == username).first()
+        if cache is not None and user is not None:
+            cache['users'][username] = user
+        return user
+
+    def get_user_by_oauth_id(self, oauth_id):
+        """Return the User class instance with the OAuth (Feide) id 'oauth_id'"""
+        return self.session.query(User).filter(User.oauth_id == oauth_id).first()
 
     def get_probe(self, probe_id):
         """Return the Probe class instance with the custom_id/MAC 'probe_id'"""
         probe_id = util.convert_mac(probe_id, mode='storage')
-        return self.session.query(Probe).filter(Probe.custom_id == probe_id).first()
+        cache = self._get_request_cache()
+        if cache is not None and probe_id in cache['probes']:
+            return cache['probes'][probe_id]
+
+        probe = self.session.query(Probe).filter(Probe.custom_id == probe_id).first()
+        if cache is not None and probe is not None:
+            cache['probes'][probe_id] = probe
+        return probe
+
+    def get_associated_probe_ids(self):
+        """Return the custom ids (MACs) of all associated probes"""
+        probe_ids = [probe_id for probe_id, in
+                     self.session.query(Probe.custom_id).filter(Probe.associated == True).all()]
+        self.shutdown_session()
+        return probe_ids
+
+    def get_probe_with_configs(self, probe_id):
+        """Same as get_probe, but the probe's user, scripts and network configs
+        are loaded in the same query"""
+        probe_id = util.convert_mac(probe_id, mode='storage')
+        probe = (self.session.query(Probe)
+                 .options(joinedload(Probe.user),
+                          joinedload(Probe.scripts),
+                          joinedload(Probe.network_configs))
+                 .filter(Probe.custom_id == probe_id)
+                 .first())
+        cache = self._get_request_cache()
+        if cache is not None and probe is not None:
+            cache['probes'][probe_id] = probe
+        return probe
 
     def get_script(self, probe, script_id):
-        """Return the Script class instance with the id 'probe_id' and relation to 'probe'"""
-        return self.session.query(Script).filter(Script.probe_id == probe.id, Script.id == script_id).first()
+        """Return the Script class instance with the id 'probe_id' and relation to 'probe'
+
+        The script is looked up in probe.scripts, so if it's already loaded
+        (see get_probe_with_configs), no query is needed.
+        """
+        for script in probe.scripts:
+            if script.id == script_id:
+                return script
+        return None
 
     def get_network_config(self, probe, config_id):
-        """Return the NetworkConfig class instance with the id 'config_id' and relation to 'probe'"""
-        return self.session.query(NetworkConfig).filter(NetworkConfig.probe_id == probe.id, NetworkConfig.id == config_id).first()
+        """Return the NetworkConfig class instance with the id 'config_id' and relation to 'probe'
+
+        The config is looked up in probe.network_configs (see get_script).
+        """
+        for config in probe.network_configs:
+            if config.id == config_id:
+                return config
+        return None
 
     def get_database(self, user, db_id):
         """Return the Database class instance with the id 'db_id' and relation to 'user'"""
         return self.session.query(Database).filter(Database.user_id == user.id, Database.id == db_id).first()
 
+    def add_ansible_run(self, username, probe_ids):
+        """Register a new Ansible run for 'username', updating the probes
+        with the custom ids/MACs in 'probe_ids'. Return the run"""
+        user = self.get_user(username)
+        run = AnsibleRun(datetime.today())
+        for probe_id in probe_ids:
+            run.hosts.append(AnsibleRunHost(util.convert_mac(probe_id, mode='storage')))
+        user.ansible_runs.append(run)
+        return run
+
+    def finish_ansible_run(self, run, exit_status, host_stats):
+        """Mark 'run' as finished, and store the per-host results in
+        'host_stats', which is a dictionary like the one returned from
+        ansible_interface.parse_play_recap.
+
+        Probes that were updated successfully get their last_updated time
+        set to the time the run finished.
+        """
+        run.finished = datetime.today()
+        run.exit_status = exit_status
+        duration = run.duration()
+
+        updated = []
+        for host in run.hosts:
+            if host.probe_custom_id not in host_stats:
+                continue
+            stats = host_stats[host.probe_custom_id]
+            host.ok = stats['ok']
+            host.changed = stats['changed']
+            host.unreachable = stats['unreachable']
+            host.failed = stats['failed']
+            # Ansible runs the hosts in lockstep, so each host takes as long as the run
+            host.duration = duration
+            if host.succeeded():
+                updated.append(host.probe_custom_id)
+
+        if len(updated) > 0:
+            for probe in self.session.query(Probe).filter(Probe.custom_id.in_(updated)).all():
+                probe.has_been_updated = True
+                probe.last_updated = run.finished
+
+    def get_last_ansible_run(self, username):
+        """Return the most recent AnsibleRun of 'username', or None"""
+        user = self.get_user(username)
+        if user is None:
+            return None
+        return (self.session.query(AnsibleRun)
+                .filter(AnsibleRun.user_id == user.id)
+                .order_by(AnsibleRun.id.desc())
+                .first())
+
+    def get_last_ansible_run_host(self, probe_id):
+        """Return the AnsibleRunHost of the most recent run that included
+        'probe_id', or None if the probe has never been updated"""
+        probe_id = util.convert_mac(probe_id, mode='storage')
+        return (self.session.query(AnsibleRunHost)
+                .filter(AnsibleRunHost.probe_custom_id == probe_id)
+                .order_by(AnsibleRunHost.run_id.desc())
+                .first())
+
+    def update_heartbeat(self, probe, timestamp, eth0, wlan0, uptime, load):
+        """Store a heartbeat from 'probe', replacing the previous one.
+
+        Return false if the heartbeat is older than the stored one (i.e. it
+        may be a replay)
+        """
+        if probe.heartbeat is None:
+            probe.heartbeat = Heartbeat()
+        elif timestamp <= probe.heartbeat.timestamp:
+            return False
+
+        heartbeat = probe.heartbeat
+        heartbeat.timestamp = timestamp
+        heartbeat.received = int(time())
+        heartbeat.eth0 = eth0
+        heartbeat.wlan0 = wlan0
+        heartbeat.uptime = uptime
+        heartbeat.load = load
+        return True
+
     def remove_probe(self, username, probe_custom_id):
         """Remove the probe with id 'probe_custom_id', as long as it belongs
         to 'username'"""
@@ -454,6 +705,7 @@ class DatabaseManager():
         ansible.remove_host_cert(probe_id)
         if probe is not None:
             self.session.delete(probe)
+            self.clear_request_cache(probe_id=probe_id)
 
         return True
 
@@ -472,16 +724,146 @@ class DatabaseManager():
             self.session.delete(database)
 
         self.session.delete(user)
+        self.clear_request_cache(username=username)
+        self._invalidate_cached_user(username)
 
         return True
 
+    def add_api_token(self, username, name, scopes):
+        """Add a new API token with 'scopes' (list of scope names) for
+        'username', and return the token. Only its hash is stored, so this
+        is the only time the token is known."""
+        user = self.get_user(username)
+        if user is None or not self.is_valid_string(name):
+            return None
+
+        token = binascii.hexlify(urandom(32)).decode('ascii')
+        user.api_tokens.append(ApiToken(name, _hash_api_token(token), scopes, datetime.now()))
+        return token
+
+    def get_api_token(self, token):
+        """Return the ApiToken instance (with its user loaded) of 'token',
+        or None if there is no such token"""
+        return (self.session.query(ApiToken)
+                .options(joinedload(ApiToken.user))
+                .filter(ApiToken.token_hash == _hash_api_token(token))
+                .first())
+
+    def remove_api_token(self, username, token_id):
+        """Remove 'username's API token with id 'token_id'. Return false if
+        there is no such token."""
+        user = self.get_user(username)
+        if user is None:
+            return False
+        for api_token in user.api_tokens:
+            if str(api_token.id) == str(token_id):
+                self.session.delete(api_token)
+                return True
+        return False
+
+    def get_changes(self, username, since=0):
+        """Return the probes, scripts, network configs and Ansible runs of
+        'username' that have changed after version 'since', and the rows that
+        have been deleted after it, as a dictionary:
+
+        {'version': <current version>, 'probes': [...], 'scripts': [...],
+         'network_configs': [...], 'ansible_runs': [...],
+         'deleted': [{'table': <table name>, 'id': <row id>}, ...]}
+
+        since = 0 returns all the rows (and no deleted rows). Clients should
+        pass the returned version as 'since' the next time.
+        """
+        user = self.get_user(username)
+
+        # Read the version first, so changes made while the rows are
+        # queried are returned again next time, instead of being missed
+        version = self.session.query(VersionCounter.version).scalar() or 0
+
+        def changed(query, model):
+            if since > 0:
+                query = query.filter(model.version > since)
+            return query.order_by(model.version).all()
+
+        probes = changed(self.session.query(Probe).filter(Probe.user_id == user.id), Probe)
+        scripts = changed(self.session.query(Script, Probe.custom_id)
+                          .join(Probe, Script.probe_id == Probe.id)
+                          .filter(Probe.user_id == user.id), Script)
+        network_configs = changed(self.session.query(NetworkConfig, Probe.custom_id)
+                                  .join(Probe, NetworkConfig.probe_id == Probe.id)
+                                  .filter(Probe.user_id == user.id), NetworkConfig)
+        runs = changed(self.session.query(AnsibleRun)
+                       .options(subqueryload(AnsibleRun.hosts))
+                       .filter(AnsibleRun.user_id == user.id), AnsibleRun)
+
+        deleted = []
+        if since > 0:
+            deleted = (self.session.query(DeletedRow)
+                       .filter(DeletedRow.user_id == user.id, DeletedRow.version > since)
+                       .order_by(DeletedRow.version)
+                       .all())
+
+        def isoformat(time):
+            return time.isoformat() if time is not None else None
+
+        return {
+                'version': version,
+                'probes': [{'id': probe.id,
+                            'mac': probe.custom_id,
+                            'name': probe.name,
+                            'location': probe.location,
+                            'associated': probe.associated,
+                            'has_been_updated': probe.has_been_updated,
+                            'last_updated': isoformat(probe.last_updated),
+                            'version': probe.version} for probe in probes],
+                'scripts': [{'id': script.id,
+                             'probe': mac,
+                             'description': script.description,
+                             'filename': script.filename,
+                             'args': script.args,
+                             'minute_interval': script.minute_interval,
+                             'enabled': script.enabled,
+                             'required': script.required,
+                             'version': script.version} for script, mac in scripts],
+                # NB: passwords are left out
+                'network_configs': [{'id': config.id,
+                                     'probe': mac,
+                                     'name': config.name,
+                                     'ssid': config.ssid,
+                                     'anonymous_id': config.anonymous_id,
+                                     'username': config.username,
+                                     'version': config.version} for config, mac in network_configs],
+                'ansible_runs': [{'id': run.id,
+                                  'started': isoformat(run.started),
+                                  'finished': isoformat(run.finished),
+                                  'exit_status': run.exit_status,
+                                  'hosts': [{'probe': host.probe_custom_id,
+                                             'ok': host.ok,
+                                             'changed': host.changed,
+                                             'unreachable': host.unreachable,
+                                             'failed': host.failed} for host in run.hosts],
+                                  'version': run.version} for run in runs],
+                'deleted': [{'table': row.table_name, 'id': row.row_id} for row in deleted]
+        }
+
     def save_changes(self):
         """Save database changes persistently to SQL database"""
         self.session.commit()
+        # Again, in case another thread cached the users before the commit
+        for username in self.session().info.pop('changed_users', []):
+            user_cache.invalidate(username)
+
+    def _invalidate_cached_user(self, username):
+        """Remove 'username' from the user cache (see user_cache.py), now
+        and when the changes are saved"""
+        user_cache.invalidate(username)
+        self.session().info.setdefault('changed_users', set()).add(username)
 
     def revert_changes(self):
         """Revert database back to how it was at last save"""
         self.session.rollback()
+        self.session().info.pop('changed_users', None)
+        # Instances added since the last save are no longer in the session
+        self.clear_request_cache()
 
     def valid_network_configs(self, probe, with_warning=False):
         """Returns true if 'probe's network config(s) has been filled out"""
@@ -525,3 +907,47 @@ class DatabaseManager():
             elif base_port + i > max_port:
                 return -1
             i += 1
+
+
+# The rows with a version column, which is set on every change
+VERSIONED_MODELS = (Probe, Script, NetworkConfig, AnsibleRun)
+
+
+def _hash_api_token(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def _assign_versions(session, flush_context, instances):
+    """Give all versioned rows changed in this flush the next version, and
+    add tombstones for the deleted ones (SQL Alchemy before_flush event).
+
+    The version counter is incremented with a single UPDATE, which also
+    locks its row until the transaction is committed, so versions are
+    assigned in commit order.
+    """
+    changed = [obj for obj in session.new if isinstance(obj, VERSIONED_MODELS)]
+    changed += [obj for obj in session.dirty
+                if isinstance(obj, VERSIONED_MODELS) and session.is_modified(obj)]
+    # Changed run results count as a change of the run
+    changed += [obj.run for obj in list(session.new) + list(session.dirty)
+                if isinstance(obj, AnsibleRunHost) and obj.run is not None]
+    deleted = [obj for obj in session.deleted if isinstance(obj, VERSIONED_MODELS)]
+
+    if len(changed) == 0 and len(deleted) == 0:
+        return
+
+    counter = VersionCounter.__table__
+    result = session.execute(counter.update().values(version=counter.c.version + 1))
+    if result.rowcount == 0:
+        session.execute(counter.insert().values(id=1, version=1))
+    version = session.execute(counter.select()).first().version
+
+    for obj in changed:
+        obj.version = version
+
+    for obj in deleted:
+        if isinstance(obj, (Probe, AnsibleRun)):
+            user_id = obj.user_id
+        else:
+            user_id = session.query(Probe.user_id).filter(Probe.id == obj.probe_id).scalar()
+        session.add(DeletedRow(obj.__tablename__, obj.id, user_id, version))
@@ -20,14 +20,38 @@ def set_database(new_database):
     database = new_database
 
 
-def update_scripts():
-    """Parse script config data from HTML POST form and update 'probe_id's scripts,
-    where 'probe_id' is the 'id' argument of the POST request.
+def save_probe_setup(probe, username):
+    """Parse the probe setup form, and update 'probe' (basic info, scripts,
+    network configs and certificates) with its data.
+
+    The form is parsed once, and 'probe' should have its scripts and network
+    configs loaded already (see DatabaseManager.get_probe_with_configs), so
+    the number of queries doesn't depend on the number of scripts/configs.
+    Nothing is saved, so the caller should save or revert the changes.
+
+    Return true if successful
+    """
+    configs = util.parse_configs(request.form.items(), None)
+    certs = util.parse_configs(request.files.items(), 'network')
+
+    # Don't stop at the first failure, so all errors are flashed
+    successful_script_update = update_scripts(probe, configs.get('script', {}))
+    successful_network_update = update_network_configs(probe, configs.get('network', {}))
+    successful_certificate_upload = upload_certificate(probe, username, certs)
+    successful_probe_update = update_probe(probe)
+
+    return (successful_script_update and
+            successful_network_update and
+            successful_certificate_upload and
+            successful_probe_update)
+
+
+def update_scripts(probe, script_configs):
+    """Update 'probe's scripts with the (parsed) script config data from
+    the HTML POST form
 
     Return true if successful
     """
-    probe_id = request.args.get('id', '')
-    script_configs = util.parse_configs(request.form.items(), 'script')
     blank_config = {
             'name': None,
             'script_file': None,
@@ -36,7 +60,6 @@ def update_scripts():
             'enabled': None,
     }
 
-    probe = database.get_probe(probe_id)
     successful = True
     for script_id, config in script_configs.items():
         # Merge the two dicts
@@ -50,14 +73,12 @@ def update_scripts():
     return successful
 
 
-def update_network_configs():
-    """Parse network config data from HTML POST form and update 'probe_id's scripts,
-    where 'probe_id' is the 'id' argument of the POST request.
+def update_network_configs(probe, network_configs):
+    """Update 'probe's network configs with the (parsed) network config data
+    from the HTML POST form
 
     Return true if successful
     """
-    probe_id = request.args.get('id', '')
-    network_configs = util.parse_configs(request.form.items(), 'network')
     blank_config = {
             'ssid': None,
             'anonymous_id': None,
@@ -65,7 +86,6 @@ def update_network_configs():
             'password': None,
     }
 
-    probe = database.get_probe(probe_id)
     successful = True
     for config_id, config in network_configs.items():
         # Merge the two dicts
@@ -79,21 +99,25 @@ def update_network_configs():
     return successful
 
 
-def upload_certificate(probe_id, username):
-    """Validate the uploaded certificate file and save it as
-    'probe_id's certificate
+def upload_certificate(probe, username, certs):
+    """Validate the uploaded certificate files (parsed from the form's files)
+    and save them as 'probe's certificates
 
     (It's the user that uploads the certificate, not the server)
     Return true if successful
     """
-    certs = util.parse_configs(request.files.items(), 'network')
-    probe = database.get_probe(probe_id)
+    probe_id = probe.custom_id
     data = ansible_interface.get_certificate_data(username, probe_id)
     successful = True
 
     # cert_paths = {'any': '', 'two_g': '', 'five_g': ''}
     for net_conf_id, tup in certs.items():
-        freq = database.get_network_config(probe, net_conf_id).name
+        network_config = database.get_network_config(probe, net_conf_id)
+        if network_config is None:
+            flash('Invalid network config.', 'error')
+            successful = False
+            break
+        freq = network_config.name
 
         if 'certificate' not in tup:
             flash('Certificate file part missing.', 'error')
@@ -126,8 +150,8 @@ def upload_certificate(probe_id, username):
     return successful
 
 
-def update_probe(probe_id):
-    """Update 'probe_id' with the supplied data.
+def update_probe(probe):
+    """Update 'probe' with the supplied data.
 
     Return true if successful
     """
@@ -135,7 +159,7 @@ def update_probe(probe_id):
     new_probe_id = request.form.get('probe_id', '')
     new_location = request.form.get('probe_location', '')
 
-    successful = database.update_probe(probe_id, new_name, new_probe_id, new_location)
+    successful = database.update_probe(probe, new_name, new_probe_id, new_location)
     return successful
 
 
@@ -187,6 +211,40 @@ def new_probe(username):
     return True
 
 
+def parse_rollout():
+    """Parse the staged rollout options of a config push.
+
+    Return a dictionary with the options (as expected by
+    ansible_interface.run_ansible_playbook), or None if they are invalid
+    """
+    canary_size = request.form.get('canary_size', '1')
+    batch_size = request.form.get('batch_size', '20%').strip()
+    max_failure_rate = request.form.get('max_failure_rate', '20')
+
+    try:
+        canary_size = int(canary_size)
+        if batch_size.endswith('%'):
+            valid_batch_size = 0 < float(batch_size[:-1]) <= 100
+        else:
+            batch_size = int(batch_size)
+            valid_batch_size = batch_size > 0
+        max_failure_rate = float(max_failure_rate) / 100
+    except ValueError:
+        valid_batch_size = False
+
+    if (not valid_batch_size or
+            canary_size < 1 or
+            not 0 <= max_failure_rate <= 1):
+        flash(messages.ERROR_MESSAGE['invalid_rollout'], 'error')
+        return None
+
+    return {
+            'canary_size': canary_size,
+            'batch_size': batch_size,
+            'max_failure_rate': max_failure_rate
+    }
+
+
 def new_user():
     """Add a new user with the supplied data.
 
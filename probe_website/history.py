@@ -0,0 +1,203 @@
+from probe_website import settings
+import os.path
+from os import makedirs
+from time import time
+import mmap
+import re
+import struct
+import threading
+
+# Connectivity history of the probes, stored as one ring buffer file per probe
+# at <root>/history/<mac>. Each file holds one byte (sample) per minute for
+# the last HISTORY_DAYS days, so the files have a fixed size no matter how long
+# the probes have been running.
+#
+# File layout: an 8 byte header with the last minute (unix time / 60) that has
+# been written, followed by SLOTS sample bytes. The sample of minute m is
+# stored at slot m % SLOTS. Each sample is a bit field of the flags below.
+#
+# Samples are recorded whenever the server learns something about a probe's
+# status (heartbeats and connection checks), and every minute for all the
+# associated probes (see sampler.py). Minutes without any samples are
+# 'unknown', and don't count towards the uptime.
+
+HISTORY_DAYS = 30
+SLOTS = HISTORY_DAYS * 24 * 60
+
+# The minute has been sampled
+PRESENT = 1
+# The probe was reachable (tunnel up or heartbeat received)
+REACHABLE = 2
+ETH0 = 4
+WLAN0 = 8
+
+_HEADER = struct.Struct('<q')
+_FILE_SIZE = _HEADER.size + SLOTS
+
+_lock = threading.Lock()
+
+# Translation tables for the queries. bytes.translate maps every sample to
+# one byte, so counting and searching can be done in C instead of
+# looping over the samples in Python.
+_UP, _DOWN, _UNKNOWN = b'U', b'D', b'-'
+
+
+def _make_table(flag):
+    table = bytearray(256)
+    for sample in range(256):
+        if not sample & PRESENT:
+            table[sample] = _UNKNOWN[0]
+        elif sample & flag:
+            table[sample] = _UP[0]
+        else:
+            table[sample] = _DOWN[0]
+    return bytes(table)
+
+_TABLES = {flag: _make_table(flag) for flag in (REACHABLE, ETH0, WLAN0)}
+
+
+def record(probe_id, reachable, eth0=False, wlan0=False, timestamp=None):
+    """Record a sample of the status of 'probe_id' (MAC in storage format).
+
+    Several samples in the same minute are merged, i.e. an interface counts as
+    up for the minute if it was up in any of the samples. Minutes between the
+    last written one and this one are cleared (set to unknown).
+    """
+    sample = PRESENT
+    if reachable:
+        sample |= REACHABLE
+    if eth0:
+        sample |= ETH0
+    if wlan0:
+        sample |= WLAN0
+
+    minute = int((timestamp or time()) // 60)
+    with _lock, _open(probe_id, create=True) as buf:
+        last = _HEADER.unpack_from(buf)[0]
+        if minute > last:
+            _clear(buf, last + 1, minute)
+            _HEADER.pack_into(buf, 0, minute)
+        elif minute <= last - SLOTS:
+            # Too old to fit in the buffer
+            return
+        offset = _HEADER.size + minute % SLOTS
+        buf[offset] |= sample
+
+
+def get_samples(probe_id, minutes=24*60, now=None):
+    """Return the samples of the last 'minutes' minutes (at most SLOTS) of
+    'probe_id' as bytes, in chronological order. Minutes without samples
+    are 0."""
+    minutes = min(minutes, SLOTS)
+    current = int((now or time()) // 60)
+    first = current - minutes + 1
+
+    with _lock, _open(probe_id) as buf:
+        if buf is None:
+            return bytes(minutes)
+        last = _HEADER.unpack_from(buf)[0]
+        start = max(first, last - SLOTS + 1)
+        end = min(current, last)
+        samples = _read(buf, start, end)
+
+    # Pad with unknown minutes on both sides
+    before = max(0, min(start, current + 1) - first)
+    after = minutes - before - len(samples)
+    return bytes(before) + samples + bytes(after)
+
+
+def get_uptime(probe_id, minutes=24*60, flag=REACHABLE, now=None):
+    """Return the percentage (0-100) of the sampled minutes of the last
+    'minutes' minutes where 'flag' (REACHABLE, ETH0 or WLAN0) was up, or None
+    if there are no samples in the period"""
+    states = get_samples(probe_id, minutes, now).translate(_TABLES[flag])
+    up = states.count(_UP)
+    sampled = up + states.count(_DOWN)
+    if sampled == 0:
+        return None
+    return 100 * up / sampled
+
+
+def get_outages(probe_id, minutes=24*60, flag=REACHABLE, now=None):
+    """Return a list of (start, end) unix times of the periods in the last
+    'minutes' minutes where 'flag' was sampled as down. Unknown minutes
+    between two down minutes are counted as part of the outage."""
+    current = int((now or time()) // 60)
+    minutes = min(minutes, SLOTS)
+    first = current - minutes + 1
+
+    states = get_samples(probe_id, minutes, now).translate(_TABLES[flag])
+    outages = []
+    for match in re.finditer(b'D[D-]*D|D', states):
+        outages.append(((first + match.start()) * 60, (first + match.end()) * 60))
+    return outages
+
+
+def remove(probe_id):
+    """Remove the history of 'probe_id'"""
+    path = _get_path(probe_id)
+    with _lock:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class _open():
+    """Context manager returning the memory mapped history file of 'probe_id',
+    or None if it doesn't exist (and create is False).
+
+    NB: _lock must be held while using it
+    """
+    def __init__(self, probe_id, create=False):
+        self.path = _get_path(probe_id)
+        self.create = create
+        self.file = None
+        self.buf = None
+
+    def __enter__(self):
+        if not os.path.isfile(self.path):
+            if not self.create:
+                return None
+            with open(self.path, 'wb') as f:
+                f.truncate(_FILE_SIZE)
+
+        self.file = open(self.path, 'r+b')
+        self.buf = mmap.mmap(self.file.fileno(), _FILE_SIZE)
+        return self.buf
+
+    def __exit__(self, *args):
+        if self.buf is not None:
+            self.buf.close()
+        if self.file is not None:
+            self.file.close()
+
+
+def _clear(buf, first, last):
+    """Clear the slots of the minutes from 'first' to 'last' (inclusive)"""
+    if last - first + 1 >= SLOTS:
+        buf[_HEADER.size:] = bytes(SLOTS)
+        return
+    start = first % SLOTS
+    end = last % SLOTS
+    if start <= end:
+        buf[_HEADER.size + start:_HEADER.size + end + 1] = bytes(end - start + 1)
+    else:
+        buf[_HEADER.size + start:] = bytes(SLOTS - start)
+        buf[_HEADER.size:_HEADER.size + end + 1] = bytes(end + 1)
+
+
+def _read(buf, first, last):
+    """Return the samples of the minutes from 'first' to 'last' (inclusive)"""
+    if last < first:
+        return b''
+    start = first % SLOTS
+    end = last % SLOTS
+    if start <= end:
+        return buf[_HEADER.size + start:_HEADER.size + end + 1]
+    return buf[_HEADER.size + start:] + buf[_HEADER.size:_HEADER.size + end + 1]
+
+
+def _get_path(probe_id):
+    dir_path = os.path.join(settings.ROOT_DIR, 'history')
+    if not os.path.exists(dir_path):
+        makedirs(dir_path)
+    return os.path.join(dir_path, probe_id)
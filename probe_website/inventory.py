@@ -0,0 +1,65 @@
+from sqlalchemy.orm import joinedload
+from probe_website import util
+from probe_website.database import Probe
+
+# Builds the Ansible inventory of a user (hosts and all their variables)
+# directly from the SQL database, instead of from exported host_vars files.
+# It's used by dynamic_inventory.py in the project root.
+
+
+def build_inventory(database, username, probe_ids=None):
+    """Return 'username's Ansible inventory as a python data structure, in the
+    format used by dynamic inventory scripts:
+
+    {<username>: {'hosts': [<mac>, ...], 'vars': {'databases': ...}},
+     '_meta': {'hostvars': {<mac>: {'ansible_port': ..., 'networks': ..., ...}}}}
+
+    probe_ids is a list of the probes (MACs) to include. None means all of
+    the user's probes.
+
+    The probes are loaded together with their scripts and network configs
+    in one query.
+    """
+    user = database.get_user(username)
+    if user is None:
+        return {'_meta': {'hostvars': {}}}
+
+    probes = (database.session.query(Probe)
+              .options(joinedload(Probe.scripts), joinedload(Probe.network_configs))
+              .filter(Probe.user_id == user.id)
+              .all())
+
+    organization = user.get_organization()
+    hosts = []
+    hostvars = {}
+    for probe in probes:
+        if probe_ids is not None and probe.custom_id not in probe_ids:
+            continue
+        hosts.append(probe.custom_id)
+        hostvars[probe.custom_id] = get_host_vars(database, probe, username, organization)
+
+    return {
+            username: {
+                'hosts': hosts,
+                'vars': {'databases': database.get_database_info(user)}
+            },
+            '_meta': {'hostvars': hostvars}
+    }
+
+
+def get_host_vars(database, probe, username, organization):
+    """Return the Ansible variables of 'probe'. These are the same as the ones
+    exported to the host_vars files and the inventory file (see
+    ansible_interface.export_probe_configs and export_to_inventory)"""
+    return {
+            'ansible_host': 'localhost',
+            'ansible_port': probe.port,
+            'username': username,
+            'probe_name': probe.name,
+            'probe_location': probe.location,
+            'probe_mac': probe.custom_id,
+            'probe_organization': organization,
+            'probe_config_token': util.get_probe_config_key(probe.custom_id),
+            'host_script_configs': util.strip_id(database.get_script_data(probe)),
+            'networks': util.strip_id(database.get_network_config_data(probe))
+    }
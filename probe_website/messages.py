@@ -15,7 +15,16 @@ ERROR_MESSAGE = {
         'fill_out_database_credentials': (
             'Please fill out the database credentials. '
             '(Under the \'Databases\' tab)'
-        )
+        ),
+        'invalid_rollout': (
+            'Invalid staged rollout options. The canary and batch sizes must be '
+            'positive numbers (the batch size may also be a percentage, like 20%), '
+            'and the max failure rate must be between 0 and 100.'
+        ),
+        'probes_not_connected': (
+            'The following probes are not connected, and will not be updated: {}'
+        ),
+        'invalid_api_token': 'The API token does not exist.'
 }
 
 INFO_MESSAGE = {
@@ -23,11 +32,28 @@ INFO_MESSAGE = {
             'Update is already in progress. Please wait for it to complete before '
             'trying to update again.'
         ),
+        'config_published': (
+            'The configuration of {} probe(s) was published. The probes will '
+            'fetch it the next time they check for updates.'
+        ),
+        'ansible_cancelled': (
+            'The update is being cancelled. Probes that had not completed the update '
+            'may have an incomplete configuration.'
+        ),
         'shutdown_warning': (
             'It is important to shut the probes down properly, to avoid file '
             'corruption. The probes will also not start WiFi probing if an ethernet '
             'cable has been connected (to avoid doing probing over cable '
             'instead of WiFi). Therefore the probes need to be restarted before '
             'WiFi probing can begin. Go to the front page to read how to do that properly.'
-        )
+        ),
+        'profiling_enabled': (
+            'All your requests will now be profiled (until you turn it off, or log out).'
+        ),
+        'profiling_disabled': 'Profiling of your requests was turned off.',
+        'api_token_added': (
+            'The API token was added: <code>{}</code><br>Copy it now, as it will '
+            'not be shown again. Send it in an "Authorization: Bearer &lt;token&gt;" header.'
+        ),
+        'api_token_removed': 'The API token was removed.'
 }
@@ -1,5 +1,5 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime
-from sqlalchemy import ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Float
+from sqlalchemy import ForeignKey, Index
 from sqlalchemy.orm import relationship
 from probe_website.database import Base
 from flask_login import UserMixin
@@ -16,12 +16,12 @@ import re
 class User(Base, UserMixin):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
-    username = Column(String(256))
+    username = Column(String(256), index=True)
     pw_hash = Column(String(256))
     contact_person = Column(String(256))
     contact_email = Column(String(256))
     admin = Column(Boolean)
-    oauth_id = Column(String(512))
+    oauth_id = Column(String(512), index=True)
 
     def __init__(self, username, password, contact_person, contact_email, admin=False, oauth_id=None):
         self.username = username
@@ -64,6 +64,9 @@ class Probe(Base):
     associated = Column(Boolean)
     has_been_updated = Column(Boolean)
     last_updated = Column(DateTime)
+    # Bumped on every change (see database._assign_versions). Rows from
+    # before the column was added have version 0.
+    version = Column(Integer, index=True, server_default='0')
 
     user_id = Column(Integer, ForeignKey('users.id'))
     user = relationship('User', back_populates='probes')
@@ -106,6 +109,7 @@ class Script(Base):
     minute_interval = Column(Integer)
     enabled = Column(Boolean)
     required = Column(Boolean)
+    version = Column(Integer, index=True, server_default='0')
 
     probe_id = Column(Integer, ForeignKey('probes.id'))
     probe = relationship('Probe', back_populates='scripts')
@@ -132,6 +136,7 @@ class NetworkConfig(Base):
     anonymous_id = Column(String(256))
     username = Column(String(256))
     password = Column(String(256))
+    version = Column(Integer, index=True, server_default='0')
 
     probe_id = Column(Integer, ForeignKey('probes.id'))
     probe = relationship('Probe', back_populates='network_configs')
@@ -191,3 +196,156 @@ class Database(Base):
                 filled(self.port) and
                 filled(self.username) and
                 filled(self.password))
+
+
+class AnsibleRun(Base):
+    __tablename__ = 'ansible_runs'
+    id = Column(Integer, primary_key=True)
+    started = Column(DateTime)
+    finished = Column(DateTime)
+    exit_status = Column(Integer)
+    version = Column(Integer, index=True, server_default='0')
+
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
+    user = relationship('User', back_populates='ansible_runs')
+
+    def __init__(self, started):
+        self.started = started
+        self.finished = None
+        self.exit_status = None
+
+    def is_finished(self):
+        return self.finished is not None
+
+    def duration(self):
+        """Return the number of seconds the run lasted (or has lasted so far)"""
+        if self.finished is None:
+            return None
+        return (self.finished - self.started).total_seconds()
+
+    def __repr__(self):
+        return 'id={},started={},finished={},exit_status={},user_id={}'.format(
+                self.id, self.started, self.finished, self.exit_status, self.user_id)
+
+
+class AnsibleRunHost(Base):
+    __tablename__ = 'ansible_run_hosts'
+    # Used for looking up the latest result of a probe in a single query
+    __table_args__ = (Index('ix_ansible_run_hosts_probe_run', 'probe_custom_id', 'run_id'),)
+
+    id = Column(Integer, primary_key=True)
+    probe_custom_id = Column(String(256))
+    ok = Column(Integer)
+    changed = Column(Integer)
+    unreachable = Column(Integer)
+    failed = Column(Integer)
+    duration = Column(Float)
+
+    run_id = Column(Integer, ForeignKey('ansible_runs.id'))
+    run = relationship('AnsibleRun', back_populates='hosts')
+
+    def __init__(self, probe_custom_id):
+        self.probe_custom_id = probe_custom_id
+        self.ok = None
+        self.changed = None
+        self.unreachable = None
+        self.failed = None
+        self.duration = None
+
+    def has_result(self):
+        """Return true if the host was included in the recap of the run"""
+        return self.ok is not None
+
+    def succeeded(self):
+        return self.has_result() and self.unreachable == 0 and self.failed == 0
+
+    def __repr__(self):
+        return ('id={},probe_custom_id={},ok={},changed={},unreachable={},failed={},'
+                'run_id={}'.format(self.id, self.probe_custom_id, self.ok, self.changed,
+                                   self.unreachable, self.failed, self.run_id))
+
+
+class Heartbeat(Base):
+    __tablename__ = 'probe_heartbeats'
+    id = Column(Integer, primary_key=True)
+    # Unix time, as sent by the probe
+    timestamp = Column(Integer)
+    # Unix time the heartbeat was received
+    received = Column(Integer)
+    eth0 = Column(Boolean)
+    wlan0 = Column(Boolean)
+    uptime = Column(Integer)
+    load = Column(Float)
+
+    probe_id = Column(Integer, ForeignKey('probes.id'), unique=True, index=True)
+    probe = relationship('Probe', back_populates='heartbeat')
+
+    def __init__(self):
+        self.timestamp = 0
+        self.received = 0
+
+    def is_fresh(self, max_age):
+        """Return true if the heartbeat was received less than 'max_age' seconds ago"""
+        return time() - self.received < max_age
+
+    def __repr__(self):
+        return 'id={},timestamp={},received={},eth0={},wlan0={},uptime={},load={},probe_id={}'.format(
+                self.id, self.timestamp, self.received, self.eth0, self.wlan0,
+                self.uptime, self.load, self.probe_id)
+
+
+class ApiToken(Base):
+    """A token for API clients (see the request_loader in views.py). Only the
+    SHA-256 hash of the token is stored, as the tokens are random, it
+    doesn't need to be a slow password hash."""
+    __tablename__ = 'api_tokens'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(256))
+    token_hash = Column(String(64), unique=True, index=True)
+    # Space separated, e.g. 'read push'
+    scopes = Column(String(256))
+    created = Column(DateTime)
+
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
+    user = relationship('User', back_populates='api_tokens')
+
+    def __init__(self, name, token_hash, scopes, created):
+        self.name = name
+        self.token_hash = token_hash
+        self.scopes = ' '.join(scopes)
+        self.created = created
+
+    def has_scope(self, scope):
+        return scope in self.scopes.split()
+
+    def __repr__(self):
+        return 'id={},name={},scopes={},created={},user_id={}'.format(
+                self.id, self.name, self.scopes, self.created, self.user_id)
+
+
+class VersionCounter(Base):
+    """The last version assigned to a changed row (single row table)"""
+    __tablename__ = 'version_counter'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer)
+
+
+class DeletedRow(Base):
+    """A tombstone for a deleted versioned row, so clients syncing changes
+    (see DatabaseManager.get_changes) find out about deletions"""
+    __tablename__ = 'deleted_rows'
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String(256))
+    row_id = Column(Integer)
+    user_id = Column(Integer, index=True)
+    version = Column(Integer, index=True)
+
+    def __init__(self, table_name, row_id, user_id, version):
+        self.table_name = table_name
+        self.row_id = row_id
+        self.user_id = user_id
+        self.version = version
+
+    def __repr__(self):
+        return 'id={},table_name={},row_id={},user_id={},version={}'.format(
+                self.id, self.table_name, self.row_id, self.user_id, self.version)
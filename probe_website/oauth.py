@@ -1,8 +1,42 @@
-from rauth import OAuth2Service
+from rauth import OAuth2Service, OAuth2Session
+from requests.adapters import HTTPAdapter
+from requests import RequestException
 from flask import current_app, url_for, request, redirect, session
-from probe_website import secret_settings
+from probe_website import settings, secret_settings
 import json
 
+# Dataporten (Feide) login. There's one DataportenSignin instance for the
+# whole process (dataporten, below), and all its requests to Dataporten go
+# through one pool of kept-alive connections, so a login doesn't have to
+# open new HTTPS connections (and do new TLS handshakes) for the token
+# exchange and the userinfo request.
+
+# Can be changed to e.g. use a local stand-in server (see benchmarks/oauth_server.py)
+OAUTH_BASE_URL = getattr(settings, 'OAUTH_BASE_URL', 'https://auth.dataporten.no/')
+# In seconds, for each request to Dataporten
+OAUTH_TIMEOUT = getattr(settings, 'OAUTH_TIMEOUT', 10)
+# Max number of kept-alive connections to Dataporten
+OAUTH_POOL_SIZE = getattr(settings, 'OAUTH_POOL_SIZE', 10)
+
+_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=OAUTH_POOL_SIZE)
+
+
+class PooledOAuth2Session(OAuth2Session):
+    """rauth's OAuth2Session (a requests Session), using the shared
+    connection pool, and with OAUTH_TIMEOUT as the default timeout"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mount('https://', _adapter)
+        self.mount('http://', _adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', OAUTH_TIMEOUT)
+        return super().request(method, url, **kwargs)
+
+    def close(self):
+        # Closing the session would close the shared pool
+        pass
+
 
 class DataportenSignin():
     def __init__(self):
@@ -10,9 +44,10 @@ class DataportenSignin():
             name='dataporten',
             client_id=secret_settings.OAUTH_CREDENTIALS['id'],
             client_secret=secret_settings.OAUTH_CREDENTIALS['secret'],
-            authorize_url='https://auth.dataporten.no/oauth/authorization',
-            access_token_url='https://auth.dataporten.no/oauth/token',
-            base_url='https://auth.dataporten.no/'
+            authorize_url=OAUTH_BASE_URL + 'oauth/authorization',
+            access_token_url=OAUTH_BASE_URL + 'oauth/token',
+            base_url=OAUTH_BASE_URL,
+            session_obj=PooledOAuth2Session
         )
 
     def get_callback_url(self):
@@ -35,12 +70,16 @@ class DataportenSignin():
                       'redirect_uri': self.get_callback_url()},
                 decoder=lambda x: json.loads(x.decode())
             )
-        except KeyError:
+            userinfo = oauth_session.get('userinfo').json()
+        except (KeyError, ValueError, RequestException) as e:
+            print('Dataporten login failed: {}'.format(e))
             return None
-        userinfo = oauth_session.get('userinfo').json()
         if ('user' in userinfo and
                 'userid_sec' in userinfo['user'] and
                 'name' in userinfo['user'] and
                 'email' in userinfo['user']):
             return userinfo['user']
         return None
+
+
+dataporten = DataportenSignin()
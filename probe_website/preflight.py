@@ -0,0 +1,90 @@
+from concurrent.futures import ThreadPoolExecutor
+from probe_website import util, messages
+from flask import flash
+
+# The pre-flight stage decides which probes a config push should include,
+# before anything is exported or Ansible is started. Checks that only depend
+# on the user are done once, and the (slow) connectivity checks of the
+# probes are run concurrently.
+
+# Max number of connectivity checks running at the same time
+MAX_WORKERS = 16
+
+
+class PreflightReport():
+    """The result of the pre-flight checks of a config push.
+
+    eligible    : probes that should be updated
+    skipped     : (probe, reason) tuples of probes that were left out, where
+                  reason is one of 'not-selected', 'not-associated',
+                  'database-config' or 'network-config'
+    unreachable : probes that passed all other checks, but are not connected
+    """
+    def __init__(self):
+        self.eligible = []
+        self.skipped = []
+        self.unreachable = []
+
+    def eligible_ids(self):
+        return [probe.custom_id for probe in self.eligible]
+
+    def as_dict(self):
+        """Return the report with probe ids instead of probe instances"""
+        return {
+                'eligible': self.eligible_ids(),
+                'skipped': [{'id': probe.custom_id, 'reason': reason} for probe, reason in self.skipped],
+                'unreachable': [probe.custom_id for probe in self.unreachable]
+        }
+
+
+def run_preflight(database, user, selected_probes=None, with_warning=False, check_connectivity=True):
+    """Check which of 'user's probes can be updated, and return a PreflightReport.
+
+    selected_probes is a list of probe ids (MACs in storage format) to
+    consider. None means consider all of the user's probes.
+    If with_warning is True, flash a message for each problem found.
+    If check_connectivity is False, probes are not required to be connected
+    (e.g. when the probes fetch their configs themselves).
+    """
+    report = PreflightReport()
+
+    # This is the same for all probes, so only check it once
+    valid_databases = database.valid_database_configs(user, with_warning=with_warning)
+
+    candidates = []
+    for probe in user.probes:
+        if selected_probes is not None and probe.custom_id not in selected_probes:
+            report.skipped.append((probe, 'not-selected'))
+        elif not probe.associated:
+            report.skipped.append((probe, 'not-associated'))
+        elif not valid_databases:
+            report.skipped.append((probe, 'database-config'))
+        elif not database.valid_network_configs(probe, with_warning=with_warning):
+            report.skipped.append((probe, 'network-config'))
+        else:
+            candidates.append(probe)
+
+    if not check_connectivity:
+        report.eligible = candidates
+        return report
+
+    if len(candidates) == 0:
+        return report
+
+    # Only the port is passed to the threads, so they never touch the SQL session
+    ports = [probe.port for probe in candidates]
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(ports))) as executor:
+        connected = list(executor.map(util.is_probe_connected, ports))
+
+    for probe, is_connected in zip(candidates, connected):
+        if is_connected is True:
+            report.eligible.append(probe)
+        else:
+            report.unreachable.append(probe)
+
+    if with_warning and len(report.unreachable) > 0:
+        names = ', '.join('{} / {}'.format(probe.name, util.convert_mac(probe.custom_id, mode='display'))
+                          for probe in report.unreachable)
+        flash(messages.ERROR_MESSAGE['probes_not_connected'].format(names), 'error')
+
+    return report
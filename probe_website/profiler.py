@@ -0,0 +1,141 @@
+from probe_website import settings
+import os.path
+from os import makedirs, listdir, remove
+import cProfile
+import pstats
+import json
+import re
+import time
+
+# Opt-in profiling of single requests, for admins (see the before/teardown
+# request hooks in views.py). A profiled request is run under cProfile, and
+# the profile is saved at <root>/profiles/<name>.prof, together with a
+# summary (<name>.json) for the profiles page. Only the newest MAX_PROFILES
+# profiles are kept.
+#
+# The summary has the top functions by cumulative time, and the time spent
+# in SQL queries and subprocesses (ssh, nc, ansible-playbook, etc.), found
+# through the call edges into SQLAlchemy's do_execute and subprocess.py.
+
+MAX_PROFILES = getattr(settings, 'MAX_PROFILES', 50)
+TOP_FUNCTIONS = 25
+
+# Functions where SQLAlchemy hands the queries to the database driver
+SQL_FUNCTIONS = ('do_execute', 'do_executemany', 'do_execute_no_params')
+
+
+def start():
+    """Start and return a profiler"""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop(profiler, method, url, username):
+    """Stop 'profiler', and save its profile of the request. Return the
+    name of the profile."""
+    profiler.disable()
+
+    dir_path = _get_dir()
+    name = _get_unique_name(dir_path)
+    profiler.dump_stats(os.path.join(dir_path, name + '.prof'))
+
+    summary = summarize(pstats.Stats(profiler))
+    summary.update({'name': name, 'method': method, 'url': url, 'username': username,
+                    'time': time.strftime('%Y-%m-%d %H:%M:%S')})
+    with open(os.path.join(dir_path, name + '.json'), 'w') as f:
+        json.dump(summary, f)
+
+    _rotate(dir_path)
+    return name
+
+
+def summarize(stats):
+    """Return a dictionary with the total, SQL and subprocess time of
+    'stats' (pstats.Stats), and its top functions by cumulative time"""
+    sql_time = 0
+    subprocess_time = 0
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if _is_sql(func):
+            sql_time += sum(edge[3] for caller, edge in callers.items() if not _is_sql(caller))
+        elif _is_subprocess(func):
+            # Only the calls into subprocess.py, so the time isn't counted
+            # once for each function inside it
+            subprocess_time += sum(edge[3] for caller, edge in callers.items()
+                                   if not _is_subprocess(caller))
+
+    functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    top = [{'function': pstats.func_std_string(func),
+            'calls': nc,
+            'total_time': tt,
+            'cumulative_time': ct}
+           for func, (cc, nc, tt, ct, callers) in functions[:TOP_FUNCTIONS]]
+
+    return {
+            'total_time': stats.total_tt,
+            'sql_time': sql_time,
+            'subprocess_time': subprocess_time,
+            'top_functions': top
+    }
+
+
+def get_summaries():
+    """Return the summaries of all saved profiles, newest first"""
+    dir_path = _get_dir()
+    summaries = []
+    for file_name in sorted(listdir(dir_path), reverse=True):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(dir_path, file_name), 'r') as f:
+                summaries.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return summaries
+
+
+def get_profile_path(name):
+    """Return the path of the profile 'name', or None if there's no such profile"""
+    if re.fullmatch(r'[0-9]{8}-[0-9]{6}-[0-9]+', name) is None:
+        return None
+    path = os.path.join(_get_dir(), name + '.prof')
+    if not os.path.isfile(path):
+        return None
+    return path
+
+
+def _is_sql(func):
+    return func[2] in SQL_FUNCTIONS and 'sqlalchemy' in func[0]
+
+
+def _is_subprocess(func):
+    return os.path.basename(func[0]) == 'subprocess.py'
+
+
+def _get_unique_name(dir_path):
+    """Return a new profile name: the time, and a number that makes it
+    unique within the second (so the names sort by age)"""
+    prefix = time.strftime('%Y%m%d-%H%M%S')
+    n = 0
+    while os.path.exists(os.path.join(dir_path, '{}-{:03d}.prof'.format(prefix, n))):
+        n += 1
+    return '{}-{:03d}'.format(prefix, n)
+
+
+def _rotate(dir_path):
+    """Remove all but the newest MAX_PROFILES profiles"""
+    names = sorted(set(os.path.splitext(file_name)[0] for file_name in listdir(dir_path)),
+                   reverse=True)
+    for name in names[MAX_PROFILES:]:
+        for extension in ['.prof', '.json']:
+            try:
+                remove(os.path.join(dir_path, name + extension))
+            except FileNotFoundError:
+                pass
+
+
+def _get_dir():
+    dir_path = os.path.join(settings.ROOT_DIR, 'profiles')
+    if not os.path.exists(dir_path):
+        makedirs(dir_path)
+    return dir_path
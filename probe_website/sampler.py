@@ -0,0 +1,85 @@
+from probe_website import settings
+from concurrent.futures import ThreadPoolExecutor
+from time import time, sleep
+import fcntl
+import os.path
+from os import makedirs
+import threading
+
+# Background sampler of the probes' connectivity history (see history.py).
+# Once per HISTORY_SAMPLE_INTERVAL seconds, the status of every associated
+# probe is checked and recorded, so the history (and the uptime on the probes
+# page) doesn't depend on someone having the probes page open.
+#
+# The sampler thread is started by the first request of each web server
+# process, but only one process on the server samples at a time: the others
+# wait for the lock file, and take over if the sampling process exits.
+
+# In seconds (None turns the sampler off)
+HISTORY_SAMPLE_INTERVAL = getattr(settings, 'HISTORY_SAMPLE_INTERVAL', 60)
+# Max number of probes checked at the same time
+SAMPLER_WORKERS = 16
+
+_thread = None
+_lock = threading.Lock()
+# The open lock file, once this process has become the sampling process
+_lock_file = None
+
+
+def start(get_probe_ids, sample):
+    """Start the sampler thread, if it isn't running already.
+
+    get_probe_ids is a function returning the MACs of the probes to sample,
+    and sample is a function taking a MAC, which checks and records the
+    status of that probe. Both are called from the sampler's threads.
+    """
+    global _thread
+    if HISTORY_SAMPLE_INTERVAL is None:
+        return
+    with _lock:
+        if _thread is not None:
+            return
+        _thread = threading.Thread(target=_sample_loop, args=(get_probe_ids, sample), daemon=True)
+        _thread.start()
+
+
+def _sample_loop(get_probe_ids, sample):
+    with ThreadPoolExecutor(max_workers=SAMPLER_WORKERS) as executor:
+        while True:
+            # Sample at the start of each interval
+            sleep(HISTORY_SAMPLE_INTERVAL - time() % HISTORY_SAMPLE_INTERVAL)
+            if not _acquire_lock_file():
+                continue
+            try:
+                probe_ids = get_probe_ids()
+            except Exception as e:
+                print('Could not get the probes to sample: {}'.format(e))
+                continue
+            list(executor.map(lambda probe_id: _sample(sample, probe_id), probe_ids))
+
+
+def _sample(sample, probe_id):
+    try:
+        sample(probe_id)
+    except Exception as e:
+        print('Could not sample the status of {}: {}'.format(probe_id, e))
+
+
+def _acquire_lock_file():
+    """Return true if this process is the one that samples"""
+    global _lock_file
+    if _lock_file is not None:
+        return True
+
+    dir_path = os.path.join(settings.ROOT_DIR, 'history')
+    if not os.path.exists(dir_path):
+        makedirs(dir_path)
+    lock_file = open(os.path.join(dir_path, '.sampler.lock'), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        # Another process is sampling
+        lock_file.close()
+        return False
+    _lock_file = lock_file
+    return True
@@ -0,0 +1,62 @@
+from time import monotonic
+import hashlib
+import threading
+
+# In-memory cache of the bodies returned by the status endpoints (see
+# views.status_response). Each entry has an ETag computed from its body, so
+# polls from browsers that already have the current status can be answered
+# with 304 Not Modified without touching the database or running ssh/nc.
+#
+# Keys are tuples, where the first item is the kind of status:
+#   ('connection', <mac>)
+#   ('ansible', <username>, <mac>)
+#   ('rollout', <username>)
+#
+# Entries expire after their TTL, and are invalidated when the status is
+# known to change (heartbeats, Ansible runs starting/finishing, etc.)
+
+_entries = {}
+_lock = threading.Lock()
+
+
+def make_etag(body):
+    """Return the ETag of 'body' (string)"""
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()[:16]
+
+
+def get(key):
+    """Return the (etag, body, mimetype) of 'key', or None if it's not
+    cached (or has expired)"""
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            return None
+        if entry[3] <= monotonic():
+            del _entries[key]
+            return None
+        return entry[:3]
+
+
+def put(key, body, mimetype, ttl):
+    """Cache 'body' for 'ttl' seconds, and return its ETag"""
+    etag = make_etag(body)
+    with _lock:
+        _entries[key] = (etag, body, mimetype, monotonic() + ttl)
+    return etag
+
+
+def invalidate(key):
+    with _lock:
+        _entries.pop(key, None)
+
+
+def invalidate_user(username):
+    """Invalidate all the Ansible and rollout statuses of 'username'"""
+    with _lock:
+        for key in [key for key in _entries if key[0] in ('ansible', 'rollout') and key[1] == username]:
+            del _entries[key]
+
+
+def clear():
+    with _lock:
+        _entries.clear()
@@ -0,0 +1,185 @@
+from subprocess import Popen, DEVNULL
+import os
+import signal
+import threading
+import time
+import resource
+
+# The supervisor owns the child processes started by the web application
+# (i.e. Ansible). It makes sure they are reaped when they exit, and that
+# they can't run forever or use up all the resources of the server.
+
+
+class ChildResult():
+    """The outcome of a supervised process that has exited"""
+    def __init__(self, exit_status, timed_out=False, cancelled=False):
+        self.exit_status = exit_status
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+
+    def __repr__(self):
+        return 'exit_status={},timed_out={},cancelled={}'.format(
+                self.exit_status, self.timed_out, self.cancelled)
+
+
+class _Child():
+    def __init__(self, process, timeout):
+        self.process = process
+        self.deadline = None if timeout is None else time.time() + timeout
+        # Set when the process has been asked to terminate
+        self.kill_deadline = None
+        self.timed_out = False
+        self.cancelled = False
+
+
+class ProcessSupervisor():
+    """Start, watch and reap child processes, identified by a key (e.g. a
+    username). Only one process can run for each key at a time."""
+
+    # Seconds between each check of the running processes
+    poll_interval = 1
+    # Seconds a process gets to exit after SIGTERM, before it is killed
+    kill_grace_period = 10
+
+    def __init__(self):
+        self._children = {}
+        self._results = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def start(self, key, command, stdout, timeout=None, memory_limit=None,
+              cpu_limit=None, env=None):
+        """Start 'command' as a child process identified by 'key', with
+        output written to the file object 'stdout'.
+
+        timeout is the wall-clock time (in seconds) before the process is killed,
+        memory_limit is the max size of the address space (in bytes), and
+        cpu_limit is the max CPU time (in seconds) of the process.
+
+        Return false if a process with that key is already running.
+        """
+        with self._lock:
+            if key in self._children:
+                return False
+
+            # The process gets its own process group, so the processes
+            # it forks can be killed along with it
+            process = Popen(command, stdin=DEVNULL, stdout=stdout, stderr=stdout,
+                            close_fds=True, start_new_session=True, env=env)
+            self._set_limits(process, memory_limit, cpu_limit)
+            self._children[key] = _Child(process, timeout)
+            self._results.pop(key, None)
+
+            if self._reaper is None or not self._reaper.is_alive():
+                self._reaper = threading.Thread(target=self._reap_loop, daemon=True)
+                self._reaper.start()
+
+        return True
+
+    def _set_limits(self, process, memory_limit, cpu_limit):
+        """Apply the resource limits to the (just started) 'process'.
+
+        This is done from the parent instead of with preexec_fn, which isn't
+        safe to use when there are other threads. The limits are inherited
+        by the processes it forks later (e.g. the Ansible workers).
+        """
+        limits = [(resource.RLIMIT_AS, memory_limit), (resource.RLIMIT_CPU, cpu_limit)]
+        for limit, value in limits:
+            if value is None:
+                continue
+            try:
+                resource.prlimit(process.pid, limit, (value, value))
+            except ProcessLookupError:
+                # It has already exited
+                return
+
+    def is_running(self, key):
+        """Return true if the process identified by 'key' is running"""
+        with self._lock:
+            self._check(key)
+            return key in self._children
+
+    def has_result(self, key):
+        """Return true if the process identified by 'key' has exited, and
+        its result has not been fetched with pop_result yet"""
+        with self._lock:
+            self._check(key)
+            return key in self._results
+
+    def pop_result(self, key):
+        """Return the ChildResult of the process identified by 'key', or None
+        if it's still running (or unknown). The result is only returned once."""
+        with self._lock:
+            self._check(key)
+            return self._results.pop(key, None)
+
+    def cancel(self, key):
+        """Terminate the process identified by 'key'.
+
+        Return false if there is no such process running.
+        """
+        with self._lock:
+            self._check(key)
+            if key not in self._children:
+                return False
+            child = self._children[key]
+            child.cancelled = True
+            self._terminate(child)
+        return True
+
+    def wait(self, key, timeout=None):
+        """Block until the process identified by 'key' has exited, or
+        'timeout' seconds have passed. Return true if it has exited."""
+        start = time.time()
+        while self.is_running(key):
+            if timeout is not None and time.time() - start > timeout:
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+    def _reap_loop(self):
+        """Reap exited processes and enforce timeouts until no processes are left"""
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                for key in list(self._children.keys()):
+                    self._check(key)
+                if len(self._children) == 0:
+                    self._reaper = None
+                    return
+
+    def _check(self, key):
+        """Reap the process identified by 'key' if it has exited, and
+        terminate/kill it if it has run for too long.
+
+        NB: The lock must be held when calling this method
+        """
+        if key not in self._children:
+            return
+        child = self._children[key]
+
+        exit_status = child.process.poll()
+        if exit_status is not None:
+            del self._children[key]
+            self._results[key] = ChildResult(exit_status, child.timed_out, child.cancelled)
+            return
+
+        now = time.time()
+        if child.kill_deadline is not None:
+            if now > child.kill_deadline:
+                self._signal(child, signal.SIGKILL)
+        elif child.deadline is not None and now > child.deadline:
+            print('Process {} ({}) timed out'.format(child.process.pid, key))
+            child.timed_out = True
+            self._terminate(child)
+
+    def _terminate(self, child):
+        if child.kill_deadline is None:
+            child.kill_deadline = time.time() + self.kill_grace_period
+            self._signal(child, signal.SIGTERM)
+
+    def _signal(self, child, sig):
+        try:
+            os.killpg(child.process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
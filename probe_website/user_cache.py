@@ -0,0 +1,73 @@
+from probe_website import settings
+from flask_login import UserMixin
+from collections import OrderedDict
+from time import monotonic
+import threading
+
+# Cache of the logged in users, for the Flask-Login user_loader (which is
+# run on every authenticated request, including all the status polls). The
+# entries are CachedUser instances, i.e. copies of the User rows that don't
+# belong to any SQL Alchemy session, so they can be shared between threads.
+#
+# The cache is a bounded LRU cache, and entries expire after USER_CACHE_TTL
+# seconds. Entries are invalidated by DatabaseManager when users are added,
+# updated or removed. NB: Each process has its own cache, so with several
+# processes (e.g. FastCGI), changes made through one process are seen by the
+# others only after the TTL.
+
+USER_CACHE_SIZE = getattr(settings, 'USER_CACHE_SIZE', 256)
+USER_CACHE_TTL = getattr(settings, 'USER_CACHE_TTL', 60)
+
+# username -> (CachedUser, expiry time)
+_entries = OrderedDict()
+_lock = threading.Lock()
+
+
+class CachedUser(UserMixin):
+    """The fields of a User that are used through current_user. Use
+    DatabaseManager.get_user to get the User itself."""
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.admin = user.admin
+        self.contact_person = user.contact_person
+        self.contact_email = user.contact_email
+
+    # This is a method override from UserMixin
+    def get_id(self):
+        return self.username
+
+
+def get(username):
+    """Return the CachedUser of 'username', or None if it's not cached
+    (or has expired)"""
+    with _lock:
+        entry = _entries.get(username)
+        if entry is None:
+            return None
+        if entry[1] <= monotonic():
+            del _entries[username]
+            return None
+        _entries.move_to_end(username)
+        return entry[0]
+
+
+def put(user):
+    """Cache a copy of 'user' (User instance), and return the copy"""
+    cached_user = CachedUser(user)
+    with _lock:
+        _entries[cached_user.username] = (cached_user, monotonic() + USER_CACHE_TTL)
+        _entries.move_to_end(cached_user.username)
+        while len(_entries) > USER_CACHE_SIZE:
+            _entries.popitem(last=False)
+    return cached_user
+
+
+def invalidate(username):
+    with _lock:
+        _entries.pop(username, None)
+
+
+def clear():
+    with _lock:
+        _entries.clear()
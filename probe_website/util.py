@@ -1,9 +1,14 @@
 from re import fullmatch
-from probe_website import settings
+from probe_website import settings, secret_settings
+from probe_website.circuit_breaker import CircuitBreaker
 import subprocess
 from datetime import timedelta
 import json
 import os
+import hashlib
+import hmac
+import base64
+import binascii
 
 
 def is_mac_valid(mac):
@@ -61,6 +66,21 @@ def convert_mac(mac, mode):
         return ':'.join([mac[i:i+2] for i in range(0, len(mac), 2)]).upper()
 
 
+def get_probe_config_key(probe_id):
+    """Return the secret key of 'probe_id' used in pull mode, both for
+    authenticating the probe when it fetches its config bundle and for
+    signing the bundle (see the config_bundles module).
+
+    The key is derived from the server's secret key, so it doesn't need to be
+    stored anywhere. It's given to the probe as the probe_config_token variable.
+    """
+    secret = secret_settings.SECRET_KEY
+    if type(secret) is str:
+        secret = secret.encode('utf-8')
+    probe_id = convert_mac(probe_id, mode='storage')
+    return hmac.new(secret, b'probe-config:' + probe_id.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
 def parse_configs(configs, config_type):
     """Parse data from HTTP POST forms into python datastructures.
 
@@ -74,7 +94,8 @@ def parse_configs(configs, config_type):
     i.e. groups values for each id together
 
     'configs' contains all the config data, while 'config_type' is the
-    content we want to extract
+    content we want to extract. If config_type is None, all types are
+    extracted in one pass, and returned as {type1: {id1: {..}, ..}, type2: ..}
     """
 
     parsed = {}
@@ -86,13 +107,17 @@ def parse_configs(configs, config_type):
             # Probably an entry in another format, so ignore it
             continue
 
-        if val_type != config_type:
+        if config_type is None:
+            entries = parsed.setdefault(val_type, {})
+        elif val_type != config_type:
             continue
+        else:
+            entries = parsed
 
         value = tup[1]
 
-        parsed.setdefault(val_id, {})
-        parsed[val_id].setdefault(attribute, value)
+        entries.setdefault(val_id, {})
+        entries[val_id].setdefault(attribute, value)
 
     return parsed
 
@@ -119,34 +144,93 @@ def is_probe_connected(port):
         print('Invalid port number')
         return -1
 
+    # Known to be down, and retried in the background
+    port = int(port)
+    if probe_breaker.is_open(port):
+        return False
+
+    # A listening port doesn't mean the probe answers (the tunnel may be
+    # stale), so only the SSH commands record successes
+    if _is_port_listening(port):
+        return True
+
+    probe_breaker.record_failure(port)
+    return False
+
+
+def _is_port_listening(port):
+    """Return true if something is listening at [localhost]:<port>"""
     # From netcat manpage:
     # -z      Specifies that nc should just scan for listening daemons,
     #         without sending any data to them.
     FNULL = open(os.devnull, 'w')
-    command = ['nc', '-z', 'localhost', port]
+    command = ['nc', '-z', 'localhost', str(port)]
     try:
         ret_code = subprocess.call(command, stdout=FNULL, stderr=subprocess.STDOUT, close_fds=True)
     except:
         return False
+    finally:
+        FNULL.close()
 
     return True if ret_code == 0 else False
 
 
+def _is_probe_answering(port):
+    """Return true if the probe at [localhost]:<port> answers over SSH
+    within PROBE_CHECK_TIMEOUT seconds"""
+    command = ['ssh',
+               '-p', str(port),
+               '-o', 'UserKnownHostsFile={}/known_hosts'.format(settings.ANSIBLE_PATH),
+               '-o', 'ConnectTimeout={}'.format(PROBE_CHECK_TIMEOUT),
+               '-o', 'BatchMode=yes',
+               'root@localhost',
+               'true']
+    try:
+        ret_code = subprocess.call(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, timeout=PROBE_CHECK_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return ret_code == 0
+
+
+# In seconds: the timeout of the SSH commands run on the probes, and of the
+# (cheaper) check of whether an unreachable probe answers again
+SSH_TIMEOUT = 20
+PROBE_CHECK_TIMEOUT = 5
+
+# Probes (tunnel ports) that have failed repeatedly are answered as
+# disconnected without running nc/ssh (see circuit_breaker.py). A stale
+# tunnel still listens, so the retries check that the probe answers over SSH.
+probe_breaker = CircuitBreaker(check=_is_probe_answering)
+
+
 def get_interface_connection_status(port):
     """Return a json string specifying whether the probe is connected
     to the interntet via eth0 or wlan0 (or both).
 
     Format of returned string: {"eth0": 0 or 1, "wlan0": 1 or 0}
     """
+    port = int(port)
+    if probe_breaker.is_open(port):
+        return None
+
     command = ['ssh',
                '-p', str(port),
                '-o', 'UserKnownHostsFile={}/known_hosts'.format(settings.ANSIBLE_PATH),
                'root@localhost',
                '[ -e /root/connection_status.sh ] && /root/connection_status.sh']
     try:
-        data = subprocess.check_output(command, timeout=20).decode('utf-8')
-    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        data = subprocess.check_output(command, timeout=SSH_TIMEOUT).decode('utf-8')
+    except subprocess.TimeoutExpired:
+        probe_breaker.record_failure(port)
+        return None
+    except subprocess.CalledProcessError as e:
+        # ssh exits with 255 if it couldn't connect, other codes are
+        # from the script itself
+        if e.returncode == 255:
+            probe_breaker.record_failure(port)
         return None
+    probe_breaker.record_success(port)
 
     # Make sure the returned status is correct
     status = json.loads(data)
@@ -156,16 +240,43 @@ def get_interface_connection_status(port):
     return None
 
 
+def is_signature_valid(pub_key, data, signature):
+    """Return true if 'signature' (base64) is a valid RSA (PKCS#1 v1.5, SHA-256)
+    signature of 'data' (string), made with the private key of 'pub_key'
+    (a public SSH key, as registered through register_key).
+
+    This is what you get with 'openssl dgst -sha256 -sign <private key>'.
+    """
+    # Imported here, as it's slow to import, and only needed for heartbeats
+    from Crypto.PublicKey import RSA
+    from Crypto.Signature import PKCS1_v1_5
+    from Crypto.Hash import SHA256
+
+    try:
+        key = RSA.importKey(pub_key)
+        signature = base64.b64decode(signature)
+    except (ValueError, IndexError, TypeError, binascii.Error):
+        return False
+
+    digest = SHA256.new(data.encode('utf-8'))
+    return PKCS1_v1_5.new(key).verify(digest, signature)
+
+
 def reboot_probe(port):
     """Reboot the probe connected to <port> over SSH"""
+    port = int(port)
+    if probe_breaker.is_open(port):
+        return False
+
     command = ['ssh',
                '-p', str(port),
                '-o', 'UserKnownHostsFile={}/known_hosts'.format(settings.ANSIBLE_PATH),
                'root@localhost',
                'reboot']
     try:
-        subprocess.call(command, timeout=20)
+        subprocess.call(command, timeout=SSH_TIMEOUT)
     except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        probe_breaker.record_failure(port)
         return False
 
     return True
@@ -1,31 +1,82 @@
 from probe_website import app
-from flask import render_template, request, abort, redirect, url_for, flash
+from flask import render_template, request, abort, redirect, url_for, flash, jsonify
+from flask import g, session, send_file, stream_with_context, get_flashed_messages
 import probe_website.database
-from probe_website.database import User, Probe
-from probe_website import settings, form_parsers, util, messages, secret_settings
+from probe_website import settings, form_parsers, util, messages, secret_settings, preflight
+from probe_website import config_bundles, history, status_cache, profiler, user_cache, sampler
 from probe_website import ansible_interface as ansible
-from probe_website.oauth import DataportenSignin
+from probe_website.oauth import dataporten
 import flask_login
 from flask_login import current_user
 from collections import OrderedDict
 from datetime import datetime
 import random
 import re
+import time
+import json
 
 database = probe_website.database.DatabaseManager(settings.DATABASE_URL)
 form_parsers.set_database(database)
 
+# Heartbeats older than this (in seconds) are not trusted as connection status
+HEARTBEAT_MAX_AGE = getattr(settings, 'HEARTBEAT_MAX_AGE', 3*60)
+# Max difference (in seconds) between the probe's and the server's clock
+HEARTBEAT_MAX_SKEW = 5*60
+# Max number of seconds the status endpoints cache a status (see status_response)
+STATUS_CACHE_TTL = 60
+# Number of template output pieces sent at a time by stream_template
+STREAM_BUFFER_SIZE = 64
+
 login_manager = flask_login.LoginManager()
 login_manager.init_app(app)
 
 
 @login_manager.user_loader
 def user_loader(username):
-    """Return the User class instance with the username 'username'."""
+    """Return the user with the username 'username', as a CachedUser (see
+    user_cache.py). Use database.get_user(current_user.username) for the
+    User class instance."""
+    user = user_cache.get(username)
+    if user is not None:
+        return user
+
     try:
-        user = database.session.query(User).filter(User.username == username).first()
+        user = database.get_user(username)
     except:
         user = None
+    if user is None:
+        return None
+    return user_cache.put(user)
+
+
+# The endpoints that accept API tokens, and the scope they require
+API_TOKEN_SCOPES = {
+        'get_connection_status': 'read',
+        'get_ansible_status': 'read',
+        'get_rollout_status': 'read',
+        'api_changes': 'read',
+        'api_push_config': 'push'
+}
+
+
+@login_manager.request_loader
+def api_token_loader(request):
+    """Return the user of the API token in the 'Authorization: Bearer <token>'
+    header, if the request is to one of the endpoints the token's scopes
+    give access to (see API_TOKEN_SCOPES). Only used when the request isn't
+    logged in through the session cookie."""
+    scope = API_TOKEN_SCOPES.get(request.endpoint)
+    header = request.headers.get('Authorization', '')
+    if scope is None or not header.startswith('Bearer '):
+        return None
+
+    api_token = database.get_api_token(header[len('Bearer '):].strip())
+    if api_token is None or not api_token.has_scope(scope):
+        return None
+
+    user = user_cache.get(api_token.user.username)
+    if user is None:
+        user = user_cache.put(api_token.user)
     return user
 
 
@@ -35,6 +86,48 @@ def shutdown_database_session(exception=None):
     database.shutdown_session()
 
 
+@app.before_request
+def start_history_sampler():
+    """Start recording the status of the probes in the background (see the
+    sampler module), if it isn't done already"""
+    sampler.start(database.get_associated_probe_ids, _sample_connection_status)
+
+
+def _sample_connection_status(mac):
+    """Check the status of 'mac' (which also records it in the history),
+    and cache it for the status polls"""
+    try:
+        body, mimetype, ttl = _get_connection_status(mac)
+        if ttl > 0:
+            status_cache.put(('connection', mac), body, mimetype, ttl)
+    finally:
+        database.shutdown_session()
+
+
+@app.before_request
+def start_profiling():
+    """Run the request under the profiler if an admin asked for it, with
+    ?__profile=1 or the flag on the profiles page"""
+    if request.args.get('__profile') != '1' and not session.get('profile_requests', False):
+        return
+    if not current_user.is_authenticated or not current_user.admin:
+        return
+    g.profiler = profiler.start()
+
+
+@app.teardown_request
+def stop_profiling(exception=None):
+    """Save the profile of the request, if it was profiled"""
+    request_profiler = getattr(g, 'profiler', None)
+    if request_profiler is None:
+        return
+    g.profiler = None
+    try:
+        profiler.stop(request_profiler, request.method, request.full_path, current_user.username)
+    except OSError as e:
+        print('Could not save profile: {}'.format(e))
+
+
 @app.route('/')
 def index():
     """Render home page if the user is authenticated.
@@ -53,7 +146,7 @@ def login():
         username = request.form.get('username', '')
         password = request.form.get('password', '')
 
-        user = user_loader(username)
+        user = database.get_user(username)
 
         if user is not None and user.check_password(password):
             flask_login.login_user(user)
@@ -69,28 +162,26 @@ def login():
 def oauth_authorize():
     if flask_login.current_user.is_authenticated:
         return redirect(url_for('index'))
-    oauth = DataportenSignin()
-    return oauth.authorize()
+    return dataporten.authorize()
 
 
 @app.route('/__oauth/callback')
 def oauth_callback():
     if flask_login.current_user.is_authenticated:
         return redirect(url_for('index'))
-    oauth = DataportenSignin()
-    userinfo = oauth.callback()
+    userinfo = dataporten.callback()
 
     if userinfo is None:
         flash('Authentication failed', 'error')
         return redirect(url_for('index'))
 
     feide_id = userinfo['userid_sec'][0].replace('feide:', '')
-    user = database.session.query(User).filter(User.oauth_id == feide_id).first()
+    user = database.get_user_by_oauth_id(feide_id)
     if user is None:
         rand_pass = ''.join(random.choice('abcdefghijklmnopqrstuvwxyz0123456789') for i in range(64))
         database.add_user(feide_id, rand_pass, userinfo['name'], userinfo['email'], False, feide_id)
         database.save_changes()
-        user = database.session.query(User).filter(User.oauth_id == feide_id).first()
+        user = database.get_user_by_oauth_id(feide_id)
     flask_login.login_user(user, True)
     return redirect(url_for('index'))
 
@@ -154,7 +245,9 @@ def probes():
         - Remove a probe
         - Reboot a probe
         - Renew a probe's association period (if not already associated)
-        - Push configurations to probes (i.e. run Ansible)
+        - Push configurations to probes (i.e. run Ansible), optionally as
+          a staged rollout
+        - Cancel a running push
     """
     user = database.get_user(current_user.username)
     if request.method == 'POST':
@@ -175,6 +268,9 @@ def probes():
                 flash('Invalid probe ID', 'error')
             else:
                 ansible.remove_host_config(probe_id)
+                config_bundles.remove_bundle(util.convert_mac(probe_id, mode='storage'))
+                history.remove(util.convert_mac(probe_id, mode='storage'))
+                status_cache.invalidate(('connection', util.convert_mac(probe_id, mode='storage')))
                 database.save_changes()
         elif action == 'renew_period':
             probe_id = request.form.get('probe_id', '')
@@ -183,49 +279,43 @@ def probes():
                 probe.new_association_period()
                 database.save_changes()
         elif action == 'push_config':
-            # Only run one instance of Ansible at a time (for each user)
-            if not ansible.is_ansible_running(current_user.username):
-                # Export configs in the sql database to ansible readable configs
-                for probe in database.session.query(Probe).filter(Probe.user_id == user.id).all():
-                    # Export script config
-                    data = util.strip_id(database.get_script_data(probe))
-                    ansible.export_host_config(probe.custom_id,
-                                               {'host_script_configs': data},
-                                               'script_configs')
-                    # Export probe info config
-                    ansible.export_host_config(probe.custom_id,
-                                               {'probe_name': probe.name,
-                                                'probe_location': probe.location,
-                                                'probe_mac': probe.custom_id,
-                                                'probe_organization': user.get_organization()},
-                                               'probe_info')
-
-                    if (probe.associated and
-                            util.is_probe_connected(probe.port) and
-                            database.valid_network_configs(probe, with_warning=True) and
-                            database.valid_database_configs(user, with_warning=True)):
-                        data = util.strip_id(database.get_network_config_data(probe))
-                        ansible.export_host_config(probe.custom_id,
-                                               {'networks': data},
-                                               'network_configs')
-                # Check which probes are selected
-                selected_probes = []
-                for entry in request.form:
-                    match = re.fullmatch('selected\-([0-9a-f]{12})', entry)
-                    if match:
-                        selected_probes.append(match.group(1))
-                ansible.export_to_inventory(current_user.username, database, selected_probes)
-                ansible.export_known_hosts(database)
-                ansible.run_ansible_playbook(current_user.username)
-            else:
+            rollout = None
+            if request.form.get('rollout', '') != '':
+                rollout = form_parsers.parse_rollout()
+                if rollout is None:
+                    return redirect(url_for('probes'))
+
+            # Check which probes are selected
+            selected_probes = []
+            for entry in request.form:
+                match = re.fullmatch('selected\-([0-9a-f]{12})', entry)
+                if match:
+                    selected_probes.append(match.group(1))
+
+            # No selection means all probes
+            report = push_configs(user, selected_probes or None, rollout, with_warning=True)
+            if report is None:
                 flash(messages.INFO_MESSAGE['ansible_already_running'], 'info')
+            elif config_bundles.PULL_MODE:
+                flash(messages.INFO_MESSAGE['config_published'].format(len(report.eligible)), 'info')
+        elif action == 'cancel_push':
+            if ansible.cancel_ansible_playbook(current_user.username):
+                flash(messages.INFO_MESSAGE['ansible_cancelled'], 'info')
 
         # Redirect to avoid re-POSTing
         return redirect(url_for('probes'))
 
-    probes = database.get_all_probes_data(current_user.username)
-    return render_template('probes.html',
-                           probes=probes,
+    def get_probes():
+        # The probes are read from the database while the page is sent
+        now = time.time()
+        for probe in database.iter_probes_data(current_user.username):
+            probe['uptime'] = history.get_uptime(probe['storage_id'], now=now)
+            probe['outages'] = [(datetime.fromtimestamp(start), datetime.fromtimestamp(end))
+                                for start, end in history.get_outages(probe['storage_id'], now=now)]
+            yield probe
+
+    return stream_template('probes.html',
+                           probes=get_probes(),
                            kibana_dashboard='probe-stats',
                            organization=user.get_organization())
 
@@ -240,6 +330,8 @@ def probe_setup():
         - Basic probe info (name, MAC and location)
         - Script configurations (interval and enabled/disabled for each script)
         - Network configration (SSID, anon id, username, password, cert)
+
+    The configuration can also be pushed to the probe right after saving.
     """
     probe_id = request.args.get('id', '')
     if probe_id == '':
@@ -247,26 +339,20 @@ def probe_setup():
         abort(404)
 
     probe_id = util.convert_mac(probe_id, mode='storage')
-    probe = database.get_probe(probe_id)
+    probe = database.get_probe_with_configs(probe_id)
 
     if probe is None or probe.user.username != current_user.username:
         flash('Unknown probe ID')
         abort(404)
 
     if request.method == 'POST':
-        successful_script_update = form_parsers.update_scripts()
-        successful_network_update = form_parsers.update_network_configs()
-        successful_certificate_upload = form_parsers.upload_certificate(probe_id, current_user.username)
-        successful_probe_update = form_parsers.update_probe(probe_id)
-
-        if (successful_script_update and
-                successful_probe_update and
-                successful_network_update and
-                successful_certificate_upload):
+        if form_parsers.save_probe_setup(probe, current_user.username):
             database.save_changes()
 
             action = request.form.get('action', '')
-            if action == 'save_as_default':
+            if action == 'save_and_push':
+                push_single_probe(probe, current_user.username)
+            elif action == 'save_as_default':
                 ansible.export_group_config(current_user.username,
                                             {'group_script_configs': database.get_script_data(probe)},
                                             'script_configs')
@@ -324,7 +410,7 @@ def user_managment():
             username = request.form.get('username', '')
 
 
-    return render_template('user_managment.html', users=database.get_all_user_data())
+    return stream_template('user_managment.html', users=database.iter_user_data())
 
 
 @app.route('/edit_user', methods=['GET', 'POST'])
@@ -362,6 +448,48 @@ def edit_user():
                            user=user_data)
 
 
+@app.route('/profiles', methods=['GET', 'POST'])
+@flask_login.login_required
+def profiles():
+    """Render page listing the saved request profiles. On POST: turn
+    profiling of all the admin's requests on or off.
+
+    This page can only be accessed by an admin.
+    """
+    if not current_user.admin:
+        return abort(403)
+
+    if request.method == 'POST':
+        action = request.form.get('action', '')
+        if action == 'enable_profiling':
+            session['profile_requests'] = True
+            flash(messages.INFO_MESSAGE['profiling_enabled'], 'info')
+        elif action == 'disable_profiling':
+            session.pop('profile_requests', None)
+            flash(messages.INFO_MESSAGE['profiling_disabled'], 'info')
+        return redirect(url_for('profiles'))
+
+    return render_template('profiles.html',
+                           profiles=profiler.get_summaries(),
+                           profiling=session.get('profile_requests', False))
+
+
+@app.route('/profiles/<name>', methods=['GET'])
+@flask_login.login_required
+def download_profile(name):
+    """Download the profile 'name' (a pstats file)
+
+    This page can only be accessed by an admin.
+    """
+    if not current_user.admin:
+        return abort(403)
+
+    path = profiler.get_profile_path(name)
+    if path is None:
+        abort(404)
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True)
+
+
 # The following two views are used as an API for registering a new
 # probe, and are not meant to be accessed through a web browser
 
@@ -446,6 +574,104 @@ def get_port():
     return str(probe.port)
 
 
+@app.route('/heartbeat', methods=['POST'])
+def heartbeat():
+    """Receive a heartbeat from a probe, with its current connection status.
+
+    Form fields: mac, timestamp (unix time), eth0 (0/1), wlan0 (0/1),
+    uptime (seconds), load (1 minute load average) and signature. The
+    signature is the base64 encoded RSA SHA-256 signature of the string
+    'mac|timestamp|eth0|wlan0|uptime|load' (the fields exactly as sent),
+    made with the probe's SSH key (the one registered through register_key).
+
+    The function can give the following responses (with explanation):
+        invalid-mac         : The supplied MAC was invalid (in form)
+        unknown-mac         : The MAC was valid, but is not in the database
+        not-registered      : No key has been registered for the probe
+        invalid-data        : Some of the other fields were missing or invalid
+        invalid-signature   : The signature didn't match the registered key
+        invalid-timestamp   : The timestamp is too far off the server's clock,
+                              or not newer than the previous heartbeat
+        success             : The heartbeat was stored
+    """
+    mac = request.form.get('mac', '')
+    if not util.is_mac_valid(mac):
+        return 'invalid-mac'
+
+    probe = database.get_probe(util.convert_mac(mac, mode='storage'))
+    if probe is None:
+        return 'unknown-mac'
+
+    if probe.pub_key == '' or not probe.associated:
+        return 'not-registered'
+
+    fields = [request.form.get(field, '') for field in ['timestamp', 'eth0', 'wlan0', 'uptime', 'load']]
+    try:
+        timestamp = int(fields[0])
+        eth0 = fields[1] == '1'
+        wlan0 = fields[2] == '1'
+        uptime = int(fields[3])
+        load = float(fields[4])
+    except ValueError:
+        return 'invalid-data'
+
+    signed_data = '|'.join([mac] + fields)
+    if not util.is_signature_valid(probe.pub_key, signed_data, request.form.get('signature', '')):
+        return 'invalid-signature'
+
+    if abs(time.time() - timestamp) > HEARTBEAT_MAX_SKEW:
+        return 'invalid-timestamp'
+
+    if not database.update_heartbeat(probe, timestamp, eth0, wlan0, uptime, load):
+        return 'invalid-timestamp'
+
+    database.save_changes()
+    history.record(probe.custom_id, True, eth0, wlan0, timestamp)
+    status_cache.invalidate(('connection', probe.custom_id))
+    return 'success'
+
+
+@app.route('/probe_config/<mac>', methods=['GET'])
+def probe_config(mac):
+    """Return the published config bundle of the probe with MAC 'mac' (pull mode).
+
+    The probe authenticates with its config token (the probe_config_token
+    variable) in an 'Authorization: Bearer <token>' header. The bundle is
+    JSON, signed with HMAC-SHA256 using the token as key (the signature is
+    in the X-Config-Signature header). Probes should send the ETag of their
+    current bundle in If-None-Match, and will then get 304 Not Modified
+    if it's unchanged.
+
+    Error responses (with explanation):
+        invalid-mac     (400) : The supplied MAC was invalid (in format)
+        invalid-token   (403) : The token is missing or wrong
+        no-config       (404) : No config has been published for the probe
+    """
+    if not util.is_mac_valid(mac):
+        return 'invalid-mac', 400
+
+    mac = util.convert_mac(mac, mode='storage')
+    auth = request.headers.get('Authorization', '')
+    if not auth.startswith('Bearer ') or not config_bundles.is_valid_token(mac, auth[len('Bearer '):]):
+        return 'invalid-token', 403
+
+    # Everything up to here is done without touching the database or the bundle
+    info = config_bundles.get_bundle_info(mac)
+    if info is None:
+        return 'no-config', 404
+
+    if request.if_none_match.contains(info['etag']):
+        response = app.response_class(status=304)
+    else:
+        body = config_bundles.load_bundle(mac)
+        if body is None:
+            return 'no-config', 404
+        response = app.response_class(body, mimetype='application/json')
+        response.headers['X-Config-Signature'] = info['signature']
+    response.set_etag(info['etag'])
+    return response
+
+
 @app.route('/get_connection_status', methods=['GET'])
 @flask_login.login_required
 def get_connection_status():
@@ -456,28 +682,55 @@ def get_connection_status():
         invalid-mac
         unknown-mac
         {"eth0": 0 or 1, "wlan0": 1 or 0}
+        (with "uptime" and "load" too, if the status is from a heartbeat)
 
         For backwards compatibility:
         connected
+
+    If the probe sends heartbeats (see heartbeat()), the status is taken
+    from the last one. Probes that have never sent a heartbeat are checked
+    over SSH instead. The status is cached (see status_response).
     """
     mac = request.args.get('mac', '')
     if mac == '':
         return 'invalid-mac'
 
     mac = util.convert_mac(mac, 'storage')
+    return status_response(('connection', mac), lambda: _get_connection_status(mac))
+
+
+def _get_connection_status(mac):
     probe = database.get_probe(mac)
     if probe is None:
-        return 'unknown-mac'
+        return 'unknown-mac', 'text/html', 0
+
+    if probe.heartbeat is not None:
+        heartbeat = probe.heartbeat
+        if not heartbeat.is_fresh(HEARTBEAT_MAX_AGE):
+            history.record(mac, False)
+            return '{"eth0": 0, "wlan0": 0}', 'text/html', STATUS_CACHE_TTL
+        history.record(mac, True, heartbeat.eth0, heartbeat.wlan0)
+        body = json.dumps({'eth0': int(heartbeat.eth0), 'wlan0': int(heartbeat.wlan0),
+                           'uptime': heartbeat.uptime, 'load': heartbeat.load}, sort_keys=True)
+        # Don't keep it after the heartbeat gets stale
+        ttl = min(STATUS_CACHE_TTL, HEARTBEAT_MAX_AGE - (time.time() - heartbeat.received))
+        # Same content type as the status from connection_status.sh, as the
+        # probes page parses it itself
+        return body, 'text/html', ttl
 
     status = util.is_probe_connected(probe.port)
     if status:
         con_stat = util.get_interface_connection_status(probe.port)
         if con_stat is not None:
-            return con_stat
+            interfaces = json.loads(con_stat)
+            history.record(mac, True, interfaces['eth0'] == 1, interfaces['wlan0'] == 1)
+            return con_stat, 'text/html', STATUS_CACHE_TTL
         else:
-            return 'connected'
+            history.record(mac, True)
+            return 'connected', 'text/html', STATUS_CACHE_TTL
 
-    return '{"eth0": 0, "wlan0": 0}'
+    history.record(mac, False)
+    return '{"eth0": 0, "wlan0": 0}', 'text/html', STATUS_CACHE_TTL
 
 
 @app.route('/get_ansible_status', methods=['GET'])
@@ -489,6 +742,7 @@ def get_ansible_status():
     Returned statuses will be either:
         invalid-mac
         unknown-mac
+        queued
         updating
         failed
         not-updated
@@ -499,29 +753,192 @@ def get_ansible_status():
         return 'invalid-mac'
 
     mac = util.convert_mac(mac, 'storage')
+    username = current_user.username
+    return status_response(('ansible', username, mac), lambda: _get_ansible_status(username, mac))
+
+
+def _get_ansible_status(username, mac):
     probe = database.get_probe(mac)
     if probe is None:
-        return 'unknown-mac'
-
-    status = ansible.get_playbook_status(current_user.username, probe)
-    if status in ['updating', 'failed']:
-        return status
+        return 'unknown-mac', 'text/html', 0
 
-    if status == 'completed':
-        probe.has_been_updated = True
-        if (probe.last_updated is None or
-                (datetime.today() - probe.last_updated).total_seconds() >= 60):
-            probe.last_updated = datetime.today()
-            database.save_changes()
+    # The time of last update is set when the results of the run are recorded
+    status = ansible.get_playbook_status(username, database, probe)
+    if status in ['queued', 'updating']:
+        # Changes as soon as the run progresses, so it's not cached
+        return status, 'text/html', 0
+    if status == 'failed':
+        return status, 'text/html', STATUS_CACHE_TTL
 
     if status == 'completed' or probe.has_been_updated:
         if probe.last_updated is None:
             probe.last_updated = datetime.today()
             database.save_changes()
         time = util.get_textual_timedelta(datetime.today() - probe.last_updated)
-        return 'updated-{}'.format(time)
+        return 'updated-{}'.format(time), 'text/html', STATUS_CACHE_TTL
+
+    return 'not-updated', 'text/html', STATUS_CACHE_TTL
+
+
+@app.route('/get_rollout_status', methods=['GET'])
+@flask_login.login_required
+def get_rollout_status():
+    """Return the progress of the current user's last staged rollout as JSON
+
+    See ansible_interface.Rollout.get_status for the format. If no staged
+    rollout has been started, {"state": "none"} is returned.
+    """
+    username = current_user.username
+    return status_response(('rollout', username), lambda: _get_rollout_status(username))
+
+
+def _get_rollout_status(username):
+    # Make sure a finished rollout gets its results recorded
+    ansible.get_playbook_status(username, database)
+
+    status = ansible.get_rollout_status(username)
+    if status is None:
+        status = {'state': 'none'}
+    ttl = 0 if status['state'] == 'running' else STATUS_CACHE_TTL
+    return json.dumps(status, sort_keys=True), 'application/json', ttl
+
+
+@app.route('/api/changes', methods=['GET'])
+@flask_login.login_required
+def api_changes():
+    """Return the current user's probes, scripts, network configs and
+    Ansible runs that have changed since the version given in the 'since'
+    argument, as JSON (see DatabaseManager.get_changes for the format).
+
+    Leaving out 'since' (or 0) returns everything. The returned 'version'
+    should be used as 'since' in the next request.
+
+    Error responses (with explanation):
+        invalid-version (400) : 'since' is not a non-negative integer
+    """
+    since = request.args.get('since', '0')
+    if not since.isdigit():
+        return 'invalid-version', 400
+
+    return jsonify(database.get_changes(current_user.username, int(since)))
+
+
+@app.route('/api/push_config', methods=['POST'])
+@flask_login.login_required
+def api_push_config():
+    """Push the configs of the current user's probes, like the push button on
+    the probes page (or publish them, in pull mode), and return the
+    pre-flight report as JSON:
+
+    {'eligible': [<MAC>, ...], 'skipped': [{'id': <MAC>, 'reason': ...}, ...],
+     'unreachable': [<MAC>, ...]}
+
+    Form fields (all optional):
+        probes  : comma separated MACs of the probes to push to (default: all)
+        rollout : if not empty, do a staged rollout with the fields
+                  canary_size, batch_size and max_failure_rate (as on the
+                  probes page)
+
+    Error responses (with explanation):
+        invalid-probes (400)  : one of the MACs is invalid
+        invalid-rollout (400) : the staged rollout fields are invalid
+        already-running (409) : a push is already running
+    """
+    selected_probes = None
+    if request.form.get('probes', '') != '':
+        selected_probes = []
+        for probe_id in request.form['probes'].split(','):
+            if not util.is_mac_valid(probe_id.strip()):
+                return 'invalid-probes', 400
+            selected_probes.append(util.convert_mac(probe_id.strip(), mode='storage'))
+
+    rollout = None
+    if request.form.get('rollout', '') != '':
+        rollout = form_parsers.parse_rollout()
+        if rollout is None:
+            return 'invalid-rollout', 400
+
+    report = push_configs(database.get_user(current_user.username), selected_probes, rollout)
+    if report is None:
+        return 'already-running', 409
+    return jsonify(report.as_dict())
+
+
+@app.route('/api_tokens', methods=['GET', 'POST'])
+@flask_login.login_required
+def api_tokens():
+    """Render page for managing the current user's API tokens. On POST:
+    add or remove a token."""
+    if request.method == 'POST':
+        action = request.form.get('action', '')
+        if action == 'new_token':
+            scopes = ['read', 'push'] if request.form.get('scope', '') == 'push' else ['read']
+            token = database.add_api_token(current_user.username, request.form.get('name', ''), scopes)
+            if token is None:
+                database.revert_changes()
+                flash(messages.ERROR_MESSAGE['invalid_settings'], 'error')
+            else:
+                database.save_changes()
+                flash(messages.INFO_MESSAGE['api_token_added'].format(token), 'info')
+        elif action == 'remove_token':
+            if database.remove_api_token(current_user.username, request.form.get('token_id', '')):
+                database.save_changes()
+                flash(messages.INFO_MESSAGE['api_token_removed'], 'info')
+            else:
+                database.revert_changes()
+                flash(messages.ERROR_MESSAGE['invalid_api_token'], 'error')
 
-    return 'not-updated'
+        # Redirect to avoid re-POSTing
+        return redirect(url_for('api_tokens'))
+
+    user = database.get_user(current_user.username)
+    return render_template('api_tokens.html', tokens=user.api_tokens)
+
+
+def stream_template(template_name, **context):
+    """Render 'template_name' as a streamed response, i.e. the page is sent
+    while it's being rendered. Used for pages with very long lists, which
+    should be given to the template as generators."""
+    # The session is saved before the page is rendered, so the flashed
+    # messages must be popped from it now. They are kept for the rest of
+    # the request, so the template gets them from get_flashed_messages.
+    get_flashed_messages(with_categories=True)
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    # Send the page in chunks, instead of one (small) string at a time
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return app.response_class(stream_with_context(stream))
+
+
+def status_response(key, get_status):
+    """Return a response with the status cached at 'key' in status_cache,
+    or, if it isn't cached, the status returned by get_status().
+
+    get_status should return a (body, mimetype, ttl) tuple, where ttl is the
+    number of seconds the status can be cached (0 means not at all).
+
+    The response has an ETag, and browsers are told to always revalidate
+    it (Cache-Control: private, no-cache). If the browser already has the
+    current status (If-None-Match), 304 Not Modified is returned. For cached
+    statuses this is done without touching the database.
+    """
+    entry = status_cache.get(key)
+    if entry is not None:
+        etag, body, mimetype = entry
+    else:
+        body, mimetype, ttl = get_status()
+        if ttl > 0:
+            etag = status_cache.put(key, body, mimetype, ttl)
+        else:
+            etag = status_cache.make_etag(body)
+
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 #################################################################
@@ -531,6 +948,66 @@ def get_ansible_status():
 #################################################################
 
 
+def push_configs(user, selected_probes=None, rollout=None, with_warning=False):
+    """Push the configs of 'user's probes with Ansible, or publish them in pull
+    mode. Return the pre-flight report, or None if Ansible is already running
+    for the user.
+
+    selected_probes is a list of probe ids (None means all the user's probes),
+    and rollout is the staged rollout options (see form_parsers.parse_rollout).
+    """
+    if config_bundles.PULL_MODE:
+        # The probes fetch the published configs themselves
+        report = preflight.run_preflight(database, user, selected_probes,
+                                         with_warning=with_warning, check_connectivity=False)
+        config_bundles.publish_bundles(database, user.username, report.eligible_ids())
+        return report
+
+    # Only run one instance of Ansible at a time (for each user)
+    if ansible.is_ansible_running(user.username):
+        return None
+
+    report = preflight.run_preflight(database, user, selected_probes, with_warning=with_warning)
+
+    # Export configs in the sql database to ansible readable configs
+    for probe in report.eligible:
+        ansible.export_probe_configs(probe, user.get_organization(), database)
+    ansible.export_to_inventory(user.username, report.eligible)
+    ansible.export_known_hosts(database)
+    ansible.run_ansible_playbook(user.username, database, rollout=rollout)
+    return report
+
+
+def push_single_probe(probe, username):
+    """Push the configuration of 'probe' only, reusing the existing
+    inventory (limited to this probe). Return true if Ansible was started
+    (or, in pull mode, if the config was published)"""
+    if config_bundles.PULL_MODE:
+        user = database.get_user(username)
+        report = preflight.run_preflight(database, user, [probe.custom_id],
+                                         with_warning=True, check_connectivity=False)
+        if len(report.eligible) == 0:
+            return False
+        config_bundles.publish_bundles(database, username, [probe.custom_id])
+        flash(messages.INFO_MESSAGE['config_published'].format(1), 'info')
+        return True
+
+    if ansible.is_ansible_running(username):
+        flash(messages.INFO_MESSAGE['ansible_already_running'], 'info')
+        return False
+
+    user = database.get_user(username)
+    report = preflight.run_preflight(database, user, [probe.custom_id], with_warning=True)
+    if len(report.eligible) == 0:
+        return False
+
+    ansible.export_probe_configs(probe, user.get_organization(), database)
+    ansible.ensure_inventory_entry(username, probe)
+    ansible.ensure_known_host(probe)
+    ansible.run_ansible_playbook(username, database, limit=[probe.custom_id])
+    return True
+
+
 def generate_probe_setup_template(probe_id, username):
     """Generate a probe setup page and return it."""
     probe_data = database.get_probe_data(probe_id)
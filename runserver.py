@@ -1,4 +1,5 @@
 from probe_website import app
 
-app.run(debug=True, host='0.0.0.0')
-# app.run(debug=True)
+if __name__ == '__main__':
+    app.run(debug=True, host='0.0.0.0')
+    # app.run(debug=True)
@@ -71,3 +71,14 @@ fi
 # echo '[+] Add paths to config files'
 # sed -i "s|ADD_PROJECT_PATH_HERE|${CURR_DIR}|g" "${CURR_DIR}/probe_website/settings.py"
 # sed -i "s|ADD_CERT_DIR_HERE|${CURR_DIR}/ansible-probes/certs|g" "${CURR_DIR}/ansible-probes/group_vars/all/locations"
+
+
+# The web server doesn't create the database tables (or the admin user) itself
+if [[ -f probe_website/settings.py && -f probe_website/secret_settings.py ]]; then
+    echo '[+] Setting up the database'
+    FLASK_APP=runserver.py flask init-db
+    echo '[+] NB: Make sure the database is writable by the web server user'
+else
+    echo '[!] probe_website/settings.py or secret_settings.py is missing, so the database was not set up'
+    echo '    Add them, and run: FLASK_APP=runserver.py flask init-db'
+fi
@@ -0,0 +1,57 @@
+import shutil
+import socket
+import time
+import unittest
+from benchmarks import common
+
+# Run with: python -m unittest discover tests
+common.configure()
+
+# Must be imported after configure()
+from probe_website import util
+
+
+@unittest.skipUnless(shutil.which('nc') and shutil.which('ssh'), 'needs nc and ssh')
+class StaleTunnelTest(unittest.TestCase):
+    """A stale tunnel: the port listens, but nothing ever answers"""
+
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(('localhost', 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+
+        self.timeouts = util.SSH_TIMEOUT, util.PROBE_CHECK_TIMEOUT
+        util.SSH_TIMEOUT = util.PROBE_CHECK_TIMEOUT = 1
+        util.probe_breaker.reset()
+
+    def tearDown(self):
+        util.SSH_TIMEOUT, util.PROBE_CHECK_TIMEOUT = self.timeouts
+        util.probe_breaker.reset()
+        self.listener.close()
+
+    def poll(self, port):
+        """Do what a status poll does (see views._get_connection_status)"""
+        if util.is_probe_connected(port):
+            return util.get_interface_connection_status(port)
+        return None
+
+    def test_breaker_opens(self):
+        for i in range(util.probe_breaker.failure_threshold):
+            self.assertFalse(util.probe_breaker.is_open(self.port))
+            # The port is given as a string sometimes, and as an int other times
+            self.assertIsNone(self.poll(str(self.port) if i % 2 else self.port))
+
+        self.assertTrue(util.probe_breaker.is_open(self.port))
+        start = time.monotonic()
+        self.assertFalse(util.is_probe_connected(self.port))
+        self.assertFalse(util.reboot_probe(str(self.port)))
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_retry_check(self):
+        self.assertTrue(util._is_port_listening(self.port))
+        self.assertFalse(util._is_probe_answering(self.port))
+
+
+if __name__ == '__main__':
+    unittest.main()